@@ -0,0 +1,380 @@
+"""
+Description: Benchmark suite that times and memory profiles each stage of the pipeline end to end on the
+             bundled test data (input/test_data, with the input/test_run configuration). Each stage is run
+             in its own process so the peak memory of one stage doesn't hide the next. Results are appended
+             to a history file, and each new result is compared against the recent history for the same host
+             so that regressions (ex. from a basd or xarray upgrade) show up before they reach production.
+Input:
+    - input/test_run/*.csv - configuration the benchmark experiments are copied from
+    - input/test_data - small sim and obs datasets
+    - input/MRI-stitches-experiment/trajectories.csv - trajectories used to time the STITCHES interpolation
+Output:
+    - input/_benchmark, input/_benchmark_stitched - benchmark experiment configurations
+    - intermediate/benchmarks/workspace - copies of the data and all outputs written by the stages
+    - intermediate/benchmarks/history.jsonl - one record per stage per benchmark run
+Usage:
+    python code/python/benchmark.py
+    python code/python/benchmark.py --stages planner interp --repeat 3
+"""
+
+# Import Libraries
+import argparse
+import datetime
+import csv
+import glob
+import importlib.metadata
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+# Paths
+INPUT_PATH = 'input'
+INTERMEDIATE_PATH = 'intermediate'
+CODE_PATH = os.path.join('code', 'python')
+BENCHMARK_PATH = os.path.join(INTERMEDIATE_PATH, 'benchmarks')
+WORKSPACE_PATH = os.path.join(BENCHMARK_PATH, 'workspace')
+HISTORY_FILE = os.path.join(BENCHMARK_PATH, 'history.jsonl')
+
+# Benchmark experiment names and the experiment they're copied from
+BENCHMARK_RUN = '_benchmark'
+BENCHMARK_STITCHED_RUN = '_benchmark_stitched'
+SOURCE_RUN = 'test_run'
+TEST_DATA_PATH = os.path.join(INPUT_PATH, 'test_data')
+
+# Every stage, in the order they run
+STAGES = ['planner', 'create_tasrange_tasskew', 'basd_downloaded', 'basd_stitches',
+          'load_sd_data', 'create_derived_outputs', 'interp']
+
+# Packages whose versions are recorded with each result
+TRACKED_PACKAGES = ['basd', 'xarray', 'dask', 'distributed', 'numpy', 'pandas', 'netCDF4', 'xesmf', 'stitches']
+
+
+# Create the benchmark experiment directories and the copies of the test data
+def setup_workspace(variable):
+    """
+    Function for creating the benchmark experiments (regular and STITCHED) from test_run, pointing all
+    outputs and the copied simulation data at the benchmark workspace
+    """
+    # Only imported in the setup process, so the measuring process stays small. Peak memory is inherited
+    # by child processes, so anything imported here would show up in every stage's result.
+    import numpy as np
+    import pandas as pd
+
+    # Start from a clean workspace so every run does the same work
+    shutil.rmtree(WORKSPACE_PATH, ignore_errors=True)
+    os.makedirs(WORKSPACE_PATH)
+
+    # Copy simulation data, without tasrange/tasskew so that stage has to create them
+    sim_path = os.path.join(WORKSPACE_PATH, 'sim')
+    shutil.copytree(os.path.join(TEST_DATA_PATH, 'sim'), sim_path)
+    for file_path in glob.glob(os.path.join(sim_path, 'tasrange_*.nc')) + glob.glob(os.path.join(sim_path, 'tasskew_*.nc')):
+        os.remove(file_path)
+
+    # Regular experiment
+    write_benchmark_run(BENCHMARK_RUN, sim_path, stitched=False)
+
+    # STITCHED experiment, with stitched style files made by joining the historical and future data
+    stitched_path = os.path.join(WORKSPACE_PATH, 'stitched')
+    os.makedirs(stitched_path)
+    write_stitched_data(stitched_path, variable)
+    write_benchmark_run(BENCHMARK_STITCHED_RUN, stitched_path, stitched=True)
+
+
+# Write a benchmark experiment input directory
+def write_benchmark_run(run_name, sim_path, stitched):
+    """
+    Function for copying the test_run input files to a benchmark experiment, with updated paths
+    """
+    import numpy as np
+    import pandas as pd
+
+    run_path = os.path.join(INPUT_PATH, run_name)
+    shutil.rmtree(run_path, ignore_errors=True)
+    shutil.copytree(os.path.join(INPUT_PATH, SOURCE_RUN), run_path)
+
+    # Point input and output locations at the workspace
+    run_manager_df = pd.read_csv(os.path.join(run_path, 'run_manager.csv'))
+    run_manager_df.loc[0, 'ESM_Input_Location'] = sim_path
+    run_manager_df.loc[0, 'Output_Location'] = os.path.join(WORKSPACE_PATH, 'output', run_name)
+    run_manager_df.loc[0, 'stitched'] = stitched
+    if stitched:
+        run_manager_df['Ensemble'] = np.nan
+    run_manager_df.to_csv(os.path.join(run_path, 'run_manager.csv'), index=False)
+
+    # Keep dask temporary files in the workspace as well
+    dask_params = pd.read_csv(os.path.join(run_path, 'dask_parameters.csv'))
+    dask_params.loc[0, 'dask_temp_directory'] = os.path.join(WORKSPACE_PATH, 'dask')
+    dask_params.to_csv(os.path.join(run_path, 'dask_parameters.csv'), index=False)
+
+
+# Make STITCHED style data from the test data
+def write_stitched_data(stitched_path, variable):
+    """
+    Function for writing stitched_<ESM>_<variable>_<scenario>.nc files from the historical and future test data
+    """
+    import xarray as xr
+
+    for file_variable in sorted(set([variable, 'tas', 'tasmin', 'tasmax'])):
+        file_paths = sorted(glob.glob(os.path.join(TEST_DATA_PATH, 'sim', f'{file_variable}_day_model-name_*_ensemble-name_*.nc')))
+        with xr.open_mfdataset(file_paths) as sim_data:
+            sim_data.to_netcdf(os.path.join(stitched_path, f'stitched_model-name_{file_variable}_scenario-name.nc'))
+
+
+# Find the row of an explicit list to run
+def get_task_id(run_name, variable):
+    """
+    Function for finding the task id of the first task in a run's explicit list using the given variable
+    """
+    with open(os.path.join(INTERMEDIATE_PATH, run_name, 'run_manager_explicit_list.csv')) as explicit_list:
+        for task_id, row in enumerate(csv.DictReader(explicit_list)):
+            if row['Variable'] == variable:
+                return task_id
+
+    raise ValueError(f'No {variable} task in {run_name}')
+
+
+# Commands that run each stage
+def get_stage_command(stage, variable):
+    """
+    Function for getting the command line that runs a stage in its own process
+    """
+    if stage == 'planner':
+        return [sys.executable, os.path.join(CODE_PATH, 'job-script-generation.py'), BENCHMARK_RUN]
+    if stage == 'create_tasrange_tasskew':
+        return [sys.executable, os.path.join(CODE_PATH, 'create_tasrange_tasskew.py'), BENCHMARK_RUN]
+    if stage == 'basd_downloaded':
+        return [sys.executable, os.path.join(CODE_PATH, 'main.py'), str(get_task_id(BENCHMARK_RUN, variable)), BENCHMARK_RUN]
+    if stage == 'basd_stitches':
+        return [sys.executable, os.path.join(CODE_PATH, 'main.py'), str(get_task_id(BENCHMARK_STITCHED_RUN, variable)), BENCHMARK_STITCHED_RUN]
+
+    # Stages that call a single function are run through this script
+    return [sys.executable, os.path.join(CODE_PATH, 'benchmark.py'), '--run-stage', stage, '--variable', variable]
+
+
+# Time a command and get its peak memory
+def measure_command(command, log_file):
+    """
+    Function for running a command, returning the wall time in seconds and the peak resident memory in MB of
+    the largest process it ran (including worker processes it waited on)
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    peak_rss_mb = rusage.ru_maxrss / 1024 if sys.platform != 'darwin' else rusage.ru_maxrss / 1024**2
+
+    return wall_seconds, peak_rss_mb, process.returncode
+
+
+# Stage bodies for stages that aren't already a script ======================================================
+
+def run_load_sd_data(variable):
+    """
+    Loads the downscaling inputs, using the future simulation test file in place of bias adjusted output
+    """
+    import pandas as pd
+    import utils
+
+    run_object = pd.Series({'Variable': variable, 'application_period': '2065-2100', 'target_period': '1979-2014'})
+    sim_application_file = os.path.basename(glob.glob(os.path.join(TEST_DATA_PATH, 'sim', f'{variable}_day_model-name_scenario-name_ensemble-name_*.nc'))[0])
+    obs_reference_data, sim_application_data = utils.load_sd_data(
+        run_object, os.path.join(TEST_DATA_PATH, 'obs', variable), 50,
+        os.path.join(TEST_DATA_PATH, 'sim'), sim_application_file
+    )
+    obs_reference_data.load()
+    sim_application_data.load()
+
+
+def run_create_derived_outputs(variable):
+    """
+    Creates tasmin and tasmax together from copies of the tas, tasrange and tasskew future simulation test files
+    """
+    import create_tasmin_tasmax
+    import utils
+
+    # Copy inputs into their own directory, since outputs are written next to them
+    full_out_path = os.path.join(WORKSPACE_PATH, 'create_derived_outputs')
+    shutil.rmtree(full_out_path, ignore_errors=True)
+    os.makedirs(full_out_path)
+    input_files = {}
+    for file_variable in ['tas', 'tasrange', 'tasskew']:
+        file_path = glob.glob(os.path.join(TEST_DATA_PATH, 'sim', f'{file_variable}_day_model-name_scenario-name_ensemble-name_*.nc'))[0]
+        shutil.copy(file_path, full_out_path)
+        input_files[file_variable] = os.path.join(full_out_path, os.path.basename(file_path))
+
+    encoding, reset_chunk_sizes = utils.get_encoding(os.path.join(INPUT_PATH, BENCHMARK_RUN))
+    _, global_monthly_attributes, global_daily_attributes = utils.get_attributes('tas', os.path.join(INPUT_PATH, BENCHMARK_RUN))
+    targets = [(os.path.join(full_out_path, f'{x}_benchmark.nc'), x, 'daily', input_files) for x in ['tasmin', 'tasmax']]
+
+    create_tasmin_tasmax.create_outputs(
+        targets, {'tasmin': encoding, 'tasmax': encoding}, reset_chunk_sizes,
+        {x: create_tasmin_tasmax.get_variable_attributes(x, os.path.join(INPUT_PATH, BENCHMARK_RUN)) for x in ['tasmin', 'tasmax']},
+        {'daily': global_daily_attributes, 'monthly': global_monthly_attributes},
+        {x: create_tasmin_tasmax.get_variable_bounds(x, os.path.join(INPUT_PATH, BENCHMARK_RUN)) for x in ['tasmin', 'tasmax']}
+    )
+
+
+def run_interp(variable, n_loops=50):
+    """
+    Interpolates every trajectory in the STITCHES example experiment to annual values
+    """
+    import generate_stitched_data
+    import numpy as np
+    import pandas as pd
+
+    trajectories_data = pd.read_csv(os.path.join(INPUT_PATH, 'MRI-stitches-experiment', 'trajectories.csv'))
+    for _ in range(n_loops):
+        for scenario in trajectories_data.columns[1:]:
+            time_series_df = trajectories_data[['year', scenario]].dropna()
+            years = np.array(time_series_df.iloc[:,0].values).astype(int)
+            generate_stitched_data.interp(years, np.array(time_series_df.iloc[:,1].values))
+
+
+STAGE_FUNCTIONS = {
+    'load_sd_data': run_load_sd_data,
+    'create_derived_outputs': run_create_derived_outputs,
+    'interp': run_interp
+}
+
+
+# History ===================================================================================================
+
+def get_versions():
+    """
+    Function for getting the installed versions of the tracked packages
+    """
+    versions = {'python': platform.python_version()}
+    for package in TRACKED_PACKAGES:
+        try:
+            versions[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            versions[package] = None
+
+    return versions
+
+
+def get_git_commit():
+    """
+    Function for getting the current commit of this repo, if available
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_history(history_file):
+    """
+    Function for reading all previous benchmark records
+    """
+    if not os.path.isfile(history_file):
+        return []
+    with open(history_file) as history:
+        return [json.loads(line) for line in history if line.strip()]
+
+
+def compare_to_history(record, history, n_previous, tolerance):
+    """
+    Function for comparing a new record to the median of the last n successful records of the same stage
+    on the same host. Returns the relative change in wall time and peak memory, or None if there's no history.
+    """
+    previous = [x for x in history if (x['stage'] == record['stage']) and (x['host'] == record['host']) and x['success']][-n_previous:]
+    if (len(previous) == 0) or (not record['success']):
+        return None
+
+    wall_change = record['wall_seconds'] / statistics.median([x['wall_seconds'] for x in previous]) - 1
+    memory_change = record['peak_rss_mb'] / statistics.median([x['peak_rss_mb'] for x in previous]) - 1
+
+    return {'wall_change': wall_change, 'memory_change': memory_change,
+            'regression': bool((wall_change > tolerance) or (memory_change > tolerance))}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Time and memory profile each pipeline stage on the bundled test data.')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='stages to run (default: all)')
+    parser.add_argument('--variable', type=str, default='tas', help='variable used by the single variable stages')
+    parser.add_argument('--repeat', type=int, default=1, help='number of times to run each stage, the fastest is kept')
+    parser.add_argument('--history', type=str, default=HISTORY_FILE, help='history file to append results to')
+    parser.add_argument('--n-previous', type=int, default=5, help='number of previous results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown or memory increase flagged as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with an error when a regression is found')
+    parser.add_argument('--run-stage', type=str, choices=list(STAGE_FUNCTIONS.keys()), help=argparse.SUPPRESS)
+    parser.add_argument('--setup', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Set up experiments and data (run in its own process by the parent benchmark process)
+    if args.setup:
+        setup_workspace(args.variable)
+        sys.exit(0)
+
+    # Run a single stage body in this process (used by the parent benchmark process)
+    if args.run_stage is not None:
+        STAGE_FUNCTIONS[args.run_stage](args.variable)
+        sys.exit(0)
+
+    # Set up experiments and data
+    print('Setting up benchmark workspace', flush=True)
+    subprocess.run([sys.executable, os.path.join(CODE_PATH, 'benchmark.py'), '--setup', '--variable', args.variable], check=True)
+
+    # The drivers need explicit lists for both experiments
+    stages = [stage for stage in STAGES if stage in args.stages]
+    if ('basd_downloaded' in stages) or ('create_tasrange_tasskew' in stages):
+        subprocess.run(get_stage_command('planner', args.variable), check=True, stdout=subprocess.DEVNULL)
+    if 'basd_stitches' in stages:
+        subprocess.run([sys.executable, os.path.join(CODE_PATH, 'job-script-generation.py'), BENCHMARK_STITCHED_RUN],
+                       check=True, stdout=subprocess.DEVNULL)
+
+    # Run and measure each stage
+    history = read_history(args.history)
+    versions = get_versions()
+    git_commit = get_git_commit()
+    timestamp = datetime.datetime.now().isoformat(timespec='seconds')
+    found_regression = False
+    os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+
+    print(f'{"stage":<25}{"wall (s)":>10}{"peak RSS (MB)":>15}  vs history', flush=True)
+    for stage in stages:
+        log_path = os.path.join(WORKSPACE_PATH, f'{stage}.log')
+        wall_times, peak_memory, success = [], [], True
+        with open(log_path, 'w') as log_file:
+            for _ in range(args.repeat):
+                wall_seconds, peak_rss_mb, returncode = measure_command(get_stage_command(stage, args.variable), log_file)
+                wall_times.append(wall_seconds)
+                peak_memory.append(peak_rss_mb)
+                success = success and (returncode == 0)
+
+        record = {
+            'timestamp': timestamp, 'stage': stage, 'variable': args.variable, 'success': success,
+            'wall_seconds': min(wall_times), 'peak_rss_mb': max(peak_memory), 'repeat': args.repeat,
+            'host': socket.gethostname(), 'git_commit': git_commit, 'versions': versions
+        }
+        comparison = compare_to_history(record, history, args.n_previous, args.tolerance)
+
+        # Write record to history
+        with open(args.history, 'a') as history_file:
+            history_file.write(json.dumps(record) + '\n')
+
+        # Report
+        if not success:
+            summary = f'FAILED, see {log_path}'
+        elif comparison is None:
+            summary = 'no history'
+        else:
+            summary = f'{comparison["wall_change"]:+.0%} time, {comparison["memory_change"]:+.0%} mem'
+            if comparison['regression']:
+                summary = f'REGRESSION {summary}'
+                found_regression = True
+        print(f'{stage:<25}{record["wall_seconds"]:>10.2f}{record["peak_rss_mb"]:>15.1f}  {summary}', flush=True)
+
+    if args.fail_on_regression and found_regression:
+        sys.exit(1)
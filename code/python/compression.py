@@ -0,0 +1,174 @@
+"""
+Compression codecs for the output NetCDF files. encoding.csv picks a codec with its optional compression column:
+zlib (the default), zstd, bzip2, szip, blosc_lz4 (or another blosc compressor), none, or auto. Codecs other than zlib
+use the HDF5 filter plugins of netCDF4, and programs reading the output need the same plugins. With auto, a short
+trial writes a sample of each variable's data with every available codec, and picks the fastest whose files are no
+more than SIZE_TOLERANCE times larger than the smallest. The choice is saved in
+intermediate/<run_name>/codec_choices/<variable>.csv, so the trial is only run once per variable.
+"""
+
+# Import Libraries
+import glob
+import os
+import tempfile
+import time
+
+import netCDF4
+import pandas as pd
+
+# Paths
+INTERMEDIATE_PATH = 'intermediate'
+
+# Encoding of each codec, passed to xarray.to_netcdf() with the other settings in encoding.csv
+CODECS = {
+    'zlib': {'zlib': True},
+    'zstd': {'compression': 'zstd'},
+    'bzip2': {'compression': 'bzip2'},
+    'szip': {'compression': 'szip', 'szip_coding': 'nn', 'szip_pixels_per_block': 8},
+    'blosc_lz': {'compression': 'blosc_lz', 'blosc_shuffle': 1},
+    'blosc_lz4': {'compression': 'blosc_lz4', 'blosc_shuffle': 1},
+    'blosc_lz4hc': {'compression': 'blosc_lz4hc', 'blosc_shuffle': 1},
+    'blosc_zlib': {'compression': 'blosc_zlib', 'blosc_shuffle': 1},
+    'blosc_zstd': {'compression': 'blosc_zstd', 'blosc_shuffle': 1},
+    'none': {'zlib': False}
+}
+# Settings of encoding.csv only used by some codecs
+CODEC_SETTINGS = ['zlib', 'compression', 'shuffle', 'complevel', 'szip_coding', 'szip_pixels_per_block',
+                  'blosc_shuffle']
+
+# netCDF4 flags saying if the filter for a codec is available
+CODEC_SUPPORT = {'zstd': '__has_zstandard_support__', 'bzip2': '__has_bzip2_support__',
+                 'szip': '__has_szip_support__', 'blosc': '__has_blosc_support__'}
+
+# Codecs and compression levels tried with auto
+AUTO_CANDIDATES = [('zlib', 1), ('zlib', 5), ('zstd', 1), ('zstd', 5), ('blosc_lz4', 5), ('blosc_zstd', 3),
+                   ('szip', None)]
+# Number of days of data written for each codec in the trial
+SAMPLE_DAYS = 365
+# Largest size relative to the smallest file in the trial that auto will accept for faster writes
+SIZE_TOLERANCE = 1.1
+
+
+# Encoding with a codec
+def set_codec(encoding, codec, complevel=None):
+    """
+    Function for getting a copy of the encoding settings (dictionary) using the given codec, and compression level if
+    given. Codecs whose filter isn't available fall back to zlib.
+    """
+    if codec not in CODECS:
+        raise ValueError(f'Unknown compression codec {codec}, must be one of {", ".join(CODECS)} or auto')
+    if not is_supported(codec):
+        print(f'Warning: netCDF4 was built without {codec} support, using zlib', flush=True)
+        codec = 'zlib'
+
+    # Keep shuffle and compression level from encoding.csv, drop the settings of other codecs
+    codec_encoding = {key: value for key, value in encoding.items() if key not in CODEC_SETTINGS}
+    codec_encoding.update(CODECS[codec])
+    if codec in ['zlib', 'zstd', 'bzip2'] or codec.startswith('blosc'):
+        codec_encoding['complevel'] = int(encoding.get('complevel', 4) if complevel is None else complevel)
+    if codec in ['zlib', 'zstd', 'bzip2']:
+        codec_encoding['shuffle'] = encoding.get('shuffle', True)
+
+    return codec_encoding
+
+
+# Whether netCDF4 can write a codec
+def is_supported(codec):
+    """
+    Function for checking if the HDF5 filter needed for a codec is available
+    """
+    filter_name = 'blosc' if codec.startswith('blosc') else codec
+    if filter_name not in CODEC_SUPPORT:
+        return True
+
+    return bool(getattr(netCDF4, CODEC_SUPPORT[filter_name], False))
+
+
+# Encoding with the codec chosen for a variable
+def choose_codec(encoding, data, run_name, variable):
+    """
+    Function for getting the encoding settings with the codec chosen for a variable. Uses the choice saved by an
+    earlier task, or else runs the trial on a sample of data (Dataset) and saves the choice. With no data and no
+    saved choice, zlib is used.
+    """
+    choices_dir = os.path.join(INTERMEDIATE_PATH, run_name, 'codec_choices')
+    choices = read_choices(choices_dir)
+    if variable not in choices.index and data is None:
+        print(f'No codec chosen for {variable} yet, using zlib', flush=True)
+        return set_codec(encoding, 'zlib')
+    if variable not in choices.index:
+        trial = run_trial(encoding, data[variable].isel(time=slice(0, SAMPLE_DAYS)).load(), variable)
+        smallest = trial['size_mb'].min()
+        choice = trial[trial['size_mb'] <= SIZE_TOLERANCE * smallest].sort_values('write_seconds').iloc[0]
+        print(f'Codec trial for {variable}:\n{trial.to_string(index=False)}', flush=True)
+        save_choice(choices_dir, variable, choice)
+        choices = read_choices(choices_dir)
+
+    codec = choices.loc[variable, 'codec']
+    complevel = choices.loc[variable, 'complevel']
+    print(f'Compressing {variable} output with {codec}', flush=True)
+
+    return set_codec(encoding, codec, None if pd.isna(complevel) else int(complevel))
+
+
+# Time and size of writing a sample with each codec
+def run_trial(encoding, sample, variable):
+    """
+    Function for writing a sample (DataArray with time, lat and lon dimensions, already loaded) with each available
+    codec, returning the time taken and file size of each
+    """
+    import utils
+
+    # Chunk sizes for the sample
+    sample = sample.transpose('time', 'lat', 'lon')
+    sample_encoding = utils.get_output_encoding(encoding, True, sample.sizes)
+
+    results = []
+    with tempfile.TemporaryDirectory() as trial_dir:
+        for codec, complevel in AUTO_CANDIDATES:
+            if not is_supported(codec):
+                continue
+            file_path = os.path.join(trial_dir, f'{codec}_{complevel}.nc')
+            start_time = time.perf_counter()
+            try:
+                sample.to_dataset(name=variable).to_netcdf(
+                    file_path, encoding={variable: set_codec(sample_encoding, codec, complevel)}
+                )
+            except (RuntimeError, ValueError) as e:
+                # Some filters can't write some data (ex. blosc with very small chunks)
+                print(f'Skipping {codec} in codec trial: {e}', flush=True)
+                continue
+            results.append({'codec': codec, 'complevel': complevel,
+                            'write_seconds': round(time.perf_counter() - start_time, 3),
+                            'size_mb': round(os.path.getsize(file_path) / 1024 ** 2, 3)})
+
+    return pd.DataFrame(results)
+
+
+# Read the codecs chosen so far
+def read_choices(choices_dir):
+    """
+    Function for reading the codec chosen for each variable, indexed by variable
+    """
+    choices_files = sorted(glob.glob(os.path.join(choices_dir, '*.csv')))
+    if not choices_files:
+        return pd.DataFrame(columns=['variable', 'codec', 'complevel']).set_index('variable')
+
+    return pd.concat([pd.read_csv(x) for x in choices_files]).set_index('variable')
+
+
+# Save the codec chosen for a variable
+def save_choice(choices_dir, variable, choice):
+    """
+    Function for saving the codec chosen for a variable. Each variable has its own file, so tasks of other variables
+    finishing their trials at the same time don't overwrite each other's choices, and the file is written under a
+    temporary name and moved into place in one go.
+    """
+    os.makedirs(choices_dir, exist_ok=True)
+    choices = pd.DataFrame([{'variable': variable, 'codec': choice['codec'], 'complevel': choice['complevel'],
+                             'write_seconds': choice['write_seconds'], 'size_mb': choice['size_mb']}])
+
+    choices_file = os.path.join(choices_dir, f'{variable}.csv')
+    temp_file = f'{choices_file}.{os.getpid()}.tmp'
+    choices.to_csv(temp_file, index=False)
+    os.replace(temp_file, choices_file)
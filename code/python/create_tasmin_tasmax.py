@@ -1,455 +1,187 @@
 """
-Description: This script will look at the input run manager file to determine for what data the user wants
-             tasmin and tasmax output. It will then look for each of those run's respective tas, tasrange and tasskew
-             output, and create the files accordingly.
+Description: This script will look at the explicit list of tasks to determine for what data the user wants
+             derived output (see utils.DERIVED_OUTPUTS), ex. tasmin and tasmax. It will then look for each of
+             those run's respective input output (ex. tas, tasrange and tasskew), and create the files accordingly.
+             Every derived output of an ESM, scenario, ensemble member, reference dataset, region and application
+             period, bias adjusted and downscaled, daily and monthly, is created in one Dask graph, so each input
+             file is read once however many outputs use it.
 Author: Noah Prime
 Modified: August 7, 2023
 Input:
-    - input/<run manager>.csv - file that specifies all the runs requested
+    - intermediate/<run_name>/run_manager_explicit_list.csv - file that explicitly lists the tasks of the run
     - input/encoding.csv - settings for encoding output NetCDF
     - input/attributes.csv - attributes to save to NetCDF metadata
-    - tas, tasrange, and tasskew output files
+    - output files of the inputs of each derived output, ex. tas, tasrange, and tasskew
 Output:
-    - tasmin and tasmax output files
+    - derived output files, ex. tasmin and tasmax
 """
 
 # To calculate tasmin and tasmax:
 # tasmin = tas - tasskew * tasrange
 # tasmax = tasmin + tasrange
+# And prsn:
+# prsn = pr * prsnratio
 
 # Packages =============================================================================================
+import itertools
 import os                                   # For navigating os
-import glob
 import sys
+from types import SimpleNamespace
 
-import numpy as np
+import dask
 import pandas as pd
 import xarray as xr
 
+import compression
+import qa
 import utils
 
-
-def create_general_CMIP(
-                        tas_file_name, tasrange_file_name, tasskew_file_name, tasmin_file_name, tasmax_file_name,
-                        full_out_path, encoding, reset_chunk_sizes, 
-                        tasmin_attributes, tasmax_attributes, global_attributes
-                    ):
-    # Print current creation step
-    print(f'Creating:\n\t- {tasmin_file_name}\n\t- {tasmax_file_name}\n\t- at {full_out_path}')
-
-    # Open data
-    tas_data = xr.open_mfdataset(os.path.join(full_out_path, tas_file_name))
-    tasrange_data = xr.open_mfdataset(os.path.join(full_out_path, tasrange_file_name))
-    tasskew_data = xr.open_mfdataset(os.path.join(full_out_path, tasskew_file_name))
-
-    # Create tasmin
-    tasmin_array = tas_data['tas'] - (tasskew_data['tasskew'] * tasrange_data['tasrange'])
-
-    # Create tasmax
-    tasmax_array = tasmin_array + tasrange_data['tasrange']
-
-    # Convert to xarray DataSet from DataArray
-    tasmin_data = tasmin_array.to_dataset(name='tasmin')
-    tasmax_data = tasmax_array.to_dataset(name='tasmax')
-
-    # Set global attributes
-    tasmin_data.attrs = global_attributes
-    tasmax_data.attrs = global_attributes
-
-    # Set variable attributes
-    tasmin_data['tasmin'].attrs = tasmin_attributes
-    tasmax_data['tasmax'].attrs = tasmax_attributes
-
-    # Reset Chunk sizes
-    if reset_chunk_sizes:
-        encoding['chunksizes'] = utils.reset_chunk_sizes(encoding['chunksizes'], tas_data.dims)
-
-    # Save data
-    tasmin_data.to_netcdf(os.path.join(full_out_path, tasmin_file_name), encoding={'tasmin': encoding}, compute=True)
-    tasmax_data.to_netcdf(os.path.join(full_out_path, tasmax_file_name), encoding={'tasmax': encoding}, compute=True)
-
-    ...
-
-
-def create_tasmin_tasmax_stitched(
-                                    run_details, encoding, reset_chunk_sizes, 
-                                    tasmin_attributes, tasmax_attributes,
-                                    global_monthly_attributes, global_daily_attributes
-                                ):
-    # List of all models and scenarios being used
-    scenarios = np.unique(run_details.Scenario.values)
-    esms = np.unique(run_details.ESM.values)
-    ref_datasets = np.unique(run_details.Reference_Dataset.values)
-    application_periods = np.unique(run_details.application_period.values)
-
-    for esm in esms:
-        for scenario in scenarios:
-            for ref_name in ref_datasets:
-                for application_period in application_periods:
-                    
-                    print(f'Creating tasrange and tasskew for {esm}, {scenario}, {ref_name}, {application_period}')
-                    # Get input/output location
-                    current_task = run_details[
-                        (run_details['ESM'] == esm) &
-                        (run_details['Scenario'] == scenario) &
-                        (run_details['Reference_Dataset'] == ref_name) &
-                        (run_details['application_period'] == application_period) 
-                    ]
-                    output_location = current_task['Output_Location'].values[0]
-                    using_pangeo = pd.isna(output_location)
-
-                    # Start and End years
-                    start, end = str.split(application_period, '-')
-
-                    # Try to create daily bias adjusted tasmin and tasmax
-                    try:
-                        create_daily_ba_STITCHES(
-                            esm, scenario, start, end, ref_name, 
-                            output_location, encoding, reset_chunk_sizes,
-                            tasmin_attributes, tasmax_attributes,
-                            global_daily_attributes
-                        )
-                    except:
-                        print(f'Waringing, could not create daily bias adjusted tasmin and tasmax')
-                        pass
-
-                    # Try to create monthly bias adjusted tasmin and tasmax
-                    try:
-                        create_monthly_ba_STITCHES(
-                            esm, scenario, start, end, ref_name, 
-                            output_location, encoding, reset_chunk_sizes,
-                            tasmin_attributes, tasmax_attributes,
-                            global_monthly_attributes
-                        )
-                    except:
-                        print(f'Waringing, could not create monthly bias adjusted tasmin and tasmax')
-                        pass
-
-                    # Try to create daily bias adjusted and downscaled tasmin and tasmax
-                    try:
-                        create_daily_basd_STITCHES(
-                            esm, scenario, start, end, ref_name, 
-                            output_location, encoding, reset_chunk_sizes,
-                            tasmin_attributes, tasmax_attributes,
-                            global_daily_attributes
-                        )
-                    except:
-                        print(f'Waringing, could not create daily bias adjusted and downscaled tasmin and tasmax')
-                        pass
-
-                    # Try to create monthly bias adjusted tasmin and tasmax
-                    try:
-                        create_monthly_basd_STITCHES(
-                            esm, scenario, start, end, ref_name, 
-                            output_location, encoding, reset_chunk_sizes,
-                            tasmin_attributes, tasmax_attributes,
-                            global_monthly_attributes
-                        )
-                    except:
-                        print(f'Waringing, could not create monthly bias adjusted and downscaled tasmin and tasmax')
-                        pass
-
-                    ...
-                ...
-            ...
-        ...
-
-
-def create_monthly_ba_STITCHES(
-                            esm, scenario, start, end, ref_name, 
-                            output_location, encoding, reset_chunk_sizes,
-                            tasmin_attributes, tasmax_attributes,
-                            global_monthly_attributes
-                        ):
-    # File names
-    tas_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tas_global_monthly_{start}_{end}.nc'
-    tasrange_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tasrange_global_monthly_{start}_{end}.nc'
-    tasskew_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tasskew_global_monthly_{start}_{end}.nc'
-    tasmin_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tasmin_global_monthly_{start}_{end}.nc'
-    tasmax_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tasmax_global_monthly_{start}_{end}.nc'
-
-    # Full output_location
-    full_out_path = os.path.join(output_location, ref_name, esm, scenario, 'ba')
-
-    # Save data using generic saver function
-    create_general_CMIP(
-        tas_file_name, tasrange_file_name, tasskew_file_name, tasmin_file_name, tasmax_file_name,
-        full_out_path, encoding, reset_chunk_sizes, 
-        tasmin_attributes, tasmax_attributes, global_monthly_attributes
-    )
-
-    ...
-
-
-def create_daily_ba_STITCHES(
-                            esm, scenario, start, end, ref_name, 
-                            output_location, encoding, reset_chunk_sizes,
-                            tasmin_attributes, tasmax_attributes,
-                            global_daily_attributes
-                        ):
-    # File names
-    tas_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tas_global_daily_{start}_{end}.nc'
-    tasrange_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tasrange_global_daily_{start}_{end}.nc'
-    tasskew_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tasskew_global_daily_{start}_{end}.nc'
-    tasmin_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tasmin_global_daily_{start}_{end}.nc'
-    tasmax_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tasmax_global_daily_{start}_{end}.nc'
-
-    # Full output_location
-    full_out_path = os.path.join(output_location, ref_name, esm, scenario, 'ba')
-
-    # Save data using generic saver function
-    create_general_CMIP(
-        tas_file_name, tasrange_file_name, tasskew_file_name, tasmin_file_name, tasmax_file_name,
-        full_out_path, encoding, reset_chunk_sizes, 
-        tasmin_attributes, tasmax_attributes, global_daily_attributes
-    )
-
-    ...
-
-
-def create_monthly_basd_STITCHES(
-                            esm, scenario, start, end, ref_name, 
-                            output_location, encoding, reset_chunk_sizes,
-                            tasmin_attributes, tasmax_attributes,
-                            global_monthly_attributes
-                        ):
-    # File names
-    tas_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tas_global_monthly_{start}_{end}.nc'
-    tasrange_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tasrange_global_monthly_{start}_{end}.nc'
-    tasskew_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tasskew_global_monthly_{start}_{end}.nc'
-    tasmin_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tasmin_global_monthly_{start}_{end}.nc'
-    tasmax_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tasmax_global_monthly_{start}_{end}.nc'
-
-    # Full output_location
-    full_out_path = os.path.join(output_location, ref_name, esm, scenario, 'basd')
-
-    # Save data using generic saver function
-    create_general_CMIP(
-        tas_file_name, tasrange_file_name, tasskew_file_name, tasmin_file_name, tasmax_file_name,
-        full_out_path, encoding, reset_chunk_sizes, 
-        tasmin_attributes, tasmax_attributes, global_monthly_attributes
-    )
-
-    ...
-
-
-def create_daily_basd_STITCHES(
-                            esm, scenario, start, end, ref_name, 
-                            output_location, encoding, reset_chunk_sizes,
-                            tasmin_attributes, tasmax_attributes,
-                            global_daily_attributes
-                        ):
-    # File names
-    tas_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tas_global_daily_{start}_{end}.nc'
-    tasrange_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tasrange_global_daily_{start}_{end}.nc'
-    tasskew_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tasskew_global_daily_{start}_{end}.nc'
-    tasmin_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tasmin_global_daily_{start}_{end}.nc'
-    tasmax_file_name = f'{esm}_STITCHES_{ref_name}_{scenario}_tasmax_global_daily_{start}_{end}.nc'
-
-    # Full output_location
-    full_out_path = os.path.join(output_location, ref_name, esm, scenario, 'basd')
-
-    # Save data using generic saver function
-    create_general_CMIP(
-        tas_file_name, tasrange_file_name, tasskew_file_name, tasmin_file_name, tasmax_file_name,
-        full_out_path, encoding, reset_chunk_sizes, 
-        tasmin_attributes, tasmax_attributes, global_daily_attributes
-    )
-
-    ...
-
-
-def create_monthly_ba_CMIP(
-                            esm, scenario, ensemble, start, end, ref_name, 
-                            output_location, encoding, reset_chunk_sizes,
-                            tasmin_attributes, tasmax_attributes,
-                            global_monthly_attributes
-                        ):
-    # File names
-    tas_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tas_global_monthly_{start}_{end}.nc'
-    tasrange_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tasrange_global_monthly_{start}_{end}.nc'
-    tasskew_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tasskew_global_monthly_{start}_{end}.nc'
-    tasmin_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tasmin_global_monthly_{start}_{end}.nc'
-    tasmax_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tasmax_global_monthly_{start}_{end}.nc'
-
-    # Full output_location
-    full_out_path = os.path.join(output_location, ref_name, esm, scenario, 'ba')
-
-    # Save data using generic saver function
-    create_general_CMIP(
-        tas_file_name, tasrange_file_name, tasskew_file_name, tasmin_file_name, tasmax_file_name,
-        full_out_path, encoding, reset_chunk_sizes, 
-        tasmin_attributes, tasmax_attributes, global_monthly_attributes
-    )
-
-    ...
-
-
-def create_daily_ba_CMIP(
-                            esm, scenario, ensemble, start, end, ref_name, 
-                            output_location, encoding, reset_chunk_sizes,
-                            tasmin_attributes, tasmax_attributes,
-                            global_daily_attributes
-                        ):
-    # File names
-    tas_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tas_global_daily_{start}_{end}.nc'
-    tasrange_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tasrange_global_daily_{start}_{end}.nc'
-    tasskew_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tasskew_global_daily_{start}_{end}.nc'
-    tasmin_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tasmin_global_daily_{start}_{end}.nc'
-    tasmax_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tasmax_global_daily_{start}_{end}.nc'
-
-    # Full output_location
-    full_out_path = os.path.join(output_location, ref_name, esm, scenario, 'ba')
-
-    # Save data using generic saver function
-    create_general_CMIP(
-        tas_file_name, tasrange_file_name, tasskew_file_name, tasmin_file_name, tasmax_file_name,
-        full_out_path, encoding, reset_chunk_sizes, 
-        tasmin_attributes, tasmax_attributes, global_daily_attributes
-    )
-
-    ...
-
-
-def create_monthly_basd_CMIP(
-                            esm, scenario, ensemble, start, end, ref_name, 
-                            output_location, encoding, reset_chunk_sizes,
-                            tasmin_attributes, tasmax_attributes,
-                            global_monthly_attributes
-                        ):
-    # File names
-    tas_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tas_global_monthly_{start}_{end}.nc'
-    tasrange_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tasrange_global_monthly_{start}_{end}.nc'
-    tasskew_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tasskew_global_monthly_{start}_{end}.nc'
-    tasmin_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tasmin_global_monthly_{start}_{end}.nc'
-    tasmax_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tasmax_global_monthly_{start}_{end}.nc'
-
-    # Full output_location
-    full_out_path = os.path.join(output_location, ref_name, esm, scenario, 'basd')
-
-    # Save data using generic saver function
-    create_general_CMIP(
-        tas_file_name, tasrange_file_name, tasskew_file_name, tasmin_file_name, tasmax_file_name,
-        full_out_path, encoding, reset_chunk_sizes, 
-        tasmin_attributes, tasmax_attributes, global_monthly_attributes
-    )
-
-    ...
-
-
-def create_daily_basd_CMIP(
-                            esm, scenario, ensemble, start, end, ref_name, 
-                            output_location, encoding, reset_chunk_sizes,
-                            tasmin_attributes, tasmax_attributes,
-                            global_daily_attributes
-                        ):
-    # File names
-    tas_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tas_global_daily_{start}_{end}.nc'
-    tasrange_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tasrange_global_daily_{start}_{end}.nc'
-    tasskew_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tasskew_global_daily_{start}_{end}.nc'
-    tasmin_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tasmin_global_daily_{start}_{end}.nc'
-    tasmax_file_name = f'{esm}_{ensemble}_{ref_name}_{scenario}_tasmax_global_daily_{start}_{end}.nc'
-
-    # Full output_location
-    full_out_path = os.path.join(output_location, ref_name, esm, scenario, 'basd')
-
-    # Save data using generic saver function
-    create_general_CMIP(
-        tas_file_name, tasrange_file_name, tasskew_file_name, tasmin_file_name, tasmax_file_name,
-        full_out_path, encoding, reset_chunk_sizes, 
-        tasmin_attributes, tasmax_attributes, global_daily_attributes
-    )
-
-    ...
-
-
-def create_tasmin_tasmax_CMIP(
-                                run_details, encoding, reset_chunk_sizes, 
-                                tasmin_attributes, tasmax_attributes,
-                                global_monthly_attributes, global_daily_attributes
-                            ):
-    # List of all models, scenarios and ensemble members being used
-    scenarios = np.unique(run_details.Scenario.values)
-    esms = np.unique(run_details.ESM.values)
-    ensembles = np.unique(run_details.Ensemble.values)
-    ref_datasets = np.unique(run_details.Reference_Dataset.values)
-    application_periods = np.unique(run_details.application_period.values)
-
-    for esm in esms:
-        for scenario in scenarios:
-            for ensemble in ensembles:
-                for ref_name in ref_datasets:
-                    for application_period in application_periods:
-                        
-                        print(f'Creating tasrange and tasskew for {esm}, {scenario}, {ensemble}, {ref_name}, {application_period}')
-                        # Get input/output location
-                        current_task = run_details[
-                            (run_details['ESM'] == esm) &
-                            (run_details['Scenario'] == scenario) &
-                            (run_details['Ensemble'] == ensemble) &
-                            (run_details['Reference_Dataset'] == ref_name) &
-                            (run_details['application_period'] == application_period) 
-                        ]
-                        output_location = current_task['Output_Location'].values[0]
-                        using_pangeo = pd.isna(output_location)
-
-                        # Start and End years
-                        start, end = str.split(application_period, '-')
-
-                        # Try to create daily bias adjusted tasmin and tasmax
-                        try:
-                            create_daily_ba_CMIP(
-                                esm, scenario, ensemble, start, end, ref_name, 
-                                output_location, encoding, reset_chunk_sizes,
-                                tasmin_attributes, tasmax_attributes,
-                                global_daily_attributes
-                            )
-                        except:
-                            print(f'Waringing, could not create daily bias adjusted tasmin and tasmax')
-                            pass
-
-                        # Try to create monthly bias adjusted tasmin and tasmax
-                        try:
-                            create_monthly_ba_CMIP(
-                                esm, scenario, ensemble, start, end, ref_name, 
-                                output_location, encoding, reset_chunk_sizes,
-                                tasmin_attributes, tasmax_attributes,
-                                global_monthly_attributes
-                            )
-                        except:
-                            print(f'Waringing, could not create monthly bias adjusted tasmin and tasmax')
-                            pass
-
-                        # Try to create daily bias adjusted and downscaled tasmin and tasmax
-                        try:
-                            create_daily_basd_CMIP(
-                                esm, scenario, ensemble, start, end, ref_name, 
-                                output_location, encoding, reset_chunk_sizes,
-                                tasmin_attributes, tasmax_attributes,
-                                global_daily_attributes
-                            )
-                        except:
-                            print(f'Waringing, could not create daily bias adjusted and downscaled tasmin and tasmax')
-                            pass
-
-                        # Try to create monthly bias adjusted tasmin and tasmax
-                        try:
-                            create_monthly_basd_CMIP(
-                                esm, scenario, ensemble, start, end, ref_name, 
-                                output_location, encoding, reset_chunk_sizes,
-                                tasmin_attributes, tasmax_attributes,
-                                global_monthly_attributes
-                            )
-                        except:
-                            print(f'Waringing, could not create monthly bias adjusted and downscaled tasmin and tasmax')
-                            pass
-
-                        ...
-                    ...
-                ...
-            ...
-        ...
-    ...
+# Stages and frequencies of the output
+STAGES = ['ba', 'basd']
+FREQUENCIES = ['daily', 'monthly']
+
+
+# Output file name of a combination
+def get_file_name(esm, member, ref_name, scenario, variable, region, frequency, start, end):
+    """
+    Function for getting the name of an output file, as written by the BASD tasks. member is the ensemble member, or
+    STITCHES for STITCHED data.
+    """
+    return f'{esm}_{member}_{ref_name}_{scenario}_{variable}_{region}_{frequency}_{start}_{end}.nc'
+
+
+# Derived outputs of a combination
+def get_targets(combination, variables, input_path):
+    """
+    Function for listing the derived outputs that can be created for one combination (row of ESM, Scenario,
+    Ensemble, Reference_Dataset, Region, application_period and Output_Location) whose tasks ran for variables, as
+    (output file, derived variable, frequency, {input variable: input file}), for each stage and frequency. With a
+    parameter sweep (see variable_parameters.csv), there is one for each configuration of the inputs, from the files
+    of that configuration (or the only files of inputs with one configuration).
+    """
+    member = combination.get('Ensemble', 'STITCHES')
+    start, end = str.split(combination['application_period'], '-')
+
+    targets = []
+    for variable, derived_output in utils.DERIVED_OUTPUTS.items():
+        if not all(x in variables for x in derived_output['inputs']):
+            continue
+        # Configurations of each input, and every configuration of any of them
+        input_configs = {x: utils.get_config_ids(SimpleNamespace(Variable=x), input_path) for x in derived_output['inputs']}
+        config_ids = list(dict.fromkeys([y for x in input_configs.values() for y in x if y is not None])) or [None]
+        for config_id, stage, frequency in itertools.product(config_ids, STAGES, FREQUENCIES):
+            full_out_path = os.path.join(combination['Output_Location'], combination['Reference_Dataset'],
+                                         combination['ESM'], combination['Scenario'], stage)
+            file_names = {x: get_file_name(combination['ESM'], member, combination['Reference_Dataset'],
+                                           combination['Scenario'], x, combination['Region'], frequency, start, end)
+                          for x in derived_output['inputs'] + [variable]}
+            # Files of the configuration, as named by the BASD tasks
+            file_names = {x: y if input_configs.get(x) == [None] else
+                          utils.get_config_file_name(y, SimpleNamespace(config_id=config_id))
+                          for x, y in file_names.items()}
+            input_files = {x: os.path.join(full_out_path, file_names[x]) for x in derived_output['inputs']}
+
+            # Not every stage and frequency is written, ex. daily output when only monthly output is wanted
+            missing_files = [x for x in input_files.values() if not os.path.exists(x)]
+            if missing_files:
+                print(f'Warning, could not create {frequency} {stage} {variable}, missing '
+                      f'{", ".join([os.path.basename(x) for x in missing_files])}', flush=True)
+                continue
+            targets.append((os.path.join(full_out_path, file_names[variable]), variable, frequency, input_files))
+
+    return targets
+
+
+# Create derived outputs
+def create_outputs(targets, encodings, reset_chunk_sizes, variable_attributes, global_attributes, variable_bounds):
+    """
+    Function for creating every target (see get_targets) in one Dask graph. Each input file is opened once, and all
+    of the outputs are computed from the same chunks of it and written together, along with their quality statistics
+    (see qa.py) within variable_bounds, {variable: (lower bound, upper bound)}. Each output is written next to its
+    output file and then moved into place, so a failed write doesn't leave a partial output file.
+    """
+    input_data = {}
+    writes = []
+    temp_files = []
+    stats = {}
+    # Outputs of each directory (stage), frequency and configuration, {output file with {variable} in place of the
+    # variable: {variable: (output file, data)}}, to compare tasmin with tasmax
+    outputs = {}
+    try:
+        for output_file, variable, frequency, input_files in targets:
+            print(f'Creating:\n\t- {os.path.basename(output_file)}\n\t- at {os.path.dirname(output_file)}', flush=True)
+
+            # Open data, once for all of the outputs using it
+            inputs = []
+            for input_variable, input_file in input_files.items():
+                if input_file not in input_data:
+                    input_data[input_file] = xr.open_dataset(input_file, chunks={})
+                inputs.append(utils.to_compute_dtype(input_data[input_file][input_variable], input_variable, 'read'))
+
+            # Create the variable, in the precision it's saved with
+            data = utils.compute_variable(utils.DERIVED_OUTPUTS[variable], inputs, variable).to_dataset(name=variable)
+
+            # Set global attributes
+            data.attrs = global_attributes[frequency]
+
+            # Chunk sizes for the grid of this data, and precision to save it with, if given in attributes.csv
+            output_encoding = utils.get_output_encoding(encodings[variable], reset_chunk_sizes, data.sizes)
+            output_encoding, attributes = utils.set_precision(output_encoding, variable_attributes[variable])
+
+            # Set variable attributes
+            data[variable].attrs = attributes
+
+            temp_file = f'{output_file}.{os.getpid()}.tmp'
+            temp_files.append((temp_file, output_file))
+            writes.append(data.to_netcdf(temp_file, encoding={variable: output_encoding}, compute=False))
+            stats[output_file] = qa.get_stats(data[variable], *variable_bounds[variable])
+            output_key = utils.swap_file_variable(output_file, variable, '{variable}')
+            outputs.setdefault(output_key, {})[variable] = (output_file, data[variable])
+
+        # tasmin should never be above tasmax
+        for variable_outputs in outputs.values():
+            if ('tasmin' in variable_outputs) and ('tasmax' in variable_outputs):
+                tasmin_above_tasmax = (variable_outputs['tasmin'][1] > variable_outputs['tasmax'][1]).sum()
+                for variable in ['tasmin', 'tasmax']:
+                    stats[variable_outputs[variable][0]]['tasmin_above_tasmax'] = tasmin_above_tasmax
+
+        # Save data
+        _, stats = dask.compute(writes, stats)
+        for temp_file, output_file in temp_files:
+            os.replace(temp_file, output_file)
+        for output_file, variable, _, _ in targets:
+            qa.save_stats(stats[output_file], output_file, variable, *variable_bounds[variable])
+    finally:
+        for data in input_data.values():
+            data.close()
+        for temp_file, _ in temp_files:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+
+# Bounds of a derived output
+def get_variable_bounds(variable, input_path):
+    """
+    Function for getting the lower and upper bounds of a derived output from variable_parameters.csv, for its quality
+    statistics, None if it has none
+    """
+    try:
+        params = SimpleNamespace(**utils.read_parameters(variable, input_path))
+    except IndexError:
+        params = None
+    return qa.get_bounds(variable, params)
+
+
+# Attributes of a derived output
+def get_variable_attributes(variable, input_path):
+    """
+    Function for getting the attributes of a derived output from attributes.csv, or from utils.DERIVED_OUTPUTS if
+    attributes.csv has none for it
+    """
+    try:
+        return utils.get_attributes(variable, input_path)[0]
+    except IndexError:
+        return dict(utils.DERIVED_OUTPUTS[variable]['attributes'])
 
 
 if __name__ == "__main__":
@@ -461,24 +193,35 @@ if __name__ == "__main__":
 
     # Read in .csv
     run_details = pd.read_csv(os.path.join(input_path, 'run_manager_explicit_list.csv'))
+    # Region of each task, used in the file names
+    run_details['Region'] = [utils.get_region_name(x) for x in run_details.itertuples()]
 
     # Read encoding settings
     encoding, reset_chunk_sizes = utils.get_encoding(os.path.join('input', run_directory))
+    # Read and compute data in the precision it's saved with
+    utils.use_compute_dtype(encoding)
+    # Compress each derived output with the codec chosen for its first input, if encoding.csv asks for auto
+    encodings = {}
+    for variable, derived_output in utils.DERIVED_OUTPUTS.items():
+        encodings[variable] = encoding
+        if encoding.get('compression') == 'auto':
+            encodings[variable] = compression.choose_codec(encoding, None, run_directory, derived_output['inputs'][0])
 
     # Get attributes
-    tasmin_attributes, global_monthly_attributes, global_daily_attributes = utils.get_attributes('tasmin', os.path.join('input', run_directory))
-    tasmax_attributes, _, _ = utils.get_attributes('tasmax', os.path.join('input', run_directory))
-
-    # Get the available models, scenarios, and ensembles (if available)
-    if run_details.iloc[0].stitched:
-        create_tasmin_tasmax_stitched(
-            run_details, encoding, reset_chunk_sizes, 
-            tasmin_attributes, tasmax_attributes,
-            global_monthly_attributes, global_daily_attributes
-        )
-    else:
-        create_tasmin_tasmax_CMIP(
-            run_details, encoding, reset_chunk_sizes, 
-            tasmin_attributes, tasmax_attributes,
-            global_monthly_attributes, global_daily_attributes
-        )
+    _, global_monthly_attributes, global_daily_attributes = utils.get_attributes('tas', os.path.join('input', run_directory))
+    global_attributes = {'daily': global_daily_attributes, 'monthly': global_monthly_attributes}
+    variable_attributes = {x: get_variable_attributes(x, os.path.join('input', run_directory)) for x in utils.DERIVED_OUTPUTS}
+    variable_bounds = {x: get_variable_bounds(x, os.path.join('input', run_directory)) for x in utils.DERIVED_OUTPUTS}
+
+    # Each ESM, scenario, ensemble member (if available), reference dataset, region and application period
+    combination_columns = [x for x in ['ESM', 'Scenario', 'Ensemble', 'Reference_Dataset', 'Region', 'application_period',
+                                       'Output_Location'] if x in run_details]
+    if run_details.iloc[0].stitched and ('Ensemble' in combination_columns):
+        combination_columns.remove('Ensemble')
+    for combination, combination_details in run_details.groupby(combination_columns, sort=False, dropna=False):
+        combination = dict(zip(combination_columns, combination))
+        print(f'Creating derived output for {", ".join([str(x) for x in combination.values()])}', flush=True)
+
+        targets = get_targets(combination, set(combination_details['Variable']), os.path.join('input', run_directory))
+        if targets:
+            create_outputs(targets, encodings, reset_chunk_sizes, variable_attributes, global_attributes, variable_bounds)
@@ -5,6 +5,9 @@
 #          Does so for both historic period, and the future period a given scenario.
 #          These are use for bias adjustment and statistical downscaling, and then converted
 #          back to tasmin, tasmax after that.
+#          Only needed for Pangeo data. Otherwise the BASD tasks compute tasrange and tasskew from tas,
+#          tasmin and tasmax as they read them (see utils.open_derived_data), and the files written here
+#          are an optional cache, read instead when present.
 # Inputs:  tas, tasmin, tasmax for historic and future periods for given ESM, scenario, ensemble member.
 # Outputs: tasrange, tasskew for historic and future periods for given ESM, scenerio, ensemble member.
 # Usage: Save the ESM data (tas, tasmin and tasmax) to it's respective directory at
@@ -27,6 +30,8 @@ import pandas as pd
 import xarray as xr
 import warnings
 
+import utils
+
 
 def create_tasrange_tasskew_stitched(run_details):
     # List of all models and scenarios being used
@@ -59,10 +64,16 @@ def create_tasrange_tasskew_stitched(run_details):
             tasmin_data = xr.open_mfdataset(tasmin_files)
             tasmax_data = xr.open_mfdataset(tasmax_files)
 
+            # Inputs in float32, and any promotion to float64 warned about (see utils.to_compute_dtype)
+            inputs = {'tas': tas_data['tas'], 'tasmin': tasmin_data['tasmin'], 'tasmax': tasmax_data['tasmax']}
+            inputs = {x: utils.to_compute_dtype(y, x, 'read') for x, y in inputs.items()}
+
             # Create tasrange
-            tasrange_array = tasmax_data['tasmax'] - tasmin_data['tasmin']
+            tasrange_array = utils.compute_variable(utils.DERIVED_VARIABLES['tasrange'],
+                                                    [inputs[x] for x in utils.DERIVED_VARIABLES['tasrange']['inputs']], 'tasrange')
             # Create tasskew
-            tasskew_array = (tas_data['tas'] - tasmin_data['tasmin']) / tasrange_array
+            tasskew_array = utils.compute_variable(utils.DERIVED_VARIABLES['tasskew'],
+                                                   [inputs[x] for x in utils.DERIVED_VARIABLES['tasskew']['inputs']], 'tasskew')
 
             # Convert to xarray Dataset from DataArray
             tasrange_data = tasrange_array.to_dataset(name='tasrange')
@@ -137,10 +148,16 @@ def create_tasrange_tasskew_CMIP(run_details, output_path):
                 tasmin_data = xr.open_mfdataset(tasmin_files)
                 tasmax_data = xr.open_mfdataset(tasmax_files)
 
+                # Inputs in float32, and any promotion to float64 warned about (see utils.to_compute_dtype)
+                inputs = {'tas': tas_data['tas'], 'tasmin': tasmin_data['tasmin'], 'tasmax': tasmax_data['tasmax']}
+                inputs = {x: utils.to_compute_dtype(y, x, 'read') for x, y in inputs.items()}
+
                 # Create tasrange
-                tasrange_array = tasmax_data['tasmax'] - tasmin_data['tasmin']
+                tasrange_array = utils.compute_variable(utils.DERIVED_VARIABLES['tasrange'],
+                                                        [inputs[x] for x in utils.DERIVED_VARIABLES['tasrange']['inputs']], 'tasrange')
                 # Create tasskew
-                tasskew_array = (tas_data['tas'] - tasmin_data['tasmin']) / tasrange_array
+                tasskew_array = utils.compute_variable(utils.DERIVED_VARIABLES['tasskew'],
+                                                       [inputs[x] for x in utils.DERIVED_VARIABLES['tasskew']['inputs']], 'tasskew')
 
                 # Convert to xarray Dataset from DataArray
                 tasrange_data = tasrange_array.to_dataset(name='tasrange')
@@ -250,10 +267,16 @@ def create_tasrange_tasskew_pangeo(output_path, esm, scenario, ensemble):
     tasmax_data = fetch_nc(tasmax_urls)
     tasmin_data = fetch_nc(tasmin_urls)
 
+    # Inputs in float32, and any promotion to float64 warned about (see utils.to_compute_dtype)
+    inputs = {'tas': tas_data['tas'], 'tasmin': tasmin_data['tasmin'], 'tasmax': tasmax_data['tasmax']}
+    inputs = {x: utils.to_compute_dtype(y, x, 'read') for x, y in inputs.items()}
+
     # Create tasrange
-    tasrange_array = tasmax_data['tasmax'] - tasmin_data['tasmin']
+    tasrange_array = utils.compute_variable(utils.DERIVED_VARIABLES['tasrange'],
+                                            [inputs[x] for x in utils.DERIVED_VARIABLES['tasrange']['inputs']], 'tasrange')
     # Create tasskew
-    tasskew_array = (tas_data['tas'] - tasmin_data['tasmin']) / tasrange_array
+    tasskew_array = utils.compute_variable(utils.DERIVED_VARIABLES['tasskew'],
+                                           [inputs[x] for x in utils.DERIVED_VARIABLES['tasskew']['inputs']], 'tasskew')
 
     # Convert to xarray Dataset from DataArray
     tasrange_data = tasrange_array.to_dataset(name='tasrange')
@@ -0,0 +1,332 @@
+"""
+Description: Keeps Python, the imported packages and a Dask cluster running on a node, and runs the BASD tasks sent
+             to it by main.py (with the --daemon flag) one at a time, sending the task's log back as it runs. This
+             saves starting up for every task, which is a large part of the run time of small tasks. One daemon
+             serves one run, and is reached through a socket in the node's temporary directory.
+Usage (from the root repository level):
+    python code/python/daemon.py <run_name> [--idle-timeout 600] [--warn]   # Start the daemon
+    python code/python/daemon.py <run_name> --wait                          # Wait until the daemon is ready
+    python code/python/daemon.py <run_name> --stop                          # Stop the daemon
+    python code/python/main.py <task_id> <run_name> --daemon                # Run a task on the daemon
+"""
+
+# Import Libraries
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+# Marks the last line sent back for a request, holding its result
+STATUS_PREFIX = '\x00STATUS '
+# Seconds to wait for the daemon to be ready with --wait
+WAIT_TIMEOUT = 600
+
+
+# Location of the daemon's socket
+def get_socket_path(run_name):
+    """
+    Function for getting the path of the socket of the daemon for a run. It's in the node's temporary directory,
+    so each node has its own daemon.
+    """
+    return os.path.join(tempfile.gettempdir(), f'basd_daemon_{os.getuid()}_{run_name}.sock')
+
+
+# Send a request to the daemon
+def send(run_name, request, output=None):
+    """
+    Function for sending a request to the daemon. Lines of the log sent back are written to output (stdout by
+    default) as they arrive, and the result of the request is returned.
+    """
+    output = sys.stdout if output is None else output
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(get_socket_path(run_name))
+        connection.sendall((json.dumps(request) + '\n').encode())
+        with connection.makefile('r', errors='replace') as response:
+            for line in response:
+                if line.startswith(STATUS_PREFIX):
+                    return json.loads(line[len(STATUS_PREFIX):])
+                output.write(line)
+                output.flush()
+
+    raise ConnectionError('BASD daemon closed the connection before the request finished')
+
+
+# Whether a daemon is running for a run
+def is_running(run_name):
+    """
+    Function for checking if a daemon is running and ready for the given run on this node
+    """
+    try:
+        return send(run_name, {'command': 'ping'})['status'] == 'ready'
+    except (OSError, ValueError):
+        return False
+
+
+# Run a task on the daemon
+def submit(task_id, run_name, performance_report=False):
+    """
+    Function for running a task on the daemon, printing its log as it runs. Returns the exit code of the task.
+    """
+    status = send(run_name, {'command': 'run', 'task_id': int(task_id), 'run_name': run_name, 'cwd': os.getcwd(),
+                             'performance_report': performance_report})
+    if status['status'] != 'completed':
+        print(f'Task {task_id} failed on the BASD daemon: {status.get("error")}', flush=True)
+
+    return status['exit_code']
+
+
+# Passes a task's printed output back to the client
+class ClientWriter:
+    """
+    File like object which sends everything written to it back to the client. If the client has gone away the
+    output is dropped, and the task carries on.
+    """
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.connected = True
+
+    def write(self, text):
+        if self.connected:
+            try:
+                self.wfile.write(text.encode(errors='replace'))
+            except OSError:
+                self.connected = False
+        return len(text)
+
+    def flush(self):
+        if self.connected:
+            try:
+                self.wfile.flush()
+            except OSError:
+                self.connected = False
+
+    def write_status(self, status):
+        self.write(STATUS_PREFIX + json.dumps(status, default=str) + '\n')
+        self.flush()
+
+
+# Sends the output of each task to its own client
+class TaskOutput:
+    """
+    Replaces stdout and stderr of the daemon once, at start up. What a task's thread writes goes to the client of
+    that task, and everything else (the prefetch thread, Dask callbacks, the server) to the daemon's own log, so
+    output from other threads never ends up in a client's log.
+    """
+    def __init__(self, log):
+        self.log = log
+        self.local = threading.local()
+
+    def set_writer(self, writer):
+        self.local.writer = writer
+
+    def get_writer(self):
+        return getattr(self.local, 'writer', None) or self.log
+
+    def write(self, text):
+        return self.get_writer().write(text)
+
+    def flush(self):
+        self.get_writer().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.log, name)
+
+
+# Output of the task running on the current thread
+@contextlib.contextmanager
+def task_output(writer):
+    """
+    Function for sending everything the current thread prints to writer, for the duration of the context
+    """
+    streams = [stream for stream in (sys.stdout, sys.stderr) if isinstance(stream, TaskOutput)]
+    for stream in streams:
+        stream.set_writer(writer)
+    try:
+        yield
+    finally:
+        for stream in streams:
+            stream.set_writer(None)
+
+
+# Handles one request from a client
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handles one request to the daemon. Tasks are run one at a time, later requests wait for the current task.
+    """
+    def handle(self):
+        server = self.server
+        output = ClientWriter(self.wfile)
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            output.write_status({'status': 'failed', 'exit_code': 1, 'error': 'Could not read request'})
+            return
+
+        if request.get('command') == 'ping':
+            status = {'status': 'ready', 'run_name': server.run_name}
+        elif request.get('command') == 'stop':
+            status = {'status': 'stopping'}
+            threading.Thread(target=server.shutdown).start()
+        elif request.get('command') == 'run':
+            with server.task_lock:
+                status = run_request(server, request, output)
+        else:
+            status = {'status': 'failed', 'exit_code': 1, 'error': f'Unknown command {request.get("command")}'}
+
+        output.write_status(status)
+
+
+# Unix socket server running requests in threads
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+# Run a task sent by a client
+def run_request(server, request, output):
+    """
+    Function for running a task sent by a client, with everything it prints sent back to the client
+    """
+    import main
+    import prefetch
+
+    # A daemon only serves one run, from the directory it was started in
+    if request.get('run_name') != server.run_name:
+        return {'status': 'failed', 'exit_code': 1, 'error': f'This daemon is running {server.run_name}'}
+    if request.get('cwd') != os.getcwd():
+        return {'status': 'failed', 'exit_code': 1, 'error': f'This daemon is running from {os.getcwd()}'}
+
+    server.last_active = time.time()
+    try:
+        with task_output(output):
+            # Copy the inputs of the next task while this one runs
+            prefetch.prefetch_next(server.run_name, request['task_id'])
+            main.run_task(request['task_id'], server.run_name, server.client, server.cluster, server.dask_settings,
+                          request.get('performance_report', False))
+        status = {'status': 'completed', 'exit_code': 0}
+    except BaseException as e:
+        # Includes scripts calling exit(), the daemon keeps running either way
+        if isinstance(e, KeyboardInterrupt):
+            raise
+        traceback.print_exc(file=output)
+        exit_code = e.code if isinstance(e, SystemExit) and isinstance(e.code, int) else 1
+        status = {'status': 'failed', 'exit_code': exit_code or 1, 'error': repr(e)}
+    finally:
+        # Start any workers the supervisor stopped again, so the next task starts with the full cluster
+        if len(server.client.scheduler_info()['workers']) != server.n_workers:
+            server.cluster.scale(server.n_workers)
+            server.client.wait_for_workers(server.n_workers)
+        server.last_active = time.time()
+
+    return status
+
+
+# Stop the daemon when it hasn't been used for a while
+def watch_idle(server, idle_timeout):
+    """
+    Function for stopping the daemon after idle_timeout seconds without a task, so it doesn't hold the node
+    """
+    while True:
+        time.sleep(min(idle_timeout, 10))
+        if not server.task_lock.locked() and time.time() - server.last_active > idle_timeout:
+            print(f'No tasks for {idle_timeout} seconds, stopping', flush=True)
+            server.shutdown()
+            return
+
+
+# Start the daemon
+def serve(run_name, idle_timeout=None, warn=False):
+    """
+    Function for starting the daemon for a run. Imports the packages and starts the Dask cluster once, then runs
+    tasks sent to it until stopped.
+    """
+    socket_path = get_socket_path(run_name)
+    if is_running(run_name):
+        print(f'A BASD daemon is already running for {run_name} ({socket_path})', flush=True)
+        return
+    # Left behind by a daemon that didn't shut down cleanly
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    # Each task's output goes to its own client, see TaskOutput
+    sys.stdout = TaskOutput(sys.stdout)
+    sys.stderr = TaskOutput(sys.stderr)
+
+    # Everything a task needs, imported once
+    import main
+    import downloaded
+    import pangeo
+    import stitched
+    import prefetch
+
+    dask_settings = main.configure_dask(run_name, warn, f'{run_name}_daemon_{os.getpid()}')
+    prefetch.start(dask_settings, f'{run_name}_prefetch_{os.getpid()}')
+
+    try:
+        serve_cluster(run_name, socket_path, idle_timeout, dask_settings)
+    finally:
+        # Remove the prefetched inputs and Dask's temporary files of this daemon
+        prefetch.stop()
+        if dask_settings.get('dask_task_directory') is not None:
+            shutil.rmtree(dask_settings['dask_task_directory'], ignore_errors=True)
+
+
+# Serve tasks on a new Dask cluster
+def serve_cluster(run_name, socket_path, idle_timeout, dask_settings):
+    """
+    Function for starting the Dask cluster of the daemon and serving tasks on it until the daemon is stopped
+    """
+    from dask.distributed import (Client, LocalCluster)
+
+    with LocalCluster(processes=True, threads_per_worker=1) as cluster, Client(cluster) as client:
+        with DaemonServer(socket_path, RequestHandler) as server:
+            server.run_name = run_name
+            server.client = client
+            server.cluster = cluster
+            server.dask_settings = dask_settings
+            server.n_workers = len(client.scheduler_info()['workers'])
+            server.task_lock = threading.Lock()
+            server.last_active = time.time()
+            if idle_timeout:
+                threading.Thread(target=watch_idle, args=(server, idle_timeout), daemon=True).start()
+
+            print(f'BASD daemon for {run_name} ready with {server.n_workers} Dask workers ({socket_path})', flush=True)
+            print({client.dashboard_link}, flush=True)
+            try:
+                server.serve_forever()
+            finally:
+                os.remove(socket_path)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Keep a Dask cluster running on this node for the BASD tasks of a run')
+    parser.add_argument('run_name', type=str, help='name of your experiment directory')
+    parser.add_argument('--idle-timeout', type=float, default=None,
+                        help='stop after this many seconds without a task')
+    parser.add_argument('--warn', action='store_const', dest='warn', const=True, default=False,
+                        help='flag to print warnings in log .out file')
+    parser.add_argument('--wait', action='store_const', dest='wait', const=True, default=False,
+                        help='wait until the daemon for this run is ready, then exit')
+    parser.add_argument('--stop', action='store_const', dest='stop', const=True, default=False,
+                        help='stop the daemon for this run')
+    args = parser.parse_args()
+
+    if args.wait:
+        start_time = time.time()
+        while not is_running(args.run_name):
+            if time.time() - start_time > WAIT_TIMEOUT:
+                sys.exit(f'BASD daemon for {args.run_name} not ready after {WAIT_TIMEOUT} seconds')
+            time.sleep(2)
+    elif args.stop:
+        if is_running(args.run_name):
+            send(args.run_name, {'command': 'stop'})
+    else:
+        serve(args.run_name, args.idle_timeout, args.warn)
@@ -4,18 +4,12 @@ This script will be used for BASD for data hosted locally
 
 # Importing Needed Libraries
 import os  # For navigating os
-import shutil  # Running system commands
-import socket  # Running on cluster
 import sys  # Getting system details
-from datetime import datetime  # Manipulate temporal data
 
-import basd  # Bias adjustment and statistical downscaling
-import dask  # Setting Dask config
-import numpy as np  # Numerical / array functions
-import pandas as pd  # Data functions
+import metrics  # Timing and memory metrics
+import pipeline  # Bias adjustment and downscaling of a task
 import utils  # Utility functions script
 import xarray as xr  # Reading and manipulating NetCDF data
-from dask.distributed import (Client, LocalCluster)  # Using Dask in parallel
 
 # CONSTANTS
 INPUT_PATH = 'input'
@@ -31,7 +25,10 @@ output_mon_basd_file_name = None
 input_ref_data_path = None
 input_sim_data_path = None
 
-# Chunk sizes (constants to be set)
+# Bounding box of the task's region, widened to whole ESM grid cells (None for global tasks)
+region_bounds = None
+
+# Chunk sizes (set by pipeline.run_basd)
 time_chunk = None
 lat_chunk = None
 lon_chunk = None
@@ -42,149 +39,78 @@ def basd_downloaded(run_object, run_name):
     Function to manage steps for running bias adjustment and downscaling using data downloaded locally.
     """
     # 1. Name output files and paths
-    set_names(run_object)
+    with metrics.stage('set_names'):
+        set_names(run_object)
 
     # 2. Try to make directories if they don't already exist
     create_directories()
 
-    # 4. Get and extract parameters
-    params = utils.get_parameters(run_object, os.path.join(INPUT_PATH, run_name))
-
-    # 5. Read encoding settings
-    encoding, reset_chunksizes = utils.get_encoding(os.path.join(INPUT_PATH, run_name))
+    # 3. Bias adjust and downscale the data, for each configuration of basd parameters
+    pipeline.run_basd(sys.modules[__name__], run_object, run_name, load_ba_data)
 
-    # 6. Read attributes
-    variable_attributes, global_monthly_attributes, global_daily_attributes = utils.get_attributes(run_object.Variable, os.path.join(INPUT_PATH, run_name))
 
-    # 7. Read Dask settings
-    global time_chunk, lat_chunk, lon_chunk
-    time_chunk, lat_chunk, lon_chunk, dask_temp_directory = utils.get_chunk_sizes(os.path.join(INPUT_PATH, run_name))
-
-    # 8. Get Data
-    # Load in data over the given periods
-    obs_reference_data, sim_reference_data, sim_application_data = load_ba_data(run_object)
+# Load in datasets and trims to reference and application periods, and drops extra variables in the dataset
+def load_ba_data(run_object):
+    """
+    Function that loads in datasets and trims to reference and application periods, and drops extra variables in the dataset
+    """
+    # Get application and target periods
+    application_start_year, application_end_year = str.split(run_object.application_period, '-')
+    target_start_year, target_end_year = str.split(run_object.target_period, '-')
 
-    # Reset Chunk sizes
-    if reset_chunksizes:
-        encoding['chunksizes'] = utils.reset_chunk_sizes(encoding['chunksizes'], sim_application_data.dims)
+    # Only list files whose date range overlaps the periods we need
+    sim_application_files, sim_reference_files, obs_reference_files = list_input_files(run_object)
+
+    # Region of the task, widened to whole ESM grid cells so the reference grid is cut at the edges of the same cells
+    global region_bounds
+    region_bounds = utils.get_region_bounds(run_object)
+    if region_bounds is not None:
+        with xr.open_dataset(utils.get_source_files(sim_application_files[0], run_object.Variable)[0]) as grid:
+            region_bounds = utils.snap_region_bounds(grid, region_bounds)
+
+    # Open data, subsetting the desired time and region and dropping unwanted vars as each file is opened
+    print(f'Attempting to open {sim_application_files}', flush=True)
+    sim_application_data = utils.open_input_data(sim_application_files, run_object.Variable, time_chunk, application_start_year, application_end_year,
+                                                 region_bounds)
+    print(f'Attempting to open {sim_reference_files}', flush=True)
+    sim_reference_data = utils.open_reference_data(sim_reference_files, run_object.Variable, time_chunk, target_start_year, target_end_year, lat_chunk, lon_chunk,
+                                                   region_bounds=region_bounds)
+    print(f'Attempting to open {obs_reference_files}', flush=True)
+    obs_reference_data = utils.open_reference_data(obs_reference_files, run_object.Variable, time_chunk, target_start_year, target_end_year, lat_chunk, lon_chunk,
+                                                   region_bounds=region_bounds)
 
-    # Use global path/file names
-    global temp_intermediate_dir, output_ba_path, output_basd_path
-    global output_day_ba_file_name, output_mon_ba_file_name, output_day_basd_file_name, output_mon_basd_file_name
-    global input_ref_data_path, input_sim_data_path
-
-    # 9. Run Bias Adjustment
-    # Initializing Bias Adjustment
-    ba = basd.init_bias_adjustment(
-        obs_reference_data, sim_reference_data, sim_application_data,
-        run_object.Variable, params,
-        lat_chunk_size=lat_chunk, lon_chunk_size=lon_chunk,
-        temp_path=temp_intermediate_dir, periodic=True
-    )
-
-    # Do / don't save monthly data
-    if ~run_object.monthly:
-        output_mon_ba_file_name = None
-        output_mon_basd_file_name = None
-
-    # Perform adjustment and save at daily resolution
-    basd.adjust_bias(
-        init_output = ba, output_dir = output_ba_path,
-        day_file = output_day_ba_file_name, month_file = output_mon_ba_file_name,
-        clear_temp = True, encoding={run_object.Variable: encoding},
-        ba_attrs = global_daily_attributes, ba_attrs_mon = global_monthly_attributes, variable_attrs = variable_attributes
-    )
-
-    # Close Bias Adjustment Data
-    obs_reference_data.close()
-    sim_reference_data.close()
-    sim_application_data.close()
-    # Clear temp directories
-    try:
-        shutil.rmtree(temp_intermediate_dir)
-    except OSError as e:
-        print("Warning: %s : %s" % (temp_intermediate_dir, e.strerror))
-
-    # Get Data for statistical downscaling
-    obs_reference_data, sim_application_data = utils.load_sd_data(run_object, input_ref_data_path, time_chunk, output_ba_path, output_day_ba_file_name)
-
-    # Reset Chunk sizes
-    if reset_chunksizes:
-        encoding['chunksizes'] = utils.reset_chunk_sizes(encoding['chunksizes'], obs_reference_data.dims)
-
-    # Remove upper bound for rsds for downscaling. Not using scaling to 0-1
-    if run_object.Variable == 'rsds':
-        params.upper_bound = None
-        params.upper_threshold = None
-        params.trend_preservation = None
-
-    # 10. Run downscaling
-    # Initialize downscaling
-    ds = basd.init_downscaling(obs_reference_data, sim_application_data, run_object.Variable, params, temp_path=temp_intermediate_dir)
-
-    # Run downscaling
-    basd.downscale(
-        ds,
-        output_dir = output_basd_path, day_file = output_day_basd_file_name, month_file = output_mon_basd_file_name,
-        encoding={run_object.Variable: encoding}, clear_temp=True,
-        basd_attrs = global_daily_attributes, basd_attrs_mon = global_monthly_attributes, variable_attrs = variable_attributes
-    )
-
-    # Close data
-    obs_reference_data.close()
-    sim_application_data.close()
-
-    # Remove temp dirs and daily data if not wanted
-    try:
-        shutil.rmtree(temp_intermediate_dir)
-    except OSError as e:
-        print("Warning: %s : %s" % (temp_intermediate_dir, e.strerror))
-    if ~run_object.daily:
-        try:
-            os.remove(os.path.join(output_ba_path, output_day_ba_file_name))
-            os.remove(os.path.join(output_basd_path, output_day_basd_file_name))
-        except OSError as e:
-            print(f"Error removing daily data")
-            pass
+    # Return
+    return obs_reference_data, sim_reference_data, sim_application_data
 
 
-# Load in datasets and trims to reference and application periods, and drops extra variables in the dataset
-def load_ba_data(run_object):
+# Input files of a task
+def list_input_files(run_object):
     """
-    Function that loads in datasets and trims to reference and application periods, and drops extra variables in the dataset
+    Function for listing the simulated application, simulated reference and observational reference files of a task,
+    only those whose date range overlaps the periods we need. Uses only the task details, so that prefetch.py can list
+    the files of the next task while this one runs.
     """
     # File name patterns
     sim_application_data_pattern = f'{run_object.Variable}_day_{run_object.ESM}_{run_object.Scenario}_{run_object.Ensemble}_*.nc'
     sim_reference_data_pattern = f'{run_object.Variable}_day_{run_object.ESM}_historical_{run_object.Ensemble}_*.nc'
     obs_reference_data_pattern = f'{run_object.Variable}_*.nc'
 
-    # Open data
-    print(f'Attempting to open {os.path.join(input_sim_data_path, sim_application_data_pattern)}', flush=True)
-    sim_application_data = xr.open_mfdataset(os.path.join(input_sim_data_path, sim_application_data_pattern), chunks={'time': time_chunk})
-    print(f'Attempting to open {os.path.join(input_sim_data_path, sim_reference_data_pattern)}', flush=True)
-    sim_reference_data = xr.open_mfdataset(os.path.join(input_sim_data_path, sim_reference_data_pattern), chunks={'time': time_chunk})
-    print(f'Attempting to open {os.path.join(input_ref_data_path, obs_reference_data_pattern)}', flush=True)
-    obs_reference_data = xr.open_mfdataset(os.path.join(input_ref_data_path, obs_reference_data_pattern), chunks={'time': time_chunk})
-
     # Get application and target periods
     application_start_year, application_end_year = str.split(run_object.application_period, '-')
     target_start_year, target_end_year = str.split(run_object.target_period, '-')
 
-    # Subsetting desired time
-    obs_reference_data = obs_reference_data.sel(time = slice(f'{target_start_year}', f'{target_end_year}'))
-    sim_reference_data = sim_reference_data.sel(time = slice(f'{target_start_year}', f'{target_end_year}'))
-    sim_application_data = sim_application_data.sel(time = slice(f'{application_start_year}', f'{application_end_year}'))
+    # Input locations of the simulated and observational reference data
+    sim_data_path = run_object.ESM_Input_Location
+    ref_data_path = os.path.join(run_object.Reference_Input_Location, run_object.Variable)
 
-    # Drop unwanted vars
-    obs_reference_data = obs_reference_data.drop([x for x in list(obs_reference_data.coords) if x not in ['time', 'lat', 'lon']])
-    sim_reference_data = sim_reference_data.drop([x for x in list(sim_reference_data.coords) if x not in ['time', 'lat', 'lon']])
-    sim_application_data = sim_application_data.drop([x for x in list(sim_application_data.coords) if x not in ['time', 'lat', 'lon']])
-    obs_reference_data = obs_reference_data.drop_vars([x for x in list(obs_reference_data.keys()) if x != run_object.Variable])
-    sim_reference_data = sim_reference_data.drop_vars([x for x in list(sim_reference_data.keys()) if x != run_object.Variable])
-    sim_application_data = sim_application_data.drop_vars([x for x in list(sim_application_data.keys()) if x != run_object.Variable])
+    sim_application_files = utils.get_input_files(sim_data_path, sim_application_data_pattern, application_start_year, application_end_year,
+                                                   run_object.Variable)
+    sim_reference_files = utils.get_input_files(sim_data_path, sim_reference_data_pattern, target_start_year, target_end_year,
+                                                 run_object.Variable)
+    obs_reference_files = utils.get_input_files(ref_data_path, obs_reference_data_pattern, target_start_year, target_end_year,
+                                                 run_object.Variable)
 
-    # Return
-    return obs_reference_data, sim_reference_data, sim_application_data
+    return sim_application_files, sim_reference_files, obs_reference_files
 
 
 # Function for setting path and file names based on run details
@@ -209,17 +135,20 @@ def set_names(run_object):
     # Start and End years
     start, end = str.split(run_object.application_period, '-')
 
+    # Region of the task, global unless the run manager gives one
+    region = utils.get_region_name(run_object)
+
     # Output file name for daily and monthly bias adjusted data
-    output_day_ba_file_name = f'{run_object.ESM}_{run_object.Ensemble}_{run_object.Reference_Dataset}_{run_object.Scenario}_{run_object.Variable}_global_daily_{start}_{end}.nc'
-    output_mon_ba_file_name = f'{run_object.ESM}_{run_object.Ensemble}_{run_object.Reference_Dataset}_{run_object.Scenario}_{run_object.Variable}_global_monthly_{start}_{end}.nc'
+    output_day_ba_file_name = f'{run_object.ESM}_{run_object.Ensemble}_{run_object.Reference_Dataset}_{run_object.Scenario}_{run_object.Variable}_{region}_daily_{start}_{end}.nc'
+    output_mon_ba_file_name = f'{run_object.ESM}_{run_object.Ensemble}_{run_object.Reference_Dataset}_{run_object.Scenario}_{run_object.Variable}_{region}_monthly_{start}_{end}.nc'
     
     # Full output path for downscaled data
     output_basd_path = os.path.join(run_object.Output_Location, run_object.Reference_Dataset,
                                     run_object.ESM, run_object.Scenario, 'basd')
     
     # Output file name for daily and monthly downscaled data
-    output_day_basd_file_name = f'{run_object.ESM}_{run_object.Ensemble}_{run_object.Reference_Dataset}_{run_object.Scenario}_{run_object.Variable}_global_daily_{start}_{end}.nc'
-    output_mon_basd_file_name = f'{run_object.ESM}_{run_object.Ensemble}_{run_object.Reference_Dataset}_{run_object.Scenario}_{run_object.Variable}_global_monthly_{start}_{end}.nc'
+    output_day_basd_file_name = f'{run_object.ESM}_{run_object.Ensemble}_{run_object.Reference_Dataset}_{run_object.Scenario}_{run_object.Variable}_{region}_daily_{start}_{end}.nc'
+    output_mon_basd_file_name = f'{run_object.ESM}_{run_object.Ensemble}_{run_object.Reference_Dataset}_{run_object.Scenario}_{run_object.Variable}_{region}_monthly_{start}_{end}.nc'
     
     # Input location for observational reference dataset
     input_ref_data_path = os.path.join(run_object.Reference_Input_Location, run_object.Variable)
@@ -227,6 +156,29 @@ def set_names(run_object):
     # Input location for simulated datasets
     input_sim_data_path = run_object.ESM_Input_Location
 
+    # Each configuration of a parameter sweep writes its own files
+    output_day_ba_file_name = utils.get_config_file_name(output_day_ba_file_name, run_object)
+    output_mon_ba_file_name = utils.get_config_file_name(output_mon_ba_file_name, run_object)
+    output_day_basd_file_name = utils.get_config_file_name(output_day_basd_file_name, run_object)
+    output_mon_basd_file_name = utils.get_config_file_name(output_mon_basd_file_name, run_object)
+
+    # Temporary files are kept on node-local scratch, if staging (see utils.start_staging)
+    temp_intermediate_dir = utils.get_staging_dir(temp_intermediate_dir)
+
+    # Tasks of other regions with the same ESM, variable and scenario can run at the same time
+    if region != 'global':
+        temp_intermediate_dir = f'{temp_intermediate_dir}_{region}'
+
+    # Each latitude band of a tiled task writes its own files, which mosaic.py puts together
+    if utils.is_tiled(run_object):
+        temp_intermediate_dir = f'{temp_intermediate_dir}_tile{run_object.tile}'
+        output_ba_path = os.path.join(output_ba_path, 'tiles')
+        output_basd_path = os.path.join(output_basd_path, 'tiles')
+        output_day_ba_file_name = utils.get_tile_file_name(output_day_ba_file_name, run_object)
+        output_mon_ba_file_name = utils.get_tile_file_name(output_mon_ba_file_name, run_object)
+        output_day_basd_file_name = utils.get_tile_file_name(output_day_basd_file_name, run_object)
+        output_mon_basd_file_name = utils.get_tile_file_name(output_mon_basd_file_name, run_object)
+
 
 # Function that creates new directories
 def create_directories():
@@ -0,0 +1,305 @@
+"""
+Description: Generates synthetic CMIP style simulation files and reference (observation) files at any
+             resolution, period and calendar, for load and scaling tests that need production sized data
+             without downloading it. Values are drawn from distributions that are plausible for each variable
+             (ex. gamma distributed precipitation with dry days, beta distributed relative humidity, a seasonal
+             and latitudinal cycle for temperature), and the simulation data is given a bias relative to the
+             reference data so that bias adjustment has something to do. Data is generated lazily, one block of
+             days at a time, so memory use stays bounded however large the grid is.
+Output:
+    - <output>/sim/<variable>_day_<ESM>_<experiment>_<ensemble>_<YYYYMMDD>-<YYYYMMDD>.nc
+    - <output>/obs/<variable>/<variable>_<reference>_<YYYYMMDD>-<YYYYMMDD>.nc
+    - <output>/stitched/stitched_<ESM>_<variable>_<scenario>.nc (with --stitched)
+    These match the file patterns read by downloaded.load_ba_data and stitched.load_ba_data, so a run_manager.csv
+    can point ESM_Input_Location at <output>/sim (or <output>/stitched) and Reference_Input_Location at <output>/obs.
+Usage:
+    python code/python/generate_synthetic_data.py <output path> --resolution 0.5 --obs-resolution 0.25
+    python code/python/generate_synthetic_data.py <output path> --variables tas pr --calendar noleap --years-per-file 10
+"""
+
+# Import Libraries
+import argparse
+import os
+
+import dask.array as da
+import numpy as np
+import xarray as xr
+
+# All variables that can be generated
+VARIABLES = ['tas', 'tasmin', 'tasmax', 'tasrange', 'tasskew', 'pr', 'prsnratio', 'hurs', 'sfcWind', 'rsds', 'rlds', 'ps']
+
+# Variable attributes
+VARIABLE_ATTRIBUTES = {
+    'tas': {'long_name': 'Near-Surface Air Temperature', 'units': 'K', 'standard_name': 'air_temperature'},
+    'tasmin': {'long_name': 'Daily Minimum Near-Surface Air Temperature', 'units': 'K', 'standard_name': 'air_temperature'},
+    'tasmax': {'long_name': 'Daily Maximum Near-Surface Air Temperature', 'units': 'K', 'standard_name': 'air_temperature'},
+    'tasrange': {'long_name': 'Range of Daily Near-Surface Air Temperature Cycle', 'units': 'K', 'standard_name': 'air_temperature_range'},
+    'tasskew': {'long_name': 'Skewness of Daily Near-Surface Air Temperature Cycle', 'units': '1', 'standard_name': 'air_temperature_skewness'},
+    'pr': {'long_name': 'Precipitation', 'units': 'kg m-2 s-1', 'standard_name': 'precipitation_flux'},
+    'prsnratio': {'long_name': 'Ratio of Snowfall Flux to Total Precipitation', 'units': '1', 'standard_name': 'snowfall_precipitation_ratio'},
+    'hurs': {'long_name': 'Near-Surface Relative Humidity', 'units': '%', 'standard_name': 'relative_humidity'},
+    'sfcWind': {'long_name': 'Daily-Mean Near-Surface Wind Speed', 'units': 'm s-1', 'standard_name': 'wind_speed'},
+    'rsds': {'long_name': 'Surface Downwelling Shortwave Radiation', 'units': 'W m-2', 'standard_name': 'surface_downwelling_shortwave_flux_in_air'},
+    'rlds': {'long_name': 'Surface Downwelling Longwave Radiation', 'units': 'W m-2', 'standard_name': 'surface_downwelling_longwave_flux_in_air'},
+    'ps': {'long_name': 'Surface Air Pressure', 'units': 'Pa', 'standard_name': 'surface_air_pressure'}
+}
+
+# Fixed codes for each random component, so that related variables (ex. tas, tasmin, tasmax) generated in
+# different files draw the same values and stay consistent with each other
+COMPONENT_CODES = {'tas': 1, 'tasrange': 2, 'tasskew': 3, 'wet': 4, 'pr': 5, 'hurs': 6, 'sfcWind': 7, 'clouds': 8, 'rlds': 9, 'ps': 10}
+
+# Seconds per day, for precipitation flux
+SECONDS_PER_DAY = 86400
+
+
+# Create a regular grid
+def make_grid(resolution, domain):
+    """
+    Function for creating cell center latitudes and longitudes for a regular grid over the given domain,
+    where domain is (lat_min, lat_max, lon_min, lon_max)
+    """
+    lat_min, lat_max, lon_min, lon_max = domain
+    lat = np.arange(lat_min + resolution / 2, lat_max, resolution)
+    lon = np.arange(lon_min + resolution / 2, lon_max, resolution)
+
+    return lat, lon
+
+
+# Create daily time coordinate
+def make_times(start_year, end_year, calendar):
+    """
+    Function for creating daily time stamps from the start of start_year to the end of end_year in the given calendar
+    """
+    use_cftime = calendar not in ['standard', 'gregorian', 'proleptic_gregorian']
+
+    return xr.date_range(f'{start_year}-01-01', f'{end_year}-12-31', freq='D', calendar=calendar, use_cftime=use_cftime)
+
+
+# Random number generator for one component of one block of days
+def get_rng(seed, component, block_start):
+    """
+    Function for getting a reproducible random number generator for a component and block of days
+    """
+    return np.random.default_rng([seed, COMPONENT_CODES[component], block_start])
+
+
+# Temperature components, shared by all the temperature variables
+def generate_temperature(seed, block_start, doy, years, days_in_year, lat, lon, bias):
+    """
+    Function for generating tas, tasrange and tasskew for a block of days. tas has a latitudinal gradient,
+    a seasonal cycle with opposite phase in each hemisphere, day to day noise, and a warming trend after 2015.
+    """
+    shape = (len(doy), len(lat), len(lon))
+    lat_rad = np.deg2rad(lat)[None, :, None]
+    season = np.cos(2 * np.pi * (doy[:, None, None] - 200) / days_in_year)
+    trend = 0.03 * np.maximum(years - 2015, 0)[:, None, None]
+
+    tas = 250 + 50 * np.cos(lat_rad) ** 2 + 15 * np.sin(lat_rad) * season + trend + bias
+    tas = tas + get_rng(seed, 'tas', block_start).normal(0, 3, shape)
+    tasrange = get_rng(seed, 'tasrange', block_start).gamma(8, 1.25, shape)
+    tasskew = get_rng(seed, 'tasskew', block_start).beta(5, 5, shape)
+
+    return tas, tasrange, tasskew
+
+
+# Generate values for one variable and one block of days
+def generate_values(variable, source, seed, block_start, doy, years, days_in_year, lat, lon):
+    """
+    Function for generating values for a variable over a block of days. The source ('sim' or 'obs') sets
+    the bias applied to the simulated data relative to the reference data.
+    """
+    shape = (len(doy), len(lat), len(lon))
+    is_sim = source == 'sim'
+
+    # Temperature and anything that depends on it
+    if variable in ['tas', 'tasmin', 'tasmax', 'tasrange', 'tasskew', 'prsnratio', 'rlds']:
+        tas, tasrange, tasskew = generate_temperature(seed, block_start, doy, years, days_in_year, lat, lon, 1.5 if is_sim else 0)
+        if variable == 'tas':
+            values = tas
+        elif variable == 'tasrange':
+            values = tasrange
+        elif variable == 'tasskew':
+            values = tasskew
+        elif variable == 'tasmin':
+            values = tas - tasskew * tasrange
+        elif variable == 'tasmax':
+            values = tas - tasskew * tasrange + tasrange
+        elif variable == 'prsnratio':
+            # Snow fraction goes from 1 when cold to 0 when warm, zero when not raining
+            wet = get_rng(seed, 'wet', block_start).random(shape) < 0.4
+            values = np.where(wet, np.clip((275 - tas) / 6, 0, 1), 0)
+        elif variable == 'rlds':
+            # Emission from a cloudy atmosphere at near surface temperature
+            values = 0.8 * 5.67e-8 * tas ** 4 + get_rng(seed, 'rlds', block_start).normal(0, 15, shape)
+
+    # Precipitation, gamma distributed amounts on wet days
+    elif variable == 'pr':
+        wet = get_rng(seed, 'wet', block_start).random(shape) < 0.4
+        amount = get_rng(seed, 'pr', block_start).gamma(0.8, 8 * (1.2 if is_sim else 1), shape)
+        values = np.where(wet, amount, 0) / SECONDS_PER_DAY
+
+    # Relative humidity, beta distributed percentage
+    elif variable == 'hurs':
+        values = 100 * get_rng(seed, 'hurs', block_start).beta(6, 2 if is_sim else 2.2, shape)
+
+    # Wind speed, weibull distributed
+    elif variable == 'sfcWind':
+        values = (4.5 if is_sim else 5) * get_rng(seed, 'sfcWind', block_start).weibull(2, shape)
+
+    # Shortwave, daily insolation reduced by clouds
+    elif variable == 'rsds':
+        declination = np.deg2rad(23.44) * np.sin(2 * np.pi * (doy - 81) / days_in_year)
+        lat_rad = np.deg2rad(lat)
+        insolation = 420 * np.maximum(np.cos(lat_rad[None, :, None] - declination[:, None, None]), 0)
+        values = insolation * get_rng(seed, 'clouds', block_start).beta(5, 2 if is_sim else 2.5, shape)
+
+    # Surface pressure, with a smooth spatial pattern standing in for elevation
+    elif variable == 'ps':
+        elevation = 500 * (1 + np.sin(np.deg2rad(3 * lat))[:, None] * np.cos(np.deg2rad(2 * lon))[None, :])
+        values = 101325 * np.exp(-elevation / 8000)[None, :, :] + get_rng(seed, 'ps', block_start).normal(0, 800, shape)
+
+    else:
+        raise ValueError(f'Unknown variable {variable}, expected one of {VARIABLES}')
+
+    return values.astype(np.float32)
+
+
+# Land mask used to blank out "ocean" cells in reference data
+def make_land_mask(lat, lon, land_fraction):
+    """
+    Function for creating a smooth pseudo land/sea mask covering roughly land_fraction of the grid
+    """
+    if land_fraction >= 1:
+        return None
+
+    pattern = np.sin(np.deg2rad(2 * lat))[:, None] + np.cos(np.deg2rad(3 * lon))[None, :] + 0.5 * np.sin(np.deg2rad(7 * lon + 5 * lat[:, None]))
+    threshold = np.quantile(pattern, 1 - land_fraction)
+
+    return pattern >= threshold
+
+
+# Lazily build a variable's data for a set of days
+def make_variable_array(variable, source, seed, times, start_index, calendar, lat, lon, chunk_days, land_mask):
+    """
+    Function for creating a lazy (dask) array of a variable's values, generated one block of days at a time.
+    start_index is the position of the first day in the full time series, so blocks get the same random
+    values regardless of how the time series is split into files.
+    """
+    doy = np.asarray(times.dayofyear)
+    years = np.asarray(times.year)
+    days_in_year = 360 if calendar == '360_day' else 365.25
+
+    def block(block_info=None):
+        t0, t1 = block_info[None]['array-location'][0]
+        values = generate_values(variable, source, seed, start_index + t0, doy[t0:t1], years[t0:t1], days_in_year, lat, lon)
+        if land_mask is not None:
+            values[:, ~land_mask] = np.nan
+        return values
+
+    n_days = len(times)
+    time_chunks = tuple(min(chunk_days, n_days - i) for i in range(0, n_days, chunk_days))
+
+    return da.map_blocks(block, dtype=np.float32, chunks=(time_chunks, (len(lat),), (len(lon),)))
+
+
+# Split a period into files
+def split_years(start_year, end_year, years_per_file):
+    """
+    Function for splitting a period into (start, end) year pairs for each file
+    """
+    if years_per_file <= 0:
+        return [(start_year, end_year)]
+
+    return [(year, min(year + years_per_file - 1, end_year)) for year in range(start_year, end_year + 1, years_per_file)]
+
+
+# Write one variable over a period, split into files
+def write_variable(variable, source, period, calendar, years_per_file, file_name_fn, output_dir, lat, lon, args, land_mask=None):
+    """
+    Function for writing a variable over a period to one or more files, with file names from file_name_fn(start, end)
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    period_start, period_end = [int(x) for x in str.split(period, '-')]
+    all_times = make_times(period_start, period_end, calendar)
+
+    # Bytes per day of data, to size blocks to roughly the requested chunk size
+    chunk_days = max(1, int(args.chunk_mb * 1024**2 // (len(lat) * len(lon) * 4)))
+
+    for start_year, end_year in split_years(period_start, period_end, years_per_file):
+        in_file = (all_times.year >= start_year) & (all_times.year <= end_year)
+        times = all_times[in_file]
+        start_index = int(np.argmax(in_file))
+
+        data = xr.Dataset(
+            {variable: (('time', 'lat', 'lon'), make_variable_array(variable, source, args.seed, times, start_index, calendar, lat, lon, chunk_days, land_mask))},
+            coords={'time': times, 'lat': lat, 'lon': lon}
+        )
+        data[variable].attrs = VARIABLE_ATTRIBUTES[variable]
+        data['lat'].attrs = {'units': 'degrees_north', 'standard_name': 'latitude'}
+        data['lon'].attrs = {'units': 'degrees_east', 'standard_name': 'longitude'}
+
+        encoding = {
+            variable: {'zlib': args.complevel > 0, 'complevel': args.complevel, 'dtype': 'float32',
+                       'chunksizes': (min(chunk_days, len(times)), len(lat), len(lon))},
+            'time': {'units': f'days since {period_start}-01-01', 'calendar': calendar}
+        }
+        file_path = os.path.join(output_dir, file_name_fn(times[0].strftime('%Y%m%d'), times[-1].strftime('%Y%m%d')))
+        print(f'Writing {file_path}', flush=True)
+        data.to_netcdf(file_path, encoding=encoding, compute=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Generate synthetic simulation and reference climate data for load testing.')
+    parser.add_argument('output_path', type=str, help='directory to write sim, obs (and stitched) data to')
+    parser.add_argument('--resolution', type=float, default=1.0, help='simulation grid resolution in degrees')
+    parser.add_argument('--obs-resolution', type=float, default=0.5, help='reference grid resolution in degrees, should divide --resolution')
+    parser.add_argument('--domain', type=float, nargs=4, default=[-90, 90, -180, 180], metavar=('LAT_MIN', 'LAT_MAX', 'LON_MIN', 'LON_MAX'),
+                        help='bounds of the grid')
+    parser.add_argument('--historical-period', type=str, default='1979-2014', help='years of historical simulation data')
+    parser.add_argument('--future-period', type=str, default='2015-2100', help='years of future simulation data')
+    parser.add_argument('--obs-period', type=str, default='1979-2014', help='years of reference data')
+    parser.add_argument('--calendar', type=str, default='standard', help='calendar of the simulation data, ex. standard, noleap, 360_day')
+    parser.add_argument('--variables', type=str, nargs='+', default=['tas', 'tasmin', 'tasmax', 'pr', 'hurs', 'sfcWind', 'rsds', 'rlds', 'ps', 'prsnratio'],
+                        choices=VARIABLES, help='variables to generate')
+    parser.add_argument('--years-per-file', type=int, default=10, help='years in each file, 0 for one file per period')
+    parser.add_argument('--esm', type=str, default='synthetic-esm', help='ESM name used in file names')
+    parser.add_argument('--scenario', type=str, default='ssp245', help='future experiment name used in file names')
+    parser.add_argument('--ensemble', type=str, default='r1i1p1f1', help='ensemble member used in file names')
+    parser.add_argument('--reference', type=str, default='synthetic-obs', help='reference dataset name used in file names')
+    parser.add_argument('--land-fraction', type=float, default=1.0, help='fraction of reference cells with data, the rest are missing (ex. 0.3 for land only data)')
+    parser.add_argument('--stitched', action='store_true', help='also write STITCHES style simulation files covering both periods')
+    parser.add_argument('--chunk-mb', type=float, default=64, help='approximate size of each generated block of days in MB')
+    parser.add_argument('--complevel', type=int, default=1, help='zlib compression level, 0 for none')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    # Grids
+    sim_lat, sim_lon = make_grid(args.resolution, args.domain)
+    obs_lat, obs_lon = make_grid(args.obs_resolution, args.domain)
+    land_mask = make_land_mask(obs_lat, obs_lon, args.land_fraction)
+
+    for variable in args.variables:
+        # Simulated historical and future data
+        for experiment, period in [('historical', args.historical_period), (args.scenario, args.future_period)]:
+            write_variable(
+                variable, 'sim', period, args.calendar, args.years_per_file,
+                lambda start, end: f'{variable}_day_{args.esm}_{experiment}_{args.ensemble}_{start}-{end}.nc',
+                os.path.join(args.output_path, 'sim'), sim_lat, sim_lon, args
+            )
+
+        # STITCHED style data, one file covering both periods
+        if args.stitched:
+            stitched_period = f'{str.split(args.historical_period, "-")[0]}-{str.split(args.future_period, "-")[1]}'
+            write_variable(
+                variable, 'sim', stitched_period, args.calendar, 0,
+                lambda start, end: f'stitched_{args.esm}_{variable}_{args.scenario}.nc',
+                os.path.join(args.output_path, 'stitched'), sim_lat, sim_lon, args
+            )
+
+        # Reference data, always on the standard calendar
+        write_variable(
+            variable, 'obs', args.obs_period, 'standard', args.years_per_file,
+            lambda start, end: f'{variable}_{args.reference}_{start}-{end}.nc',
+            os.path.join(args.output_path, 'obs', variable), obs_lat, obs_lon, args, land_mask
+        )
@@ -10,19 +10,74 @@ Input:
 Output:
     - intermediate/<run_manager>_explicit_list.csv - file that explicitly lists out the details of each run requested
     - intermediate/<run_manager>.job - bash file for submitting jobs to slurm scheduler
+    - intermediate/<run_name>/preflight_report.csv - problems found in the input data of each task
+    - intermediate/<run_name>/run_plan.json, run_plan.jsonl, run_plan.idx - compiled settings of each task (see plan.py)
+    - intermediate/<run_name>/basd_daemon.job - bash file for running all BASD jobs in one allocation through daemon.py
+    - intermediate/<run_name>/mosaic.job - bash file for joining the tiles of tasks split with --tiles
+    - intermediate/<run_name>/reference_cache - reference period data shared by tasks, written by the tasks themselves
 """
 
 # Import Libraries
+import argparse
 import os
 import sys
 
 import numpy as np
 import pandas as pd
 
+import plan
+import preflight
+import utils
+
+
+# Slurm time limit in seconds
+def parse_slurm_time(time_limit):
+    """
+    Function for reading a Slurm time limit (minutes, minutes:seconds, hours:minutes:seconds, days-hours,
+    days-hours:minutes or days-hours:minutes:seconds) as seconds
+    """
+    days, _, time_limit = str(time_limit).strip().rpartition('-')
+    parts = [int(x) for x in time_limit.split(':')]
+    if days:
+        hours, minutes, seconds = (parts + [0, 0])[:3]
+    elif len(parts) == 3:
+        hours, minutes, seconds = parts
+    else:
+        hours, (minutes, seconds) = 0, (parts + [0])[:2]
+
+    return ((int(days or 0) * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+# Slurm time limit from seconds
+def format_slurm_time(seconds):
+    """
+    Function for writing a number of seconds as a Slurm time limit, days-hours:minutes:seconds
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+
+    return f'{days}-{hours:02d}:{minutes:02d}:{seconds:02d}'
+
+
 if __name__ == "__main__":
 
     # Read in desired run
-    run_name = str(sys.argv[1])
+    parser = argparse.ArgumentParser(description='Create the job scripts and explicit list of tasks for a run')
+    parser.add_argument('run_name', type=str, help='name of your experiment directory')
+    parser.add_argument('--preflight', type=str, choices=['flag', 'drop', 'off'], default='flag',
+                        help='check the input data of every task before any jobs are submitted, and either flag or '
+                             'drop tasks that would fail (default flag)')
+    parser.add_argument('--stack-ensembles', action='store_const', dest='stack_ensembles', const=True, default=False,
+                        help='run all ensemble members of the same ESM, variable and scenario in one task, sharing the '
+                             'observational reference data between them')
+    parser.add_argument('--tiles', type=int, default=1,
+                        help='split each task into this many latitude bands, run as separate tasks and put back '
+                             'together by mosaic.job (default 1, not split)')
+    args = parser.parse_args()
+    if args.tiles < 1:
+        sys.exit('--tiles must be at least 1')
+    run_name = args.run_name
 
     # Define paths
     input_files_path = 'input'
@@ -49,11 +104,13 @@ if __name__ == "__main__":
     monthly = remove_nas(run_manager_df['monthly'].values)
     stitched = remove_nas(run_manager_df['stitched'].values)
 
-    # If you want to use BASD for tasmin or tasmax, need to use tas, tasrange and tasskew to do so indirectly
-    # So here we make sure to have those variables present when tasmax and/or tasmin is present,
-    # and remove the direct tasmin/tasmax calls. We will create these later from the results
-    if ('tasmax' in variables) or ('tasmin' in variables):
-        variables = np.union1d(np.setdiff1d(variables, ['tasmax', 'tasmin']), ['tas', 'tasrange', 'tasskew'])
+    # Some variables are created from the BASD output of others (see utils.DERIVED_OUTPUTS), ex. tasmin and tasmax
+    # from tas, tasrange and tasskew, or prsn from pr and prsnratio. So here we make sure to have those variables
+    # present, and remove the direct calls. We will create these later from the results
+    derived_outputs = [x for x in variables if x in utils.DERIVED_OUTPUTS]
+    if derived_outputs:
+        variables = np.union1d(np.setdiff1d(variables, derived_outputs),
+                               [y for x in derived_outputs for y in utils.DERIVED_OUTPUTS[x]['inputs']])
 
     # If no ensembles given (this happens when we're using STITCHED data)
     if len(ensembles) == 0:
@@ -92,14 +149,41 @@ if __name__ == "__main__":
     mesh_df['daily'] = daily[0]
     mesh_df['monthly'] = monthly[0]
     mesh_df['stitched'] = stitched[0]
+    # Every task is run for each region, if any are given, instead of the whole globe
+    if 'Region' in run_manager_df and len(remove_nas(run_manager_df['Region'].values)) > 0:
+        region_columns = [x for x in ['Region', 'Region_Bounds', 'Region_Mask'] if x in run_manager_df]
+        mesh_df = mesh_df.merge(run_manager_df[region_columns].dropna(subset=['Region']), how='cross')
 
 
     # Make new directory if not already created
     os.makedirs(os.path.join(intermediate_path, run_name), exist_ok=True)
 
+    # Split each task into latitude bands, which mosaic.py puts back together
+    if args.tiles > 1:
+        mesh_df = mesh_df.loc[mesh_df.index.repeat(args.tiles)].reset_index(drop=True)
+        mesh_df['tile'] = np.tile(np.arange(args.tiles), mesh_df.shape[0] // args.tiles)
+        mesh_df['n_tiles'] = args.tiles
+
+    # Group ensemble members which only differ by Ensemble into one task
+    if args.stack_ensembles and 'Ensemble' in mesh_df:
+        mesh_df['task_id'] = mesh_df.groupby([x for x in mesh_df.columns if x != 'Ensemble'], sort=False, dropna=False).ngroup()
+
+    # Check input data of each task, flagging or dropping those that would fail. Run on the final rows, so the
+    # report has the task ids of the run plan and the slurm array
+    mesh_df = preflight.run_preflight(run_name, mesh_df, args.preflight)
+    if mesh_df.shape[0] == 0:
+        sys.exit('No tasks left to run after the preflight checks, see preflight_report.csv')
+    n_tasks = mesh_df['task_id'].max() + 1 if 'task_id' in mesh_df else mesh_df.shape[0]
+
     # Save dataframe of every run to csv
     mesh_df.to_csv(os.path.join(intermediate_path, run_name, f'run_manager_explicit_list.csv'), index=False)
 
+    # Compile every task's settings into the run plan, checking the input files for mistakes before any jobs run
+    try:
+        plan.compile_plan(run_name, mesh_df)
+    except ValueError as e:
+        sys.exit(str(e))
+
     # Read in parameters relating to slurm
     slurm_params = pd.read_csv(os.path.join(input_files_path, run_name, 'slurm_parameters.csv'))
     account = slurm_params[slurm_params['parameter'] == 'account']['value'].values[0]
@@ -109,6 +193,13 @@ if __name__ == "__main__":
     email = slurm_params[slurm_params['parameter'] == 'email']['value'].values[0]
     mail_type = slurm_params[slurm_params['parameter'] == 'mail-type']['value'].values[0]
     conda_env = slurm_params[slurm_params['parameter'] == 'conda_env']['value'].values[0]
+    # The daemon job runs every task one after another, given its own time limit (daemon_time), or the time limit of
+    # one task for each task
+    daemon_time = slurm_params[slurm_params['parameter'] == 'daemon_time']['value'].values
+    if len(daemon_time) > 0 and pd.notna(daemon_time[0]):
+        daemon_time = daemon_time[0]
+    else:
+        daemon_time = format_slurm_time(parse_slurm_time(time) * n_tasks)
 
     # Create bash file for submitting all BASD jobs to slurm
     with open(os.path.join(intermediate_path, run_name, 'basd.job'), 'w') as job_file:
@@ -121,7 +212,7 @@ if __name__ == "__main__":
         job_file.writelines(f"#SBATCH --mail-type={mail_type}\n")
         job_file.writelines(f"#SBATCH --mail-user={email}\n")
         job_file.writelines(f"#SBATCH --output=.out/{run_name}_BASD_%A_%a.out\n")
-        job_file.writelines(f"#SBATCH --array=0-{mesh_df.shape[0]-1}%{max_concurrent}\n\n\n")
+        job_file.writelines(f"#SBATCH --array=0-{n_tasks-1}%{max_concurrent}\n\n\n")
         job_file.writelines('# Load Modules\n')
         job_file.writelines('module load gcc/11.2.0\n')
         job_file.writelines('module load python/miniconda3.9\n')
@@ -137,6 +228,55 @@ if __name__ == "__main__":
         job_file.writelines('runtime=$( echo "($end - $start) / 60" | bc -l )\n')
         job_file.writelines('echo "Run completed in $runtime minutes"\n')
 
+    # Create bash file for running all BASD jobs in one allocation, through a daemon which keeps Python and Dask
+    # running between tasks instead of starting them for every task
+    with open(os.path.join(intermediate_path, run_name, 'basd_daemon.job'), 'w') as job_file:
+        job_file.writelines(f"#!/bin/bash\n\n\n")
+        job_file.writelines('# Slurm Settings\n')
+        job_file.writelines(f"#SBATCH --account={account}\n")
+        job_file.writelines(f"#SBATCH --partition={partition}\n")
+        job_file.writelines(f"#SBATCH --job-name={run_name}_BASD_daemon.job\n")
+        job_file.writelines(f"#SBATCH --time={daemon_time}\n")
+        job_file.writelines(f"#SBATCH --mail-type={mail_type}\n")
+        job_file.writelines(f"#SBATCH --mail-user={email}\n")
+        job_file.writelines(f"#SBATCH --output=.out/{run_name}_BASD_daemon_%j.out\n\n\n")
+        job_file.writelines('# Load Modules\n')
+        job_file.writelines('module load gcc/11.2.0\n')
+        job_file.writelines('module load python/miniconda3.9\n')
+        job_file.writelines('source /share/apps/python/miniconda3.9/etc/profile.d/conda.sh\n\n')
+        job_file.writelines('# activate conda environment\n')
+        job_file.writelines(f'conda activate {conda_env}\n\n')
+        job_file.writelines('# Timing\n')
+        job_file.writelines('start=`date +%s.%N`\n\n')
+        job_file.writelines('# Start the daemon, and wait until it is ready\n')
+        job_file.writelines(f"python code/python/daemon.py {run_name} &\n")
+        job_file.writelines(f"python code/python/daemon.py {run_name} --wait\n\n")
+        job_file.writelines('# Run each task through the daemon, carrying on past failed tasks and recording them\n')
+        job_file.writelines('failed_tasks=()\n')
+        job_file.writelines(f"for task_id in $(seq 0 {n_tasks-1}); do\n")
+        job_file.writelines(f"    python code/python/main.py $task_id {run_name} --daemon\n")
+        job_file.writelines('    if [ $? -ne 0 ]; then\n')
+        job_file.writelines('        echo "Task $task_id failed"\n')
+        job_file.writelines('        failed_tasks+=($task_id)\n')
+        job_file.writelines('    fi\n')
+        job_file.writelines('done\n\n')
+        if args.tiles > 1:
+            job_file.writelines('# Join the tiles of each task\n')
+            job_file.writelines(f"python code/python/mosaic.py {run_name} || failed_tasks+=(mosaic)\n\n")
+        job_file.writelines('# Stop the daemon\n')
+        job_file.writelines(f"python code/python/daemon.py {run_name} --stop\n")
+        job_file.writelines('wait\n\n')
+        job_file.writelines('# End timing and print runtime\n')
+        job_file.writelines('end=`date +%s.$N`\n')
+        job_file.writelines('runtime=$( echo "($end - $start) / 60" | bc -l )\n')
+        job_file.writelines('echo "Run completed in $runtime minutes"\n\n')
+        job_file.writelines('# Record the failed tasks (and mosaic step), and fail the job if there are any\n')
+        job_file.writelines(f"echo \"${{failed_tasks[@]}}\" > {intermediate_path}/{run_name}/daemon_failed_tasks.txt\n")
+        job_file.writelines('if [ ${#failed_tasks[@]} -gt 0 ]; then\n')
+        job_file.writelines('    echo "Failed tasks: ${failed_tasks[@]}"\n')
+        job_file.writelines('    exit 1\n')
+        job_file.writelines('fi\n')
+
     # Create bash file for generating tasrange and tasskew files
     with open(os.path.join(intermediate_path, run_name, 'tasrange_tasskew.job'), 'w') as job_file:
         job_file.writelines(f"#!/bin/bash\n\n\n")
@@ -184,6 +324,8 @@ if __name__ == "__main__":
         job_file.writelines('start=`date +%s.%N`\n\n')
         job_file.writelines('# Run script\n')
         job_file.writelines(f"python code/python/create_tasmin_tasmax.py {run_name}\n\n")
+        job_file.writelines('# Remove the reference period data cached by the BASD tasks\n')
+        job_file.writelines(f"rm -rf intermediate/{run_name}/reference_cache\n\n")
         job_file.writelines('# End timing and print runtime\n')
         job_file.writelines('end=`date +%s.$N`\n')
         job_file.writelines('runtime=$( echo "($end - $start) / 60" | bc -l )\n')
@@ -213,18 +355,25 @@ if __name__ == "__main__":
         job_file.writelines('# Timing\n')
         job_file.writelines('start=`date +%s.%N`\n\n')
 
+        basd_dependency = ''
         if stitched:
             job_file.writelines('# Run STITCHED data generation script\n')
             job_file.writelines(f"stitch_id=$(sbatch --parsable intermediate/{run_name}/stitch.job)\n\n")
+            basd_dependency = ' --dependency=afterok:$stitch_id'
 
+        # tasrange and tasskew are computed from tas, tasmin and tasmax as the tasks read them, apart from Pangeo
+        # data, which is downloaded one variable at a time, so they are only created beforehand for Pangeo tasks
+        if (mesh_df['ESM_Input_Location'].isna() & mesh_df['Variable'].isin(['tasrange', 'tasskew'])).any():
             job_file.writelines('# Run tasrange and tasskew creation job\n')
-            job_file.writelines(f"range_skew_id=$(sbatch --parsable --dependency=afterok:$stitch_id intermediate/{run_name}/tasrange_tasskew.job)\n\n")            
-        else:
-            job_file.writelines('# Run tasrange and tasskew creation job\n')
-            job_file.writelines(f"range_skew_id=$(sbatch --parsable intermediate/{run_name}/tasrange_tasskew.job)\n\n")
+            job_file.writelines(f"range_skew_id=$(sbatch --parsable{basd_dependency} intermediate/{run_name}/tasrange_tasskew.job)\n\n")
+            basd_dependency = ' --dependency=afterok:$range_skew_id'
 
         job_file.writelines('# Run bias adjustment and downscaling\n')
-        job_file.writelines(f"basd_id=$(sbatch --parsable --dependency=afterok:$range_skew_id intermediate/{run_name}/basd.job)\n\n")
+        job_file.writelines(f"basd_id=$(sbatch --parsable{basd_dependency} intermediate/{run_name}/basd.job)\n\n")
+
+        if args.tiles > 1:
+            job_file.writelines('# Join the tiles of each task\n')
+            job_file.writelines(f"basd_id=$(sbatch --parsable --dependency=afterok:$basd_id intermediate/{run_name}/mosaic.job)\n\n")
 
         job_file.writelines('# Run tasmin and tasmax creation job\n')
         job_file.writelines(f"min_max_id=$(sbatch --parsable --dependency=afterok:$basd_id intermediate/{run_name}/tasmin_tasmax.job)\n\n")
@@ -234,6 +383,33 @@ if __name__ == "__main__":
         job_file.writelines('runtime=$( echo "($end - $start) / 60" | bc -l )\n')
         job_file.writelines('echo "Run completed in $runtime minutes"\n')
 
+    # Create bash file for joining the tiles of each task
+    if args.tiles > 1:
+        with open(os.path.join(intermediate_path, run_name, 'mosaic.job'), 'w') as job_file:
+            job_file.writelines(f"#!/bin/bash\n\n\n")
+            job_file.writelines('# Slurm Settings\n')
+            job_file.writelines(f"#SBATCH --account={account}\n")
+            job_file.writelines(f"#SBATCH --partition={partition}\n")
+            job_file.writelines(f"#SBATCH --job-name={run_name}_mosaic.job\n")
+            job_file.writelines(f"#SBATCH --time={time}\n")
+            job_file.writelines(f"#SBATCH --mail-type={mail_type}\n")
+            job_file.writelines(f"#SBATCH --mail-user={email}\n")
+            job_file.writelines(f"#SBATCH --output=.out/{run_name}_mosaic.out\n\n\n")
+            job_file.writelines('# Load Modules\n')
+            job_file.writelines('module load gcc/11.2.0\n')
+            job_file.writelines('module load python/miniconda3.9\n')
+            job_file.writelines('source /share/apps/python/miniconda3.9/etc/profile.d/conda.sh\n\n')
+            job_file.writelines('# activate conda environment\n')
+            job_file.writelines(f'conda activate {conda_env}\n\n')
+            job_file.writelines('# Timing\n')
+            job_file.writelines('start=`date +%s.%N`\n\n')
+            job_file.writelines('# Run script\n')
+            job_file.writelines(f"python code/python/mosaic.py {run_name}\n\n")
+            job_file.writelines('# End timing and print runtime\n')
+            job_file.writelines('end=`date +%s.$N`\n')
+            job_file.writelines('runtime=$( echo "($end - $start) / 60" | bc -l )\n')
+            job_file.writelines('echo "Run completed in $runtime minutes"\n')
+
     # Create bash file for generating STITCHED data
     if stitched:
         with open(os.path.join(intermediate_path, run_name, 'stitch.job'), 'w') as job_file:
@@ -1,111 +1,218 @@
 """
-This file manages which scripts are used for each job
+This file manages which scripts are used for each job. Tasks are either run here, or with the --daemon flag, sent
+to a BASD daemon already running on this node (see daemon.py), which saves starting Python, importing packages and
+starting Dask for every task.
 """
 
-from pangeo import basd_pangeo
-from downloaded import basd_downloaded
-from stitched import basd_stitches
-
+import contextlib
+import copy
 import os
+import shutil
 import socket
 import sys
+import traceback
+import warnings
 
 import argparse
-import dask
-from dask.distributed import (Client, LocalCluster)
-import numpy as np
-import pandas as pd
-import warnings
 
-if __name__ == "__main__":
-
-    # Set high recursion limit so Dask is able to do things like find size of objects
-    # sys.setrecursionlimit(3000)
+import daemon
+import plan
 
 # Paths =======================================================================================================
-    intermediate_path = 'intermediate'
-    input_path = 'input'
+intermediate_path = 'intermediate'
+input_path = 'input'
 
-# Get Run Details =============================================================================================
 
-    parser = argparse.ArgumentParser(description='Process some integers.')
-    parser.add_argument('task_id', type=int, help='The number of the current task (row of the run_manager_explicit_list.csv file)')
-    parser.add_argument('run_name', type=str, help='name of your experiment directory')
-    parser.add_argument('--warn', action='store_const', dest='warn',
-                        const=True, default=False,
-                        help='flag to print warnings in log .out file')
-    args = parser.parse_args()
+# Set Dask config for a run, must be done before the Dask cluster is started
+def configure_dask(run_name, warn=False, sub_dir=None):
+    """
+    Function for reading the Dask settings of a run from its plan and setting the Dask config from them. With
+    sub_dir given, Dask's temporary files go in that sub directory of the temporary directory, so that tasks sharing
+    a node don't spill into the same place and each can remove its own when done.
+    """
+    import dask
 
-    # Task index from SLURM array to run specific variable and model combinations
-    task_id = args.task_id
-    # Name of run directory
-    run_name = args.run_name
-    # Extract task details
-    task_details = pd.read_csv(os.path.join(intermediate_path, run_name, 'run_manager_explicit_list.csv')).iloc[task_id]
     # Extract Dask settings
-    dask_settings = pd.read_csv(os.path.join(input_path, run_name, 'dask_parameters.csv')).iloc[0]
+    dask_settings = plan.read_run(run_name)['dask']
 
     # Ignore non-helpful warnings
-    if not args.warn:
+    if not warn:
         dask.config.set({'logging.distributed': 'error'})
         warnings.filterwarnings('ignore')
 
+    # Check to see if a non-default dask temporary directory is requested
+    # If so, set it using dask config
+    if dask_settings.get('dask_temp_directory') is not None:
+        dask_task_directory = dask_settings['dask_temp_directory']
+        if sub_dir is not None:
+            dask_task_directory = os.path.join(dask_task_directory, sub_dir)
+            dask_settings['dask_task_directory'] = dask_task_directory
+        dask.config.set({'temporary_directory': f'{dask_task_directory}'})
+
+    return dask_settings
+
+
+# Run one task on a running Dask cluster
+def run_task(task_id, run_name, client, cluster, dask_settings, save_performance_report=False):
+    """
+    Function for running one task (row of the run_manager_explicit_list.csv file) on the given Dask cluster
+    """
+    # Imported here so that sending a task to the daemon doesn't have to wait for them
+    from dask.distributed import performance_report
+
+    import metrics
+    import supervisor
+    import utils
+
+# Get Run Details =============================================================================================
+
+    # Extract task details, and the task's settings from the run plan
+    task_details = plan.read_task(run_name, task_id)
+    utils.use_task_plan(task_details.plan)
+
 # Check if using Pangeo =======================================================================================
 
+    # Driver script of the task (pangeo, stitched or downloaded)
+    driver = utils.get_driver(task_details)
     # Boolean will be true when no input location is given
-    using_pangeo = pd.isna(task_details.ESM_Input_Location) & ~(task_details.Variable in ['tasrange', 'tasskew'])
+    using_pangeo = driver.__name__ == 'pangeo'
     # Boolean will be true when using STITCHED data
-    using_stitches = task_details.stitched
+    using_stitches = driver.__name__ == 'stitched'
     # When trying to use pangeo for tasrange/tasskew, data will actually be saved in intermediate
-    if pd.isna(task_details.ESM_Input_Location) & (task_details.Variable in ['tasrange', 'tasskew']):
+    if (task_details.ESM_Input_Location is None) and (task_details.Variable in ['tasrange', 'tasskew']):
         task_details.ESM_Input_Location = os.path.join(intermediate_path, run_name, 'tasrange_tasskew')
 
-
-
-    # Check to see if a non-default dask temporary directory is requested
-    # If so, set it using dask config
-    if not pd.isna(dask_settings.dask_temp_directory):
-        dask.config.set({'temporary_directory': f'{dask_settings.dask_temp_directory}'})
-
     # Writing task details to log
     print(f'======================================================', flush=True)
     print(f'Task Details:', flush=True)
     print(f'ESM: {task_details.ESM}', flush=True)
     print(f'Variable: {task_details.Variable}', flush=True)
     print(f'Scenario: {task_details.Scenario}', flush=True)
-    try:
-        print(f'Ensemble Member: {task_details.Ensemble}', flush=True)
-    except AttributeError:
-        pass
+    if getattr(task_details, 'Ensembles', None) is not None:
+        print(f'Ensemble Members: {", ".join(task_details.Ensembles)}', flush=True)
+    else:
+        try:
+            print(f'Ensemble Member: {task_details.Ensemble}', flush=True)
+        except AttributeError:
+            pass
     print(f'Reference Period: {task_details.target_period}', flush=True)
     print(f'Application Period: {task_details.application_period}', flush=True)
     if using_pangeo:
         print('Getting Data From Pangeo', flush=True)
     elif using_stitches:
         print('Using STITCHED Data', flush=True)
-    else: 
+    else:
         print(f'Retrieving Data From {task_details.Reference_Input_Location}', flush=True)
     print(f'======================================================')
 
-    with LocalCluster(processes=True, threads_per_worker=1) as cluster, Client(cluster) as client:
-        # Setting up dask.Client so that I can ssh into the dashboard
-        port = client.scheduler_info()['services']['dashboard']
-        host = client.run_on_scheduler(socket.gethostname)
-        print("If running remotely use the below command to ssh into dashboard from a local terminal session")
-        print(f"ssh -N -L 8000:{host}:{port} <username>@<remote name>", flush=True)
-        print("Then use a browser to visit localhost:8000/ to view the dashboard.")
-        print("If running locally, just visit the below link")
-        print({client.dashboard_link})
-
-        if using_pangeo:
-            # Run pangeo script
-            basd_pangeo(task_details, run_name)
-        elif using_stitches:
-            # Run stitches script
-            basd_stitches(task_details, run_name)
-        else:
-            # Run downloaded data script
-            basd_downloaded(task_details, run_name)
-
-        client.close()
-        cluster.close()
+    # Setting up dask.Client so that I can ssh into the dashboard
+    port = client.scheduler_info()['services']['dashboard']
+    host = client.run_on_scheduler(socket.gethostname)
+    print("If running remotely use the below command to ssh into dashboard from a local terminal session")
+    print(f"ssh -N -L 8000:{host}:{port} <username>@<remote name>", flush=True)
+    print("Then use a browser to visit localhost:8000/ to view the dashboard.")
+    print("If running locally, just visit the below link")
+    print({client.dashboard_link})
+
+    # Record timing and memory of each step of the task
+    metrics_dir = os.path.join(intermediate_path, run_name, 'metrics')
+    metrics.start_task(task_id, run_name, task_details, client, metrics_dir)
+    # Retry steps with smaller chunks / fewer workers if workers run out of memory
+    supervisor.start(client, cluster, run_name, task_details, dask_settings.get('max_retries'))
+    if save_performance_report:
+        report = performance_report(filename=os.path.join(metrics_dir, f'task_{task_id}_performance_report.html'))
+    else:
+        report = contextlib.nullcontext()
+
+    if using_pangeo:
+        # Run pangeo script
+        basd_function = driver.basd_pangeo
+    elif using_stitches:
+        # Run stitches script
+        basd_function = driver.basd_stitches
+    else:
+        # Run downloaded data script
+        basd_function = driver.basd_downloaded
+
+    # Ensemble members stacked into this task are run one after another
+    members = getattr(task_details, 'Ensembles', None) or [getattr(task_details, 'Ensemble', None)]
+    if len(members) > 1:
+        metrics.record(ensemble_members=len(members))
+    # Reference period data also used by other tasks or members is cached, and read from the cache if already there
+    if getattr(task_details, 'reference_cache', False):
+        utils.start_reference_cache(os.path.join(intermediate_path, run_name, 'reference_cache'))
+    # Intermediate and output files are written to node-local scratch, and output files are moved into place when done
+    utils.start_staging(utils.get_scratch_root(dask_settings), f'{run_name}_task_{task_id}')
+    # Warn about data in more precision than it's computed in once per task, also when the daemon runs many tasks
+    utils.promotion_warnings.clear()
+
+    try:
+        with report:
+            failed_members = []
+            for member in members:
+                member_details = copy.copy(task_details)
+                member_details.Ensemble = member
+                try:
+                    basd_function(member_details, run_name)
+                except Exception:
+                    # Carry on with the other members, the task still fails at the end
+                    if len(members) == 1:
+                        raise
+                    print(f'Ensemble member {member} failed:', flush=True)
+                    traceback.print_exc()
+                    failed_members.append(member)
+            if failed_members:
+                raise RuntimeError(f'Ensemble members {", ".join(failed_members)} failed')
+    except BaseException as e:
+        metrics.finish_task('failed', error=repr(e))
+        raise
+    finally:
+        utils.stop_reference_cache()
+        utils.stop_staging()
+        supervisor.stop()
+    metrics.finish_task('completed')
+
+
+if __name__ == "__main__":
+
+    # Set high recursion limit so Dask is able to do things like find size of objects
+    # sys.setrecursionlimit(3000)
+
+    parser = argparse.ArgumentParser(description='Process some integers.')
+    parser.add_argument('task_id', type=int, help='The number of the current task (row of the run_manager_explicit_list.csv file)')
+    parser.add_argument('run_name', type=str, help='name of your experiment directory')
+    parser.add_argument('--warn', action='store_const', dest='warn',
+                        const=True, default=False,
+                        help='flag to print warnings in log .out file')
+    parser.add_argument('--performance-report', action='store_const', dest='performance_report',
+                        const=True, default=False,
+                        help='flag to save a Dask performance report (html) for the task in intermediate/<run_name>/metrics')
+    parser.add_argument('--daemon', action='store_const', dest='daemon',
+                        const=True, default=False,
+                        help='flag to run the task on the BASD daemon running on this node, if there is one')
+    args = parser.parse_args()
+
+    # Task index from SLURM array to run specific variable and model combinations
+    task_id = args.task_id
+    # Name of run directory
+    run_name = args.run_name
+
+    # Send the task to the daemon, and exit with its result
+    if args.daemon:
+        if daemon.is_running(run_name):
+            sys.exit(daemon.submit(task_id, run_name, args.performance_report))
+        print('No BASD daemon running for this run, running the task here', flush=True)
+
+    dask_settings = configure_dask(run_name, args.warn, f'{run_name}_task_{task_id}')
+
+    from dask.distributed import (Client, LocalCluster)
+    try:
+        with LocalCluster(processes=True, threads_per_worker=1) as cluster, Client(cluster) as client:
+            run_task(task_id, run_name, client, cluster, dask_settings, args.performance_report)
+
+            client.close()
+            cluster.close()
+    finally:
+        # Remove Dask's temporary files of this task, also when it failed
+        if dask_settings.get('dask_task_directory') is not None:
+            shutil.rmtree(dask_settings['dask_task_directory'], ignore_errors=True)
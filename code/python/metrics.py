@@ -0,0 +1,271 @@
+"""
+Structured timing and memory metrics for each step of a BASD task. Each step is recorded as one JSON record with
+wall time, peak memory, number of Dask tasks run, bytes spilled to disk by Dask workers, and bytes read and
+written. Records are printed to the task's log (lines starting with METRICS) and appended to
+intermediate/<run_name>/metrics/task_<task_id>.jsonl
+"""
+
+# Importing Needed Libraries
+import contextlib  # Context managers for stages
+import datetime  # Time stamps
+import json  # Writing records
+import os  # For navigating os
+import resource  # Peak memory when /proc isn't available
+import socket  # Host name
+import time  # Timing
+
+# Current task's record, the stages are added to it as they run
+task_record = None
+metrics_file = None
+client = None
+
+
+# Start recording metrics for a task
+def start_task(task_id, run_name, run_object, dask_client, metrics_dir):
+    """
+    Function for starting to record metrics for a task. Must be called before any stages are run for them to be recorded.
+    """
+    global task_record, metrics_file, client
+
+    os.makedirs(metrics_dir, exist_ok=True)
+    metrics_file = os.path.join(metrics_dir, f'task_{task_id}.jsonl')
+    client = dask_client
+
+    # Details of the task to attach to every record
+    task_record = {
+        'run_name': run_name,
+        'task_id': int(task_id),
+        'slurm_job_id': os.environ.get('SLURM_ARRAY_JOB_ID', os.environ.get('SLURM_JOB_ID')),
+        'slurm_array_task_id': os.environ.get('SLURM_ARRAY_TASK_ID'),
+        'host': socket.gethostname(),
+        'ESM': getattr(run_object, 'ESM', None),
+        'Variable': getattr(run_object, 'Variable', None),
+        'Scenario': getattr(run_object, 'Scenario', None),
+        'Ensemble': getattr(run_object, 'Ensemble', None),
+        'start': datetime.datetime.now().isoformat(timespec='seconds'),
+        'start_time': time.perf_counter(),
+        'stages': []
+    }
+
+
+# Record one step of a task
+@contextlib.contextmanager
+def stage(name):
+    """
+    Context manager for recording the metrics of one step of a task. Does nothing if no task has been started.
+    """
+    if task_record is None:
+        yield
+        return
+
+    # Reset peak memory, and take starting counters
+    reset_peak_memory()
+    start_snapshot = get_snapshot()
+    start_time = time.perf_counter()
+
+    # Stages that fail are still recorded, so it's clear where a task stopped
+    status = 'failed'
+    try:
+        yield
+        status = 'completed'
+    finally:
+        # Take ending counters, and record the difference
+        wall_seconds = time.perf_counter() - start_time
+        end_snapshot = get_snapshot()
+        stage_record = get_stage_record(name, wall_seconds, start_snapshot, end_snapshot)
+        task_record['stages'].append(stage_record)
+        write_record(dict(get_task_details(), type='stage', status=status, **stage_record))
+
+
+# Add information to the task record
+def record(**kwargs):
+    """
+    Function for adding extra information to the task record (ex. size of the grid)
+    """
+    if task_record is not None:
+        task_record.update(kwargs)
+
+
+# Add to counts in the task record
+def add(**kwargs):
+    """
+    Function for adding to counts in the task record (ex. grid cell days downscaled), summed over the ensemble members
+    and parameter configurations of a task
+    """
+    if task_record is not None:
+        for key, value in kwargs.items():
+            task_record[key] = task_record.get(key, 0) + value
+
+
+# Stages recorded so far
+def get_stages():
+    """
+    Function for getting the records of the stages of the current task run so far
+    """
+    if task_record is None:
+        return []
+
+    return task_record['stages']
+
+
+# Finish recording metrics for a task, and write the summary
+def finish_task(status='completed', error=None):
+    """
+    Function for writing the summary record of a task, with the totals over all its stages
+    """
+    global task_record
+
+    if task_record is None:
+        return
+
+    # Total time in each stage, some stages (ex. cleanup) run more than once
+    stages = task_record['stages']
+    stage_seconds = {}
+    for stage_record in stages:
+        stage_seconds[stage_record['stage']] = stage_seconds.get(stage_record['stage'], 0) + stage_record['wall_seconds']
+
+    summary = dict(
+        get_task_details(), type='task', status=status, error=error,
+        end=datetime.datetime.now().isoformat(timespec='seconds'),
+        wall_seconds=time.perf_counter() - task_record['start_time'],
+        peak_rss_mb=max([x['peak_rss_mb'] for x in stages], default=None),
+        worker_peak_rss_mb=max([x['worker_peak_rss_mb'] for x in stages if x['worker_peak_rss_mb'] is not None], default=None),
+        dask_tasks=sum([x['dask_tasks'] for x in stages]),
+        spilled_bytes=sum([x['spilled_bytes'] for x in stages]),
+        read_bytes=sum([x['read_bytes'] for x in stages]),
+        written_bytes=sum([x['written_bytes'] for x in stages]),
+        stage_seconds=stage_seconds
+    )
+    write_record(summary)
+
+    task_record = None
+
+
+# Details of the task included in each record
+def get_task_details():
+    """
+    Function for getting the details of the current task to include in a record
+    """
+    return {key: value for key, value in task_record.items() if key not in ['stages', 'start_time']}
+
+
+# Write a record to the log and metrics file
+def write_record(metrics_record):
+    """
+    Function for printing a record to the log and appending it to the task's metrics file
+    """
+    line = json.dumps(metrics_record, default=str)
+    print(f'METRICS {line}', flush=True)
+    with open(metrics_file, 'a') as file:
+        file.write(line + '\n')
+
+
+# Compute the stage record from the snapshots at the start and end of the stage
+def get_stage_record(name, wall_seconds, start_snapshot, end_snapshot):
+    """
+    Function for getting a stage's metrics from the counters taken at its start and end
+    """
+    # Workers present at the end of the stage. Workers that were restarted have their counters
+    # reset, so differences are never allowed to be negative.
+    workers = end_snapshot['workers']
+    start_workers = start_snapshot['workers']
+    def worker_difference(key):
+        return sum([max(workers[x][key] - start_workers.get(x, {}).get(key, 0), 0) for x in workers])
+
+    main_start, main_end = start_snapshot['main'], end_snapshot['main']
+
+    return {
+        'stage': name,
+        'wall_seconds': wall_seconds,
+        'peak_rss_mb': main_end['peak_rss_mb'],
+        'worker_peak_rss_mb': max([x['peak_rss_mb'] for x in workers.values()], default=None),
+        'n_workers': len(workers),
+        'dask_tasks': worker_difference('tasks'),
+        'spilled_bytes': worker_difference('spilled_bytes'),
+        'read_bytes': max(main_end['read_bytes'] - main_start['read_bytes'], 0) + worker_difference('read_bytes'),
+        'written_bytes': max(main_end['written_bytes'] - main_start['written_bytes'], 0) + worker_difference('written_bytes')
+    }
+
+
+# Counters for this process and each Dask worker
+def get_snapshot():
+    """
+    Function for getting the counters of this process and of each Dask worker
+    """
+    workers = {}
+    if client is not None:
+        try:
+            workers = client.run(get_worker_counters)
+        except Exception:
+            workers = {}
+
+    return {'main': get_process_counters(), 'workers': workers}
+
+
+# Counters of the current process
+def get_process_counters():
+    """
+    Function for getting the peak memory (MB), and bytes read and written to storage of the current process
+    """
+    counters = {'peak_rss_mb': None, 'read_bytes': 0, 'written_bytes': 0}
+
+    # Peak memory since the last reset
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    counters['peak_rss_mb'] = int(line.split()[1]) / 1024
+    except OSError:
+        counters['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    # Bytes actually read and written to storage
+    try:
+        with open('/proc/self/io') as io:
+            for line in io:
+                key, value = line.split(':')
+                if key == 'read_bytes':
+                    counters['read_bytes'] = int(value)
+                elif key == 'write_bytes':
+                    counters['written_bytes'] = int(value)
+    except OSError:
+        pass
+
+    return counters
+
+
+# Counters of a Dask worker
+def get_worker_counters(dask_worker=None):
+    """
+    Function run on each Dask worker, getting the process counters along with the number of tasks run and
+    bytes spilled to disk
+    """
+    counters = get_process_counters()
+    counters['tasks'] = getattr(dask_worker.state, 'executed_count', 0)
+    counters['spilled_bytes'] = sum([value for key, value in getattr(dask_worker, 'digests_total', {}).items()
+                                     if isinstance(key, tuple) and key[-2:] == ('disk-write', 'bytes')])
+
+    return counters
+
+
+# Reset peak memory so each stage gets its own peak
+def reset_peak_memory():
+    """
+    Function for resetting the peak memory (VmHWM) of this process and of each Dask worker (Linux only)
+    """
+    reset_process_peak_memory()
+    if client is not None:
+        try:
+            client.run(reset_process_peak_memory)
+        except Exception:
+            pass
+
+
+def reset_process_peak_memory():
+    """
+    Resets the peak memory of the current process, if possible
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
@@ -0,0 +1,160 @@
+"""
+Puts together the latitude bands of tasks split into tiles by job-script-generation.py --tiles. Each tile writes its
+bias adjusted and downscaled output, including a halo of neighbouring cells, to a tiles directory next to the usual
+output. Once every tile of a task is done, the halos are cut off and the tiles are joined along latitude into the
+usual output files, and the tile files are removed.
+Run with:
+    python code/python/mosaic.py <run_name>
+"""
+
+# Import Libraries
+import argparse
+import copy
+import itertools
+import os
+import sys
+
+import dask
+import xarray as xr
+
+import compression
+import plan
+import qa
+import utils
+
+# Paths
+INPUT_PATH = 'input'
+
+
+# Output files of a task
+def get_output_files(driver, task, tile=None):
+    """
+    Function for getting the paths of the daily and monthly bias adjusted and downscaled files of a task, as
+    {(step, frequency): path}. With tile given, the files of that tile, otherwise the files of the whole task.
+    """
+    task = copy.copy(task)
+    if tile is None:
+        task.n_tiles = 1
+    else:
+        task.tile = tile
+    driver.set_names(task)
+
+    return {('ba', 'daily'): os.path.join(driver.output_ba_path, driver.output_day_ba_file_name),
+            ('ba', 'monthly'): os.path.join(driver.output_ba_path, driver.output_mon_ba_file_name),
+            ('basd', 'daily'): os.path.join(driver.output_basd_path, driver.output_day_basd_file_name),
+            ('basd', 'monthly'): os.path.join(driver.output_basd_path, driver.output_mon_basd_file_name)}
+
+
+# Put together the tiles of one task
+def mosaic_task(task, run_name):
+    """
+    Function for joining the output of every tile of a task (the record of its first tile), for each ensemble member
+    and parameter configuration
+    """
+    input_path = os.path.join(INPUT_PATH, run_name)
+    utils.use_task_plan(task.plan)
+
+    # Encoding of the output, as used by the tasks
+    encoding, reset_chunksizes = utils.get_encoding(input_path)
+    if encoding.get('compression') == 'auto':
+        encoding = compression.choose_codec(encoding, None, run_name, task.Variable)
+    variable_attributes = utils.get_attributes(task.Variable, input_path)[0]
+    encoding, variable_attributes = utils.set_precision(encoding, variable_attributes)
+
+    # Each ensemble member, and configuration of a parameter sweep, has its own tiles
+    members = getattr(task, 'Ensembles', None) or [getattr(task, 'Ensemble', None)]
+    for member, config_id in itertools.product(members, utils.get_config_ids(task, input_path)):
+        member_task = copy.copy(task)
+        member_task.Ensemble = member
+        member_task.config_id = config_id
+        driver = utils.get_driver(member_task)
+        # Bounds of the output, for its quality statistics
+        bounds = qa.get_bounds(task.Variable, utils.get_parameters(member_task, input_path))
+        tile_files = [get_output_files(driver, member_task, tile) for tile in range(task.n_tiles)]
+        output_files = get_output_files(driver, member_task)
+
+        for frequency in ['daily', 'monthly']:
+            # Daily tiles aren't written by the tasks if daily data isn't wanted
+            if not getattr(task, frequency):
+                continue
+            ba_tiles = [x[('ba', frequency)] for x in tile_files]
+            basd_tiles = [x[('basd', frequency)] for x in tile_files]
+            missing_tiles = [x for x in ba_tiles + basd_tiles if not os.path.exists(x)]
+            if missing_tiles:
+                raise FileNotFoundError(f'Tiles not found: {", ".join(missing_tiles)}')
+
+            # Fine grid cells in each coarse cell of each tile, for the size of the downscaled halos
+            ratios = []
+            for ba_tile, basd_tile in zip(ba_tiles, basd_tiles):
+                with xr.open_dataset(ba_tile) as ba_data, xr.open_dataset(basd_tile) as basd_data:
+                    ratios.append(basd_data.sizes['lat'] // ba_data.sizes['lat'])
+
+            print(f'Joining {len(ba_tiles)} tiles of {os.path.basename(output_files[("basd", frequency)])}', flush=True)
+            mosaic_files(ba_tiles, output_files[('ba', frequency)], task.Variable, [1] * len(ba_tiles),
+                         encoding, reset_chunksizes, bounds)
+            mosaic_files(basd_tiles, output_files[('basd', frequency)], task.Variable, ratios,
+                         encoding, reset_chunksizes, bounds)
+
+            # Copy of the daily downscaled output for reading time series, if encoding.csv asks for one
+            if encoding.get('timeseries_copy') and frequency == 'daily':
+                basd_file = output_files[('basd', 'daily')]
+                utils.write_timeseries_copy(
+                    basd_file,
+                    os.path.join(os.path.dirname(os.path.dirname(basd_file)), 'basd_timeseries',
+                                 os.path.basename(basd_file)),
+                    task.Variable, encoding
+                )
+
+            for tile_file in ba_tiles + basd_tiles:
+                os.remove(tile_file)
+
+
+# Join the tiles of one file
+def mosaic_files(tile_files, output_file, variable, ratios, encoding, reset_chunksizes, bounds=(None, None)):
+    """
+    Function for cutting the halo off each tile (file), with ratios giving the rows of the tile's grid in each
+    coarse cell, and joining them along latitude into output_file. The file is written next to output_file and
+    then moved into place, so a failed write doesn't leave a partial output file. Its quality statistics (see
+    qa.py), with the lower and upper bounds given, are computed as it's written.
+    """
+    tiles = []
+    for tile, (tile_file, ratio) in enumerate(zip(tile_files, ratios)):
+        data = xr.open_dataset(tile_file, chunks={})
+        halo_start, halo_end = utils.get_tile_halo(tile, len(tile_files), ratio)
+        tiles.append(data.isel(lat=slice(halo_start, data.sizes['lat'] - halo_end)))
+
+    mosaic = xr.concat(tiles, dim='lat', data_vars='minimal', coords='minimal', compat='override',
+                       combine_attrs='override')
+    mosaic = mosaic.transpose('time', 'lat', 'lon', ...)
+    output_encoding = utils.get_output_encoding(encoding, reset_chunksizes, mosaic.sizes)
+
+    temp_file = f'{output_file}.{os.getpid()}.tmp'
+    write = mosaic.to_netcdf(temp_file, encoding={variable: output_encoding}, compute=False)
+    _, stats = dask.compute(write, qa.get_stats(mosaic[variable], *bounds))
+    for data in tiles:
+        data.close()
+    os.replace(temp_file, output_file)
+    qa.save_stats(stats, output_file, variable, *bounds)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Join the tiles of tasks split with job-script-generation.py --tiles')
+    parser.add_argument('run_name', type=str, help='name of your experiment directory')
+    args = parser.parse_args()
+    run_name = args.run_name
+
+    # The first tile of each tiled task stands for the task
+    failed_tasks = []
+    for task_id in range(plan.read_run(run_name)['n_tasks']):
+        task = plan.read_task(run_name, task_id)
+        if not utils.is_tiled(task) or task.tile != 0:
+            continue
+        try:
+            mosaic_task(task, run_name)
+        except Exception as e:
+            print(f'Could not join the tiles of {task.ESM} {task.Variable} {task.Scenario}: {e}', flush=True)
+            failed_tasks.append(task_id)
+
+    if failed_tasks:
+        sys.exit(f'Joining tiles failed for tasks {", ".join([str(x) for x in failed_tasks])}')
@@ -5,20 +5,15 @@ This script will be used for BASD for data hosted on Pangeo
 # Importing Needed Libraries
 import os  # For navigating os
 import shutil  # Running system commands
-import socket  # Running on cluster
 import sys  # Getting system details
-from datetime import datetime  # Manipulate temporal data
 
-import basd  # Bias adjustment and statistical downscaling
-import dask  # Setting Dask config
 import fsspec  # Used semi-secretly in pangeo
 import intake  # Used semi-secretly in pangeo
-import numpy as np  # Numerical / array functions
-import pandas as pd  # Data functions
+import metrics  # Timing and memory metrics
+import pipeline  # Bias adjustment and downscaling of a task
 import utils  # Utility functions script
 import xarray as xr  # Reading and manipulating NetCDF data
-from dask.distributed import (Client, LocalCluster,  # Using Dask in parallel
-                              progress)
+from dask.distributed import progress  # Showing download progress
 
 # CONSTANTS
 INPUT_PATH = 'input'
@@ -34,7 +29,10 @@ output_day_basd_file_name = None
 output_mon_basd_file_name = None
 input_ref_data_path = None
 
-# Chunk sizes (constants to be set)
+# Bounding box of the task's region, widened to whole ESM grid cells (None for global tasks)
+region_bounds = None
+
+# Chunk sizes (set by pipeline.run_basd)
 time_chunk = None
 lat_chunk = None
 lon_chunk = None
@@ -45,7 +43,8 @@ def basd_pangeo(run_object, run_name):
     Function to manage steps for running bias adjustment and downscaling using data accessed from Pangeo.
     """
     # 1. Name output files and paths
-    set_names(run_object)
+    with metrics.stage('set_names'):
+        set_names(run_object)
 
     # 2. Try to make directories if they don't already exist
     create_directories()
@@ -54,160 +53,110 @@ def basd_pangeo(run_object, run_name):
     # TODO: Alternate behavior for tasmin and tasmax
     reference_url, application_url = get_pangeo_urls(run_object)
 
-    # 4. Get and extract parameters
-    params = utils.get_parameters(run_object, os.path.join(INPUT_PATH, run_name))
-
-    # 5. Read encoding settings
-    encoding, reset_chunksizes = utils.get_encoding(os.path.join(INPUT_PATH, run_name))
-
-    # 6. Read attributes
-    variable_attributes, global_monthly_attributes, global_daily_attributes = utils.get_attributes(run_object.Variable, os.path.join(INPUT_PATH, run_name))
-
-    # 7. Read Dask settings
-    global time_chunk, lat_chunk, lon_chunk
-    time_chunk, lat_chunk, lon_chunk, dask_temp_directory = utils.get_chunk_sizes(os.path.join(INPUT_PATH, run_name))
-
-    # 8. Get Data
     # Download data from pangeo
-    try:
-        download_data(reference_url, application_url)
-    except:
-        print("Something went wrong trying to download data from Pangeo")
-        exit()
-
-    # Load in data over the given periods
-    obs_reference_data, sim_reference_data, sim_application_data = load_ba_data(run_object)
+    def download_task_data(task):
+        try:
+            download_data(reference_url, application_url, task)
+        except:
+            print("Something went wrong trying to download data from Pangeo")
+            exit()
 
-    # Reset Chunk sizes
-    if reset_chunksizes:
-        encoding['chunksizes'] = utils.reset_chunk_sizes(encoding['chunksizes'], sim_application_data.dims)
+    # 4. Bias adjust and downscale the downloaded data, for each configuration of basd parameters
+    pipeline.run_basd(sys.modules[__name__], run_object, run_name, lambda task: load_ba_data(task, reference_url),
+                      download_task_data)
 
-    # Use global path/file names
-    global temp_intermediate_dir, output_ba_path, output_basd_path
-    global output_day_ba_file_name, output_mon_ba_file_name, output_day_basd_file_name, output_mon_basd_file_name
-    global input_ref_data_path
-
-    # 9. Run Bias Adjustment
-    # Initializing Bias Adjustment
-    ba = basd.init_bias_adjustment(
-        obs_reference_data, sim_reference_data, sim_application_data,
-        run_object.Variable, params,
-        lat_chunk_size=lat_chunk, lon_chunk_size=lon_chunk,
-        temp_path=temp_intermediate_dir, periodic=True
-    )
-
-    # Do / don't save monthly data
-    if ~run_object.monthly:
-        output_mon_ba_file_name = None
-        output_mon_basd_file_name = None
-
-    # Perform adjustment and save at daily resolution
-    basd.adjust_bias(
-        init_output = ba, output_dir = output_ba_path,
-        day_file = output_day_ba_file_name, month_file = output_mon_ba_file_name,
-        clear_temp = True, encoding={run_object.Variable: encoding},
-        ba_attrs = global_daily_attributes, ba_attrs_mon = global_monthly_attributes, variable_attrs = variable_attributes
-    )
-
-    # Close Bias Adjustment Data
-    obs_reference_data.close()
-    sim_reference_data.close()
-    sim_application_data.close()
-    # Clear temp directories
-    try:
-        shutil.rmtree(temp_download_dir)
-        shutil.rmtree(temp_intermediate_dir)
-    except OSError as e:
-        print("Warning: %s : %s" % (temp_download_dir, e.strerror))
-
-    # Get Data for statistical downscaling
-    obs_reference_data, sim_application_data = utils.load_sd_data(run_object, input_ref_data_path, time_chunk, output_ba_path, output_day_ba_file_name)
-
-    # Reset Chunk sizes
-    if reset_chunksizes:
-        encoding['chunksizes'] = utils.reset_chunk_sizes(encoding['chunksizes'], obs_reference_data.dims)
-
-    # Remove upper bound for rsds for downscaling. Not using scaling to 0-1
-    if run_object.Variable == 'rsds':
-        params.upper_bound = None
-        params.upper_threshold = None
-        params.trend_preservation = None
-
-    # 10. Run downscaling
-    # Initialize downscaling
-    ds = basd.init_downscaling(obs_reference_data, sim_application_data, run_object.Variable, params, temp_path=temp_intermediate_dir)
-
-    # Run downscaling
-    basd.downscale(
-        ds,
-        output_dir = output_basd_path, day_file = output_day_basd_file_name, month_file = output_mon_basd_file_name,
-        encoding={run_object.Variable: encoding}, clear_temp=True,
-        basd_attrs = global_daily_attributes, basd_attrs_mon = global_monthly_attributes, variable_attrs = variable_attributes
-    )
-
-    # Close data
-    obs_reference_data.close()
-    sim_application_data.close()
-
-    # Remove temp dirs and daily data if not wanted
-    try:
-        shutil.rmtree(temp_intermediate_dir)
-    except OSError as e:
-        print("Warning: %s : %s" % (temp_download_dir, e.strerror))
-    if ~run_object.daily:
+    # Remove the downloaded data, used by every configuration
+    with metrics.stage('cleanup'):
         try:
-            os.remove(os.path.join(output_ba_path, output_day_ba_file_name))
-            os.remove(os.path.join(output_basd_path, output_day_basd_file_name))
+            shutil.rmtree(temp_download_dir)
         except OSError as e:
-            print(f"Error removing daily data")
+            print("Warning: %s : %s" % (temp_download_dir, e.strerror))
 
 
 # Load in datasets and trims to reference and application periods, and drops extra variables in the dataset
-def load_ba_data(run_object):
+def load_ba_data(run_object, reference_url):
     """
-    Function that loads in datasets and trims to reference and application periods, and drops extra variables in the dataset
+    Function that loads in datasets and trims to reference and application periods, and drops extra variables in the dataset.
+    reference_url is the Pangeo store of the historical data, naming it in the reference cache.
     """
-    # Open data
-    sim_application_data = xr.open_mfdataset(os.path.join(temp_download_dir, 'sim_application_data.nc'), chunks={'time': time_chunk})
-    sim_reference_data = xr.open_mfdataset(os.path.join(temp_download_dir, 'sim_reference_data.nc'), chunks={'time': time_chunk})
-    obs_reference_data = xr.open_mfdataset(os.path.join(input_ref_data_path, f'{run_object.Variable}_*.nc'), chunks={'time': time_chunk})
-
     # Get application and target periods
     application_start_year, application_end_year = str.split(run_object.application_period, '-')
     target_start_year, target_end_year = str.split(run_object.target_period, '-')
 
-    # Subsetting desired time
-    obs_reference_data = obs_reference_data.sel(time = slice(f'{target_start_year}', f'{target_end_year}'))
-    sim_reference_data = sim_reference_data.sel(time = slice(f'{target_start_year}', f'{target_end_year}'))
-    sim_application_data = sim_application_data.sel(time = slice(f'{application_start_year}', f'{application_end_year}'))
+    # Only list reference files whose date range overlaps the target period
+    obs_reference_files = utils.get_input_files(input_ref_data_path, f'{run_object.Variable}_*.nc', target_start_year, target_end_year)
 
-    # Drop unwanted vars
-    obs_reference_data = obs_reference_data.drop([x for x in list(obs_reference_data.coords) if x not in ['time', 'lat', 'lon']])
-    sim_reference_data = sim_reference_data.drop([x for x in list(sim_reference_data.coords) if x not in ['time', 'lat', 'lon']])
-    sim_application_data = sim_application_data.drop([x for x in list(sim_application_data.coords) if x not in ['time', 'lat', 'lon']])
-    obs_reference_data = obs_reference_data.drop_vars([x for x in list(obs_reference_data.keys()) if x != run_object.Variable])
-    sim_reference_data = sim_reference_data.drop_vars([x for x in list(sim_reference_data.keys()) if x != run_object.Variable])
-    sim_application_data = sim_application_data.drop_vars([x for x in list(sim_application_data.keys()) if x != run_object.Variable])
+    # Open data, subsetting the desired time and dropping unwanted vars as each file is opened. The ESM data was cut
+    # to the region as it was downloaded.
+    sim_application_data = utils.open_input_data([os.path.join(temp_download_dir, 'sim_application_data.nc')], run_object.Variable, time_chunk, 
+                                                 application_start_year, application_end_year)
+    sim_reference_data = utils.open_reference_data([os.path.join(temp_download_dir, 'sim_reference_data.nc')], run_object.Variable, time_chunk,
+                                                   target_start_year, target_end_year, lat_chunk, lon_chunk, source=reference_url,
+                                                   region_bounds=region_bounds)
+    obs_reference_data = utils.open_reference_data(obs_reference_files, run_object.Variable, time_chunk, target_start_year, target_end_year, lat_chunk, lon_chunk,
+                                                   region_bounds=region_bounds)
 
     # Return
     return obs_reference_data, sim_reference_data, sim_application_data
 
 
+# Input data of a task
+def list_input_files(run_object):
+    """
+    Function for listing the Pangeo stores (application, then historical) and the observational reference files of a
+    task, only the reference files whose date range overlaps the target period. Uses only the task details, so that
+    prefetch.py can list the reference files of the next task while this one runs.
+    """
+    reference_url, application_url = get_pangeo_urls(run_object)
+    target_start_year, target_end_year = str.split(run_object.target_period, '-')
+    obs_reference_files = utils.get_input_files(os.path.join(run_object.Reference_Input_Location, run_object.Variable),
+                                                f'{run_object.Variable}_*.nc', target_start_year, target_end_year)
+
+    return [application_url], [reference_url], obs_reference_files
+
+
+# Whether the historical data is already in the reference cache
+def is_reference_cached(reference_url, run_object):
+    """
+    Function for checking if an earlier task saved the historical data from Pangeo in the reference cache
+    """
+    target_start_year, target_end_year = str.split(run_object.target_period, '-')
+    cache_file = utils.get_reference_cache_file(None, run_object.Variable, target_start_year, target_end_year,
+                                                lat_chunk, lon_chunk, source=reference_url, region_bounds=region_bounds)
+
+    return cache_file is not None and os.path.exists(cache_file)
+
+
 # Function for downloading data from Pangeo
-def download_data(reference_url, application_url):
+def download_data(reference_url, application_url, run_object):
     """
-    Function for downloading pangeo data into a temporary directory
+    Function for downloading pangeo data into a temporary directory, only the task's region if it has one. The
+    historical data is skipped if an earlier task already saved it in the reference cache.
     """
+    global region_bounds
+
     # Install CMIP6 data and store in a temp dir as .zarr
     try:
         sim_application_data = fetch_nc(application_url)
+        # Region of the task, widened to whole ESM grid cells so the reference grid is cut at the edges of the same
+        # cells
+        region_bounds = utils.get_region_bounds(run_object)
+        if region_bounds is not None:
+            region_bounds = utils.snap_region_bounds(sim_application_data, region_bounds)
+            sim_application_data = utils.select_region(sim_application_data, region_bounds)
+        # Saved in the precision it's computed in, rather than downloaded and saved in more
+        sim_application_data[run_object.Variable] = utils.to_compute_dtype(sim_application_data[run_object.Variable],
+                                                                           run_object.Variable, 'read from Pangeo')
         write_job = sim_application_data.to_netcdf(os.path.join(temp_download_dir, 'sim_application_data.nc'), compute=True)
         progress(write_job)
-        sim_reference_data = fetch_nc(reference_url)
-        write_job = sim_reference_data.to_netcdf(os.path.join(temp_download_dir, 'sim_reference_data.nc'), compute=True)
-        progress(write_job)
         sim_application_data.close()
-        sim_reference_data.close()
+        if not is_reference_cached(reference_url, run_object):
+            sim_reference_data = utils.select_region(fetch_nc(reference_url), region_bounds)
+            sim_reference_data[run_object.Variable] = utils.to_compute_dtype(sim_reference_data[run_object.Variable],
+                                                                             run_object.Variable, 'read from Pangeo')
+            write_job = sim_reference_data.to_netcdf(os.path.join(temp_download_dir, 'sim_reference_data.nc'), compute=True)
+            progress(write_job)
+            sim_reference_data.close()
     except:
         print('Could not download data from Pangeo', flush=True)
         sys.exit(1)
@@ -239,21 +188,50 @@ def set_names(run_object):
     # Start and End years
     start, end = str.split(run_object.application_period, '-')
 
+    # Region of the task, global unless the run manager gives one
+    region = utils.get_region_name(run_object)
+
     # Output file name for daily and monthly bias adjusted data
-    output_day_ba_file_name = f'{run_object.ESM}_{run_object.Ensemble}_{run_object.Reference_Dataset}_{run_object.Scenario}_{run_object.Variable}_global_daily_{start}_{end}.nc'
-    output_mon_ba_file_name = f'{run_object.ESM}_{run_object.Ensemble}_{run_object.Reference_Dataset}_{run_object.Scenario}_{run_object.Variable}_global_monthly_{start}_{end}.nc'
+    output_day_ba_file_name = f'{run_object.ESM}_{run_object.Ensemble}_{run_object.Reference_Dataset}_{run_object.Scenario}_{run_object.Variable}_{region}_daily_{start}_{end}.nc'
+    output_mon_ba_file_name = f'{run_object.ESM}_{run_object.Ensemble}_{run_object.Reference_Dataset}_{run_object.Scenario}_{run_object.Variable}_{region}_monthly_{start}_{end}.nc'
     
     # Full output path for downscaled data
     output_basd_path = os.path.join(run_object.Output_Location, run_object.Reference_Dataset,
                                     run_object.ESM, run_object.Scenario, 'basd')
     
     # Output file name for daily and monthly downscaled data
-    output_day_basd_file_name = f'{run_object.ESM}_{run_object.Ensemble}_{run_object.Reference_Dataset}_{run_object.Scenario}_{run_object.Variable}_global_daily_{start}_{end}.nc'
-    output_mon_basd_file_name = f'{run_object.ESM}_{run_object.Ensemble}_{run_object.Reference_Dataset}_{run_object.Scenario}_{run_object.Variable}_global_monthly_{start}_{end}.nc'
+    output_day_basd_file_name = f'{run_object.ESM}_{run_object.Ensemble}_{run_object.Reference_Dataset}_{run_object.Scenario}_{run_object.Variable}_{region}_daily_{start}_{end}.nc'
+    output_mon_basd_file_name = f'{run_object.ESM}_{run_object.Ensemble}_{run_object.Reference_Dataset}_{run_object.Scenario}_{run_object.Variable}_{region}_monthly_{start}_{end}.nc'
     
     # Input location for observational reference dataset
     input_ref_data_path = os.path.join(run_object.Reference_Input_Location, run_object.Variable)
 
+    # Each configuration of a parameter sweep writes its own files
+    output_day_ba_file_name = utils.get_config_file_name(output_day_ba_file_name, run_object)
+    output_mon_ba_file_name = utils.get_config_file_name(output_mon_ba_file_name, run_object)
+    output_day_basd_file_name = utils.get_config_file_name(output_day_basd_file_name, run_object)
+    output_mon_basd_file_name = utils.get_config_file_name(output_mon_basd_file_name, run_object)
+
+    # Temporary files are kept on node-local scratch, if staging (see utils.start_staging)
+    temp_download_dir = utils.get_staging_dir(temp_download_dir)
+    temp_intermediate_dir = utils.get_staging_dir(temp_intermediate_dir)
+
+    # Tasks of other regions with the same ESM, variable and scenario can run at the same time
+    if region != 'global':
+        temp_download_dir = f'{temp_download_dir}_{region}'
+        temp_intermediate_dir = f'{temp_intermediate_dir}_{region}'
+
+    # Each latitude band of a tiled task writes its own files, which mosaic.py puts together
+    if utils.is_tiled(run_object):
+        temp_download_dir = f'{temp_download_dir}_tile{run_object.tile}'
+        temp_intermediate_dir = f'{temp_intermediate_dir}_tile{run_object.tile}'
+        output_ba_path = os.path.join(output_ba_path, 'tiles')
+        output_basd_path = os.path.join(output_basd_path, 'tiles')
+        output_day_ba_file_name = utils.get_tile_file_name(output_day_ba_file_name, run_object)
+        output_mon_ba_file_name = utils.get_tile_file_name(output_mon_ba_file_name, run_object)
+        output_day_basd_file_name = utils.get_tile_file_name(output_day_basd_file_name, run_object)
+        output_mon_basd_file_name = utils.get_tile_file_name(output_mon_basd_file_name, run_object)
+
 
 # Function that creates new directories
 def create_directories():
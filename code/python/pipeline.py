@@ -0,0 +1,291 @@
+"""
+Bias adjustment and downscaling of a task, shared by the drivers (downloaded.py, stitched.py and pangeo.py). The
+drivers find and load the input data of a task and name its output, and run_basd runs the rest: bias adjustment and
+downscaling of each configuration of basd parameters, retried with less memory use if Dask workers run out of memory,
+and the finished output moved into place with its quality statistics.
+"""
+
+# Import Libraries
+import copy
+import os
+import shutil
+
+import basd
+
+import compression
+import metrics
+import qa
+import supervisor
+import utils
+
+
+# Bias adjust and downscale the data of a task
+def run_basd(driver, run_object, run_name, load_ba_data, download_data=None):
+    """
+    Function for running bias adjustment and downscaling for a task, once for each configuration of basd parameters.
+    Shared by the drivers (downloaded.py, stitched.py and pangeo.py): driver is the driver's module, whose set_names()
+    and create_directories() have been run, and load_ba_data(run_object) is its function for loading the obs
+    reference, sim reference and sim application data. download_data(run_object) fetches the input data first, if the
+    driver has to.
+    """
+    input_path = os.path.join('input', run_name)
+
+    # 1. Read encoding settings
+    encoding, reset_chunksizes = utils.get_encoding(input_path)
+    # Read and compute data in the precision it's saved with
+    utils.use_compute_dtype(encoding)
+
+    # 2. Read attributes
+    variable_attributes, global_monthly_attributes, global_daily_attributes = utils.get_attributes(run_object.Variable, input_path)
+    # Precision to save the variable with, if given in attributes.csv
+    encoding, variable_attributes = utils.set_precision(encoding, variable_attributes)
+
+    # 3. Read Dask settings, used by the driver to load the data
+    time_chunk, lat_chunk, lon_chunk, dask_temp_directory = utils.get_chunk_sizes(input_path)
+    driver.time_chunk, driver.lat_chunk, driver.lon_chunk = time_chunk, lat_chunk, lon_chunk
+
+    # 4. Get Data
+    if download_data is not None:
+        with metrics.stage('download_data'):
+            download_data(run_object)
+
+    # Load in data over the given periods
+    with metrics.stage('load_ba_data'):
+        obs_reference_data, sim_reference_data, sim_application_data = load_ba_data(run_object)
+        # Mask of the region, if given as a mask or shapes rather than only a bounding box
+        region_mask = utils.get_region_mask(run_object, run_name, obs_reference_data)
+        obs_reference_data = utils.mask_region(obs_reference_data, region_mask, run_object.Variable)
+
+    # Bounding box of the task's region, set by the driver as it loads the data
+    region_bounds = driver.region_bounds
+
+    # Choose the output compression codec for this variable, if encoding.csv asks for auto
+    if encoding.get('compression') == 'auto':
+        with metrics.stage('codec_trial'):
+            encoding = compression.choose_codec(encoding, obs_reference_data, run_name, run_object.Variable)
+
+    # Grid cells with reference data, if only those are processed
+    compact_cells = utils.use_compact_cells(input_path)
+    if compact_cells:
+        valid_cells = utils.get_valid_cells(obs_reference_data, run_object, run_name)
+
+    # Latitude band of a tiled task, with a halo of coarse cells on either side
+    if utils.is_tiled(run_object):
+        sim_rows, obs_rows = utils.get_tile_rows(run_object, sim_application_data.sizes['lat'], obs_reference_data.sizes['lat'])
+        obs_reference_data = obs_reference_data.isel(lat=obs_rows)
+        sim_reference_data = sim_reference_data.isel(lat=sim_rows)
+        sim_application_data = sim_application_data.isel(lat=sim_rows)
+        if compact_cells:
+            valid_cells = valid_cells.isel(lat=obs_rows)
+
+    # Chunk sizes of the bias adjusted output, on the ESM grid
+    ba_encoding = utils.get_output_encoding(encoding, reset_chunksizes, sim_application_data.sizes)
+
+    # Only process the rows and columns of the grid with reference data, the output is put back on the whole grid
+    if compact_cells:
+        ba_grid = {'lat': sim_application_data['lat'].values, 'lon': sim_application_data['lon'].values}
+        coarse_cells, fine_cells = utils.get_compact_cells(valid_cells, sim_application_data.sizes, obs_reference_data.sizes)
+        print(f'Processing {coarse_cells["lat"].size} x {coarse_cells["lon"].size} of {ba_grid["lat"].size} x '
+              f'{ba_grid["lon"].size} ESM grid cells, with reference data', flush=True)
+        obs_reference_data = obs_reference_data.isel(fine_cells)
+        sim_reference_data = sim_reference_data.isel(coarse_cells)
+        sim_application_data = sim_application_data.isel(coarse_cells)
+        ba_grid_encoding = ba_encoding
+        ba_encoding = utils.get_output_encoding(encoding, reset_chunksizes, sim_application_data.sizes)
+
+    # Bias Adjustment data, used by every configuration
+    ba_data = obs_reference_data, sim_reference_data, sim_application_data
+
+    # Configurations of basd parameters to run, more than one for a parameter sweep (see variable_parameters.csv).
+    # Each configuration is bias adjusted and downscaled from the same loaded data, with its own output files.
+    for config_id in utils.get_config_ids(run_object, input_path):
+        obs_reference_data, sim_reference_data, sim_application_data = ba_data
+        config_object = copy.copy(run_object)
+        config_object.config_id = config_id
+        if config_id is not None:
+            print(f'Running parameter configuration {config_id}', flush=True)
+            driver.set_names(config_object)
+            driver.create_directories()
+
+        # 5. Get and extract parameters
+        params = utils.get_parameters(config_object, input_path)
+
+        # Paths and file names of the configuration, set by the driver. Monthly files only if monthly data is wanted.
+        temp_intermediate_dir = driver.temp_intermediate_dir
+        output_ba_path, output_basd_path = driver.output_ba_path, driver.output_basd_path
+        output_day_ba_file_name = driver.output_day_ba_file_name
+        output_day_basd_file_name = driver.output_day_basd_file_name
+        output_mon_ba_file_name = driver.output_mon_ba_file_name if run_object.monthly else None
+        output_mon_basd_file_name = driver.output_mon_basd_file_name if run_object.monthly else None
+
+        # Output is written to the staging directory on node-local scratch, and moved to the output directory when
+        # finished. Without daily output, daily downscaled data is never written, only its monthly means, and the
+        # daily bias adjusted data, still needed for downscaling, is left on scratch.
+        ba_stage_path = utils.get_staging_dir(output_ba_path)
+        basd_stage_path = utils.get_staging_dir(output_basd_path)
+        os.makedirs(ba_stage_path, exist_ok=True)
+        os.makedirs(basd_stage_path, exist_ok=True)
+        if not run_object.daily:
+            output_day_basd_file_name = None
+
+        # 6. Run Bias Adjustment, retrying with smaller chunks if Dask workers run out of memory
+        def bias_adjustment(lat_chunk_size, lon_chunk_size):
+            # Initializing Bias Adjustment
+            with metrics.stage('init_bias_adjustment'):
+                ba = basd.init_bias_adjustment(
+                    obs_reference_data, sim_reference_data, sim_application_data,
+                    run_object.Variable, params,
+                    lat_chunk_size=lat_chunk_size, lon_chunk_size=lon_chunk_size,
+                    temp_path=temp_intermediate_dir, periodic=region_bounds is None
+                )
+
+            # Perform adjustment and save at daily resolution
+            with metrics.stage('adjust_bias'):
+                basd.adjust_bias(
+                    init_output = ba, output_dir = ba_stage_path,
+                    day_file = output_day_ba_file_name, month_file = output_mon_ba_file_name,
+                    clear_temp = True, encoding={run_object.Variable: ba_encoding},
+                    ba_attrs = global_daily_attributes, ba_attrs_mon = global_monthly_attributes, variable_attrs = variable_attributes
+                )
+
+        supervisor.run_step('bias_adjustment', bias_adjustment, lat_chunk, lon_chunk, temp_dir=temp_intermediate_dir)
+
+        # Quality statistics of the output, within the bounds of the variable (see qa.py). For tiled tasks they are
+        # computed by mosaic.py instead.
+        bounds = None if utils.is_tiled(run_object) else qa.get_bounds(run_object.Variable, params)
+
+        # Put the bias adjusted output back on the whole grid, with its quality statistics
+        if compact_cells:
+            with metrics.stage('expand_output'):
+                # Without daily output, the daily bias adjusted data is only kept for downscaling, which reads it
+                # compact, so is left as it is
+                for file_name in [output_day_ba_file_name if run_object.daily else None, output_mon_ba_file_name]:
+                    if file_name is not None:
+                        utils.expand_output(os.path.join(ba_stage_path, file_name), ba_grid, run_object.Variable, ba_grid_encoding, time_chunk,
+                                      bounds)
+
+        # Clear temp directories
+        with metrics.stage('cleanup'):
+            try:
+                shutil.rmtree(temp_intermediate_dir)
+            except OSError as e:
+                print("Warning: %s : %s" % (temp_intermediate_dir, e.strerror))
+
+        # Get Data for statistical downscaling
+        with metrics.stage('load_sd_data'):
+            obs_reference_data, sim_application_data = utils.load_sd_data(run_object, driver.input_ref_data_path, time_chunk, ba_stage_path, output_day_ba_file_name,
+                                                                    region_bounds, region_mask)
+
+        # Same latitude band of the reference data as used for bias adjustment
+        if utils.is_tiled(run_object):
+            obs_reference_data = obs_reference_data.isel(lat=obs_rows)
+
+        # Record size of the downscaled output, used for throughput in the telemetry report. The grid cell days are
+        # added up over the ensemble members and configurations of the task.
+        metrics.record(n_lat=obs_reference_data.sizes['lat'], n_lon=obs_reference_data.sizes['lon'],
+                       n_days=sim_application_data.sizes['time'])
+        metrics.add(n_cell_days=obs_reference_data.sizes['lat'] * obs_reference_data.sizes['lon'] *
+                    sim_application_data.sizes['time'])
+
+        # Chunk sizes of the downscaled output, on the reference grid over the application period
+        basd_encoding = utils.get_output_encoding(encoding, reset_chunksizes, {
+            'time': sim_application_data.sizes['time'],
+            'lat': obs_reference_data.sizes['lat'], 'lon': obs_reference_data.sizes['lon']
+        })
+
+        # Only downscale the same rows and columns as were bias adjusted. The daily bias adjusted data is still
+        # compact if it wasn't put back on the whole grid for output.
+        if compact_cells:
+            basd_grid = {'lat': obs_reference_data['lat'].values, 'lon': obs_reference_data['lon'].values}
+            obs_reference_data = obs_reference_data.isel(fine_cells)
+            if run_object.daily:
+                sim_application_data = sim_application_data.isel(coarse_cells)
+            basd_grid_encoding = basd_encoding
+            basd_encoding = utils.get_output_encoding(encoding, reset_chunksizes, {
+                'time': sim_application_data.sizes['time'],
+                'lat': obs_reference_data.sizes['lat'], 'lon': obs_reference_data.sizes['lon']
+            })
+
+        # Remove upper bound for rsds for downscaling. Not using scaling to 0-1
+        if run_object.Variable == 'rsds':
+            params.upper_bound = None
+            params.upper_threshold = None
+            params.trend_preservation = None
+
+        # 7. Run downscaling, retrying with fewer workers if Dask workers run out of memory
+        def downscaling(lat_chunk_size, lon_chunk_size):
+            # Initialize downscaling
+            with metrics.stage('init_downscaling'):
+                ds = basd.init_downscaling(obs_reference_data, sim_application_data, run_object.Variable, params, temp_path=temp_intermediate_dir)
+
+            # Run downscaling
+            with metrics.stage('downscale'):
+                basd.downscale(
+                    ds,
+                    output_dir = basd_stage_path, day_file = output_day_basd_file_name, month_file = output_mon_basd_file_name,
+                    encoding={run_object.Variable: basd_encoding}, clear_temp=True,
+                    basd_attrs = global_daily_attributes, basd_attrs_mon = global_monthly_attributes, variable_attrs = variable_attributes
+                )
+
+        supervisor.run_step('downscaling', downscaling, lat_chunk, lon_chunk, chunked=False, temp_dir=temp_intermediate_dir)
+
+        # Put the downscaled output back on the whole grid, with its quality statistics
+        if compact_cells:
+            with metrics.stage('expand_output'):
+                for file_name in [output_day_basd_file_name, output_mon_basd_file_name]:
+                    if file_name is not None:
+                        utils.expand_output(os.path.join(basd_stage_path, file_name), basd_grid, run_object.Variable, basd_grid_encoding, time_chunk,
+                                      bounds)
+
+        # Finished output files, staged and in place
+        output_files = [(os.path.join(stage_path, file_name), os.path.join(output_path, file_name))
+                        for stage_path, output_path, file_name in [
+                            (ba_stage_path, output_ba_path, output_day_ba_file_name if run_object.daily else None),
+                            (ba_stage_path, output_ba_path, output_mon_ba_file_name),
+                            (basd_stage_path, output_basd_path, output_day_basd_file_name),
+                            (basd_stage_path, output_basd_path, output_mon_basd_file_name)
+                        ] if file_name is not None]
+
+        # 8. Quality statistics of the output files basd wrote and nothing has rewritten since, if dask_parameters.csv
+        # asks for them. basd computes and writes its files itself, so these are read back once, from node-local
+        # scratch, all in one computation, a whole extra read of the output.
+        if (bounds is not None) and not compact_cells and utils.use_qa_stats(input_path):
+            with metrics.stage('qa_stats'):
+                qa.save_file_stats([x for x, _ in output_files], run_object.Variable, bounds, time_chunk)
+
+        # 9. Move the finished output files into place, with their quality statistics
+        with metrics.stage('publish_output'):
+            for staged_file, output_file in output_files:
+                utils.publish_output(staged_file, output_file)
+                if os.path.exists(qa.get_stats_file(staged_file)):
+                    utils.publish_output(qa.get_stats_file(staged_file), qa.get_stats_file(output_file))
+
+        # Copy of the daily downscaled output for reading time series, if encoding.csv asks for one. For tiled tasks it
+        # is written by mosaic.py instead.
+        if encoding.get('timeseries_copy') and run_object.daily and not utils.is_tiled(run_object):
+            with metrics.stage('timeseries_copy'):
+                utils.write_timeseries_copy(
+                    os.path.join(output_basd_path, output_day_basd_file_name),
+                    os.path.join(os.path.dirname(output_basd_path), 'basd_timeseries', output_day_basd_file_name),
+                    run_object.Variable, encoding
+                )
+
+        # 10. Close data
+        with metrics.stage('cleanup'):
+            obs_reference_data.close()
+            sim_application_data.close()
+
+            # Remove temp dirs, and the staged output left, ex. daily bias adjusted data if daily data isn't wanted
+            try:
+                shutil.rmtree(temp_intermediate_dir)
+            except OSError as e:
+                print("Warning: %s : %s" % (temp_intermediate_dir, e.strerror))
+            if ba_stage_path != output_ba_path:
+                shutil.rmtree(ba_stage_path, ignore_errors=True)
+                shutil.rmtree(basd_stage_path, ignore_errors=True)
+            elif not run_object.daily:
+                os.remove(os.path.join(output_ba_path, output_day_ba_file_name))
+
+    # Close Bias Adjustment Data
+    for data in ba_data:
+        data.close()
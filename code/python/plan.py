@@ -0,0 +1,338 @@
+"""
+Compiled run plan. job-script-generation.py compiles the explicit list of tasks together with the settings each task
+needs (basd parameters, encoding, attributes and Dask settings) into one typed, validated plan, so mistakes in the
+input files are found before any jobs are submitted, and each task reads only its own record when it starts.
+Output:
+    - intermediate/<run_name>/run_plan.json - settings shared by the whole run (Dask settings, number of tasks)
+    - intermediate/<run_name>/run_plan.jsonl - one JSON record per task, in task_id order
+    - intermediate/<run_name>/run_plan.idx - byte offset of each record in run_plan.jsonl (unsigned 64 bit integers)
+"""
+
+# Import Libraries
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import types
+
+# Paths
+INTERMEDIATE_PATH = 'intermediate'
+INPUT_PATH = 'input'
+
+# Size of each offset in run_plan.idx
+OFFSET_FORMAT = '<Q'
+OFFSET_SIZE = struct.calcsize(OFFSET_FORMAT)
+
+# Types of the columns of the explicit list. Columns not listed are kept as read.
+TASK_TYPES = {
+    'ESM': str, 'Variable': str, 'Scenario': str, 'Ensemble': str, 'Reference_Dataset': str,
+    'target_period': str, 'application_period': str,
+    'ESM_Input_Location': str, 'Reference_Input_Location': str, 'Output_Location': str,
+    'daily': bool, 'monthly': bool, 'stitched': bool, 'tile': int, 'n_tiles': int,
+    'Region': str, 'Region_Bounds': str, 'Region_Mask': str
+}
+# Columns every task must have a value for
+REQUIRED_TASK_COLUMNS = ['ESM', 'Variable', 'Scenario', 'Reference_Dataset', 'target_period', 'application_period',
+                         'Reference_Input_Location', 'Output_Location', 'daily', 'monthly', 'stitched']
+
+# Types of the basd parameters in variable_parameters.csv. Parameters not listed are passed on as read.
+PARAMETER_TYPES = {
+    'distribution': str, 'trend_preservation': str,
+    'lower_bound': float, 'lower_threshold': float, 'upper_bound': float, 'upper_threshold': float,
+    'if_all_invalid_use': float, 'max_change_factor': float, 'max_adjustment_factor': float, 'p_value_eps': float,
+    'n_iterations': int, 'halfwin_ubc': int, 'step_size': int, 'n_quantiles': int, 'randomization_seed': int,
+    'detrend': bool, 'parametric': bool, 'unconditional_ccs_transfer': bool, 'trendless_bound_frequency': bool,
+    'adjust_p_values': bool
+}
+# Allowed values of string parameters and settings
+PARAMETER_CHOICES = {
+    'distribution': ['normal', 'gamma', 'weibull', 'beta', 'rice'],
+    'trend_preservation': ['additive', 'multiplicative', 'mixed', 'bounded'],
+    'layout': ['map', 'timeseries', 'balanced']
+}
+
+# Largest keepbits (mantissa bits) of each output data type
+MAX_KEEPBITS = {'float32': 23, 'float64': 52}
+
+# Types of the chunk layout settings in encoding.csv. Other settings are passed to xarray.to_netcdf() as read.
+ENCODING_TYPES = {'layout': str, 'target_chunk_mb': float, 'timeseries_copy': bool}
+
+# Types of the settings in dask_parameters.csv
+DASK_TYPES = {
+    'time_chunk_size': int, 'lat_chunk_size': int, 'lon_chunk_size': int, 'dask_temp_directory': str,
+    'max_retries': int, 'compact_cells': bool, 'qa_stats': bool, 'scratch_directory': str, 'prefetch_budget_gb': float
+}
+
+
+# Files of the plan of a run
+def get_plan_paths(run_name):
+    """
+    Function for getting the paths of the run settings, task records, and offsets files of a run's plan
+    """
+    plan_dir = os.path.join(INTERMEDIATE_PATH, run_name)
+    return (os.path.join(plan_dir, 'run_plan.json'), os.path.join(plan_dir, 'run_plan.jsonl'),
+            os.path.join(plan_dir, 'run_plan.idx'))
+
+
+# Read the settings shared by all tasks of a run
+def read_run(run_name):
+    """
+    Function for reading the settings shared by all tasks of a run (Dask settings, number of tasks)
+    """
+    run_file, _, _ = get_plan_paths(run_name)
+    try:
+        with open(run_file) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        raise FileNotFoundError(f'No run plan found for {run_name}, run job-script-generation.py first') from None
+
+
+# Read the record of one task
+def read_task(run_name, task_id):
+    """
+    Function for reading the record of one task from the plan, without reading the rest of the plan. Returns an
+    object with the task details as attributes (ex. task.Variable), and the task's settings as task.plan.
+    """
+    _, tasks_file, offsets_file = get_plan_paths(run_name)
+    try:
+        with open(offsets_file, 'rb') as offsets, open(tasks_file, 'rb') as tasks:
+            with mmap.mmap(offsets.fileno(), 0, access=mmap.ACCESS_READ) as offsets_map:
+                n_tasks = len(offsets_map) // OFFSET_SIZE - 1
+                if not 0 <= task_id < n_tasks:
+                    raise IndexError(f'Task {task_id} is not in the plan for {run_name}, which has {n_tasks} tasks')
+                start, = struct.unpack_from(OFFSET_FORMAT, offsets_map, task_id * OFFSET_SIZE)
+                end, = struct.unpack_from(OFFSET_FORMAT, offsets_map, (task_id + 1) * OFFSET_SIZE)
+            with mmap.mmap(tasks.fileno(), 0, access=mmap.ACCESS_READ) as tasks_map:
+                task_record = json.loads(tasks_map[start:end])
+    except FileNotFoundError:
+        raise FileNotFoundError(f'No run plan found for {run_name}, run job-script-generation.py first') from None
+
+    task = types.SimpleNamespace(**task_record['details'])
+    task.plan = task_record['settings']
+
+    return task
+
+
+# Compile and save the plan of a run
+def compile_plan(run_name, explicit_list):
+    """
+    Function for compiling the plan of a run from its explicit list of tasks (DataFrame) and input files, and saving
+    it. All problems found in the input files are raised together as a ValueError.
+    """
+    import utils
+
+    input_path = os.path.join(INPUT_PATH, run_name)
+    errors = []
+
+    # Settings shared by every task
+    dask_settings = convert_settings(utils.read_dask_settings(input_path), DASK_TYPES, 'dask_parameters.csv', errors)
+    for setting in ['time_chunk_size', 'lat_chunk_size', 'lon_chunk_size']:
+        if dask_settings.get(setting) is None or dask_settings[setting] < 1:
+            errors.append(f'dask_parameters.csv: {setting} must be a positive integer')
+    try:
+        encoding, reset_chunksizes = utils.read_encoding(input_path)
+    except ValueError as e:
+        errors.append(f'encoding.csv: {e}')
+        encoding, reset_chunksizes = {}, False
+    encoding = convert_settings(encoding, ENCODING_TYPES, 'encoding.csv', errors)
+    if encoding.get('target_chunk_mb') is not None and encoding['target_chunk_mb'] <= 0:
+        errors.append('encoding.csv: target_chunk_mb must be positive')
+    for chunk in encoding.get('chunksizes', []):
+        if chunk != 'max' and not is_integer(chunk):
+            errors.append(f'encoding.csv: chunk sizes must be integers or max, not {chunk}')
+
+    # Settings of each variable, only read once per variable
+    variable_settings = {}
+    for variable in explicit_list['Variable'].unique():
+        try:
+            parameters = convert_settings(utils.read_parameters(variable, input_path), PARAMETER_TYPES,
+                                          f'variable_parameters.csv ({variable})', errors)
+        except IndexError:
+            errors.append(f'variable_parameters.csv: no parameters for {variable}')
+            parameters = {}
+        # Configurations of a parameter sweep, each row of the variable with its own config_id
+        config_ids = utils.read_config_ids(variable, input_path)
+        configs = {}
+        if config_ids != [None]:
+            if None in config_ids or len(set(config_ids)) < len(config_ids):
+                errors.append(f'variable_parameters.csv ({variable}): every row of a parameter sweep needs its own '
+                              f'config_id')
+            for config_id in [x for x in config_ids if x is not None]:
+                configs[config_id] = convert_settings(utils.read_parameters(variable, input_path, config_id),
+                                                      PARAMETER_TYPES,
+                                                      f'variable_parameters.csv ({variable}, {config_id})', errors)
+        try:
+            attributes = to_python(utils.get_attributes(variable, input_path))
+        except IndexError:
+            errors.append(f'attributes.csv: no attributes for {variable}')
+            attributes = ({}, {}, {})
+        for setting in utils.PRECISION_SETTINGS:
+            value = attributes[0].get(setting)
+            if value is not None and (not is_integer(value) or float(value) < 0):
+                errors.append(f'attributes.csv ({variable}): {setting} must be a positive whole number, not {value!r}')
+        keepbits = attributes[0].get('keepbits')
+        if is_integer(keepbits) and not 0 < float(keepbits) <= MAX_KEEPBITS.get(encoding.get('dtype'), 52):
+            errors.append(f'attributes.csv ({variable}): keepbits must be between 1 and '
+                          f'{MAX_KEEPBITS.get(encoding.get("dtype"), 52)} for {encoding.get("dtype")} data')
+        variable_settings[variable] = {'parameters': parameters, 'attributes': attributes}
+        if configs:
+            variable_settings[variable]['configs'] = configs
+
+    # Rows of each task. Ensemble members stacked into one task (task_id column) share a record, listing their
+    # members in Ensembles.
+    rows = explicit_list.to_dict(orient='records')
+    if 'task_id' in explicit_list:
+        task_rows = [[i for i, x in enumerate(rows) if x['task_id'] == task_id]
+                     for task_id in range(explicit_list['task_id'].max() + 1)]
+    else:
+        task_rows = [[i] for i in range(len(rows))]
+
+    # Number of rows reading each set of observational reference data. Tasks whose reference data is also read by
+    # other rows cache it (see utils.open_reference_data).
+    reference_columns = ['Reference_Input_Location', 'Variable', 'target_period']
+    if 'Region' in explicit_list:
+        reference_columns.append('Region')
+    reference_counts = explicit_list.groupby(reference_columns, dropna=False)['Variable'].transform('size').tolist()
+
+    # Task records
+    task_records = []
+    for task_id, member_rows in enumerate(task_rows):
+        row = {key: value for key, value in rows[member_rows[0]].items() if key != 'task_id'}
+        details = convert_settings(row, TASK_TYPES, f'run_manager_explicit_list.csv (task {task_id})', errors)
+        if 'task_id' in explicit_list:
+            details['Ensembles'] = [to_python(rows[x]['Ensemble']) for x in member_rows]
+        # Parameter sweeps bias adjust the same reference data once for each configuration
+        details['reference_cache'] = (max([reference_counts[x] for x in member_rows]) > 1 or
+                                      len(variable_settings[details['Variable']].get('configs', {})) > 1)
+        for column in REQUIRED_TASK_COLUMNS:
+            if details.get(column) is None:
+                errors.append(f'run_manager_explicit_list.csv (task {task_id}): {column} is missing')
+        for period in ['target_period', 'application_period']:
+            if details.get(period) is not None and not is_period(details[period]):
+                errors.append(f'run_manager_explicit_list.csv (task {task_id}): {period} must look like 1980-2014, '
+                              f'not {details[period]}')
+        if details.get('Region_Bounds') is not None and not is_bounds(details['Region_Bounds']):
+            errors.append(f'run_manager_explicit_list.csv (task {task_id}): Region_Bounds must be west south east '
+                          f'north, ex. -125 24 -66 50, not {details["Region_Bounds"]}')
+        settings = dict(variable_settings[details['Variable']], encoding=encoding, reset_chunksizes=reset_chunksizes,
+                        dask=dask_settings)
+        task_records.append({'task_id': task_id, 'details': details, 'settings': settings})
+
+    if errors:
+        raise ValueError('Problems found in the input files of ' + run_name + ':\n    ' + '\n    '.join(errors))
+
+    write_plan(run_name, task_records, {'run_name': run_name, 'n_tasks': len(task_records), 'dask': dask_settings})
+
+
+# Write the plan files
+def write_plan(run_name, task_records, run_settings):
+    """
+    Function for writing the plan of a run, one JSON line per task and the byte offset of each line
+    """
+    run_file, tasks_file, offsets_file = get_plan_paths(run_name)
+    offsets = [0]
+    with open(tasks_file, 'wb') as tasks:
+        for task_record in task_records:
+            tasks.write((json.dumps(task_record) + '\n').encode())
+            offsets.append(tasks.tell())
+    with open(offsets_file, 'wb') as offsets_output:
+        offsets_output.write(b''.join([struct.pack(OFFSET_FORMAT, x) for x in offsets]))
+    with open(run_file, 'w') as file:
+        json.dump(run_settings, file, indent=4)
+
+
+# Check and convert the types of a set of settings
+def convert_settings(settings, setting_types, source, errors):
+    """
+    Function for converting each setting to its type. Missing values become None, and values that can't be
+    converted are added to errors.
+    """
+    typed_settings = {}
+    for name, value in to_python(settings).items():
+        if value is None or name not in setting_types:
+            typed_settings[name] = value
+            continue
+        try:
+            typed_settings[name] = convert(value, setting_types[name])
+        except ValueError:
+            errors.append(f'{source}: {name} should be {setting_types[name].__name__}, not {value!r}')
+            continue
+        if name in PARAMETER_CHOICES and value not in PARAMETER_CHOICES[name]:
+            errors.append(f'{source}: {name} must be one of {", ".join(PARAMETER_CHOICES[name])}, not {value!r}')
+
+    return typed_settings
+
+
+# Convert a value to a type
+def convert(value, setting_type):
+    """
+    Function for converting a value read from a csv file to the given type, raising ValueError if it can't be
+    """
+    if setting_type is bool:
+        if isinstance(value, bool):
+            return value
+        if str(value).strip().upper() in ['TRUE', '1', '1.0']:
+            return True
+        if str(value).strip().upper() in ['FALSE', '0', '0.0']:
+            return False
+        raise ValueError(value)
+    if setting_type is int:
+        if isinstance(value, bool) or not is_integer(value):
+            raise ValueError(value)
+        return int(float(value))
+    if setting_type is float:
+        return float(value)
+
+    return str(value)
+
+
+# Convert numpy / pandas values to plain python values
+def to_python(value):
+    """
+    Function for converting numpy values, NaN and tuples, as read by pandas, into plain python values that can be
+    saved as JSON
+    """
+    if isinstance(value, dict):
+        return {str(key): to_python(x) for key, x in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_python(x) for x in value]
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+
+    return value
+
+
+# Whether a value is a whole number
+def is_integer(value):
+    """
+    Function for checking if a value is a whole number (ex. 10, 10.0 or '10')
+    """
+    try:
+        return float(value).is_integer()
+    except (TypeError, ValueError):
+        return False
+
+
+# Whether a string is a period of years
+def is_period(period):
+    """
+    Function for checking if a period looks like <start year>-<end year>, with start before end
+    """
+    match = re.fullmatch(r'(\d{4})-(\d{4})', period)
+    return match is not None and int(match.group(1)) <= int(match.group(2))
+
+
+# Whether a string is the bounding box of a region
+def is_bounds(bounds):
+    """
+    Function for checking if a region's bounds look like <west> <south> <east> <north>, with south below north
+    """
+    try:
+        west, south, east, north = [float(x) for x in bounds.split()]
+    except ValueError:
+        return False
+    return -90 <= south < north <= 90
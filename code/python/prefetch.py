@@ -0,0 +1,220 @@
+"""
+Prefetching of the input data of the next task while the current one runs. The BASD daemon (see daemon.py) runs the
+tasks of a run one after another, so when it starts a task, the input files of the next task in
+intermediate/<run_name>/run_manager_explicit_list.csv are copied to node-local scratch in a background thread. Reading
+them then overlaps the bias adjustment and downscaling of the current task, and the next task reads the local copies
+(see utils.get_prefetched_file). The copies are kept within the prefetch_budget_gb setting of dask_parameters.csv, and
+prefetching is off without it. Pangeo stores aren't copied, as a task only downloads its time range and region of them
+(see pangeo.download_data), far less than the whole store.
+"""
+
+# Importing Needed Libraries
+import copy  # Copies of task details for each ensemble member
+import hashlib  # Names of the local copies
+import os  # For navigating os
+import shutil  # Removing copies
+import tempfile  # Directory of the copies
+import threading  # Copying in the background
+
+import pandas as pd  # Checking for missing settings
+
+import plan  # Task details
+import utils  # Scratch directory, and the copies in use
+
+# CONSTANTS
+INTERMEDIATE_PATH = 'intermediate'
+# Bytes in a GB, for the budget
+GB = 1024 ** 3
+# Bytes copied at a time, between checks for whether to stop
+COPY_BLOCK_SIZE = 64 * 1024 ** 2
+
+# Directory of the copies, and the most disk they may use (set in start)
+prefetch_dir = None
+budget_bytes = 0
+
+# Background copy of the inputs of the next task, and the event stopping it
+copy_thread = None
+stop_event = None
+
+# Inputs of the tasks prefetched for, {task_id: [sources]}, and the size of each copy, {source: bytes}
+task_sources = {}
+copy_sizes = {}
+
+
+# Start prefetching
+def start(dask_settings, name):
+    """
+    Function for making a directory on node-local scratch for the copies, if dask_parameters.csv gives a
+    prefetch_budget_gb. Without it, prefetch_next does nothing.
+    """
+    global prefetch_dir, budget_bytes
+
+    budget = dask_settings.get('prefetch_budget_gb')
+    if (budget is None) or pd.isna(budget) or (float(budget) <= 0):
+        return
+
+    scratch_root = utils.get_scratch_root(dask_settings)
+    os.makedirs(scratch_root, exist_ok=True)
+    prefetch_dir = tempfile.mkdtemp(prefix=f'{name}_', dir=scratch_root)
+    budget_bytes = int(float(budget) * GB)
+
+
+# Stop prefetching
+def stop():
+    """
+    Function for stopping any copy in progress and removing the copies
+    """
+    global prefetch_dir
+
+    cancel()
+    for source in list(copy_sizes):
+        remove_copy(source)
+    task_sources.clear()
+    if prefetch_dir is not None:
+        shutil.rmtree(prefetch_dir, ignore_errors=True)
+    prefetch_dir = None
+
+
+# Prefetch the inputs of the task after the one starting
+def prefetch_next(run_name, task_id):
+    """
+    Function for starting to copy the inputs of the task after task_id in the background, called as task_id starts.
+    Copies made for other tasks are removed first, to make room in the budget.
+    """
+    global copy_thread, stop_event, task_sources
+
+    if prefetch_dir is None:
+        return
+
+    # The copy for this task stops here, the task reads whatever was copied in time
+    cancel()
+    keep_sources = task_sources.get(task_id, [])
+    for source in list(copy_sizes):
+        if source not in keep_sources:
+            remove_copy(source)
+    task_sources = {task_id: keep_sources}
+
+    stop_event = threading.Event()
+    copy_thread = threading.Thread(target=copy_task_inputs, args=(run_name, task_id + 1, stop_event), daemon=True)
+    copy_thread.start()
+
+
+# Stop the copy in progress
+def cancel():
+    """
+    Function for stopping the background copy, if running, and waiting for it to stop
+    """
+    global copy_thread, stop_event
+
+    if copy_thread is not None:
+        stop_event.set()
+        copy_thread.join()
+    copy_thread = None
+    stop_event = None
+
+
+# Copy the inputs of a task
+def copy_task_inputs(run_name, task_id, stop):
+    """
+    Function for copying the inputs of a task to the prefetch directory, in the order they are read, until the budget
+    is used up or stop is set. Inputs that don't fit are left to be read from their original location.
+    """
+    try:
+        sources = get_task_sources(run_name, task_id)
+    except (Exception, SystemExit) as e:
+        # The task fails with a better message when it runs
+        print(f'Could not list the inputs of task {task_id} to prefetch: {e}', flush=True)
+        return
+    task_sources[task_id] = sources
+
+    for source in sources:
+        if stop.is_set():
+            return
+        if source in copy_sizes:
+            continue
+        try:
+            size = get_source_size(source)
+            if sum(copy_sizes.values()) + size > budget_bytes:
+                continue
+            copy_source(source, size, stop)
+        except Exception as e:
+            print(f'Could not prefetch {source}: {e}', flush=True)
+
+
+# Inputs of a task
+def get_task_sources(run_name, task_id):
+    """
+    Function for listing the local input files of a task, for every ensemble member stacked into it, or nothing if
+    there is no such task. Pangeo stores are left out.
+    """
+    if task_id >= plan.read_run(run_name)['n_tasks']:
+        return []
+    task = plan.read_task(run_name, task_id)
+
+    # tasrange/tasskew made from Pangeo data are read from intermediate, as in main.py
+    if (task.ESM_Input_Location is None) and (task.Variable in ['tasrange', 'tasskew']):
+        task.ESM_Input_Location = os.path.join(INTERMEDIATE_PATH, run_name, 'tasrange_tasskew')
+    driver = utils.get_driver(task)
+
+    sources = []
+    for member in getattr(task, 'Ensembles', None) or [getattr(task, 'Ensemble', None)]:
+        member_task = copy.copy(task)
+        member_task.Ensemble = member
+        # Derived variables without files of their own are read from the files of their source variables
+        for files in driver.list_input_files(member_task):
+            for file_path in files:
+                if '://' in file_path:
+                    continue
+                sources += [x for x in utils.get_source_files(file_path, member_task.Variable) if x not in sources]
+
+    return sources
+
+
+# Disk space of an input
+def get_source_size(source):
+    """
+    Function for getting the size in bytes of a local file
+    """
+    return os.path.getsize(source)
+
+
+# Copy one input
+def copy_source(source, size, stop):
+    """
+    Function for copying a local file to the prefetch directory. The copy is made under a
+    temporary name and renamed when complete, and is only used once recorded in utils.prefetched_files.
+    """
+    local_file = os.path.join(prefetch_dir, f'{hashlib.sha1(source.encode()).hexdigest()[:16]}_'
+                                            f'{os.path.basename(source.rstrip("/"))}')
+    temp_file = f'{local_file}.tmp'
+    stamp = utils.get_file_stamp(source)
+
+    try:
+        with open(source, 'rb') as source_file, open(temp_file, 'wb') as copy_file:
+            while not stop.is_set():
+                block = source_file.read(COPY_BLOCK_SIZE)
+                if not block:
+                    break
+                copy_file.write(block)
+        if stop.is_set():
+            return
+        os.replace(temp_file, local_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+    copy_sizes[source] = size
+    utils.prefetched_files[source] = (local_file, stamp)
+
+
+# Remove one copy
+def remove_copy(source):
+    """
+    Function for no longer using the copy of an input, and removing it
+    """
+    local_file, _ = utils.prefetched_files.pop(source, (None, None))
+    copy_sizes.pop(source, None)
+    if local_file is None:
+        return
+    if os.path.exists(local_file):
+        os.remove(local_file)
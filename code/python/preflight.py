@@ -0,0 +1,299 @@
+"""
+Preflight checks of every task in a run, run by job-script-generation.py before any jobs are submitted. Uses only
+file names and metadata (time coordinate, grid size and calendar) to find tasks that would fail once running:
+missing input files, periods not covered by the data, grids or calendars that don't match, and data missing from the
+Pangeo catalog. Problems are written to intermediate/<run_name>/preflight_report.csv, and tasks with errors can be
+dropped from the run.
+"""
+
+# Import Libraries
+import functools
+import os
+
+import cftime
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import utils
+
+# Paths
+INTERMEDIATE_PATH = 'intermediate'
+
+# Calendar names that mean the same thing
+CALENDAR_NAMES = {'gregorian': 'standard', 'proleptic_gregorian': 'standard', '365_day': 'noleap', '366_day': 'all_leap'}
+
+
+# Check every task of a run
+def run_preflight(run_name, explicit_list, mode='flag'):
+    """
+    Function for checking every task in the explicit list (DataFrame). Problems are printed and saved to the
+    preflight report. With mode 'drop', rows with errors are removed from the returned explicit list (a stacked task
+    keeps its members without errors), with 'flag' they are kept, and with 'off' nothing is checked.
+    """
+    if mode == 'off':
+        return explicit_list
+
+    # Task id of each row in the run plan. Rows of stacked ensemble members share a task_id, the others are one task
+    # each (with --tiles, each tile is a task)
+    if 'task_id' in explicit_list:
+        task_ids = explicit_list['task_id'].to_numpy()
+    else:
+        task_ids = np.arange(explicit_list.shape[0])
+
+    report = []
+    report_rows = []
+    checked = {}
+    for row_index, (task_id, task) in enumerate(zip(task_ids, explicit_list.to_dict(orient='records'))):
+        # Tiles of a task use the same input data, so are only checked once
+        key = tuple((x, str(y)) for x, y in task.items() if x not in ['tile', 'n_tiles', 'task_id'])
+        if key not in checked:
+            checked[key] = check_task(task)
+        for severity, problem in checked[key]:
+            report.append({'task_id': task_id, 'ESM': task['ESM'], 'Variable': task['Variable'],
+                           'Scenario': task['Scenario'], 'Ensemble': task.get('Ensemble'),
+                           'severity': severity, 'problem': problem})
+            report_rows.append(row_index)
+    report = pd.DataFrame(report, columns=['task_id', 'ESM', 'Variable', 'Scenario', 'Ensemble', 'severity', 'problem'])
+
+    # Rows (ensemble members) that would fail, and the tasks they are in. A stacked task only fails as a whole when
+    # all of its members do.
+    report_rows = np.array(report_rows, dtype=int)
+    failing_rows = np.zeros(explicit_list.shape[0], dtype=bool)
+    failing_rows[report_rows[(report['severity'] == 'error').to_numpy()]] = True
+    failing_tasks = np.unique(task_ids[failing_rows])
+    lost_tasks = np.setdiff1d(failing_tasks, task_ids[~failing_rows])
+    report['dropped'] = (mode == 'drop') & failing_rows[report_rows]
+    os.makedirs(os.path.join(INTERMEDIATE_PATH, run_name), exist_ok=True)
+    report.to_csv(os.path.join(INTERMEDIATE_PATH, run_name, 'preflight_report.csv'), index=False)
+
+    # Print a summary
+    print(f'======================================================')
+    print(f'Preflight: {len(failing_tasks)} of {len(np.unique(task_ids))} tasks have errors, '
+          f'{(report["severity"] == "warning").sum()} warnings')
+    for _, row in report.iterrows():
+        print(f'    Task {row.task_id} ({row.ESM} {row.Variable} {row.Scenario} {row.Ensemble}) '
+              f'{row.severity}: {row.problem}')
+    if len(failing_tasks) > 0:
+        if mode == 'drop':
+            print(f'Dropped {failing_rows.sum()} rows with errors, removing {len(lost_tasks)} tasks entirely, '
+                  f'see preflight_report.csv')
+        else:
+            print(f'Tasks with errors are still in the run, use --preflight drop to remove them')
+    print(f'======================================================')
+
+    # Only the failing members are dropped, and the tasks left are numbered again. The Ensembles of each stacked task
+    # are built from its remaining rows when the run plan is compiled.
+    if mode == 'drop':
+        explicit_list = explicit_list[~failing_rows].reset_index(drop=True)
+        if 'task_id' in explicit_list:
+            explicit_list['task_id'] = pd.factorize(explicit_list['task_id'])[0]
+
+    return explicit_list
+
+
+# Check one task
+def check_task(task):
+    """
+    Function for checking one task (dictionary of a row of the explicit list). Returns a list of (severity, problem),
+    where severity is 'error' for problems that would make the task fail, and 'warning' otherwise.
+    """
+    problems = []
+    variable = task['Variable']
+    target_period = [int(x) for x in str.split(task['target_period'], '-')]
+    application_period = [int(x) for x in str.split(task['application_period'], '-')]
+
+    # Observational reference data
+    reference = check_data(problems, 'reference', os.path.join(task['Reference_Input_Location'], variable),
+                           '{variable}_*.nc', variable, *target_period)
+
+    # Region mask, if the region isn't only a bounding box
+    mask_path = task.get('Region_Mask')
+    if (mask_path is not None) and pd.notna(mask_path) and not os.path.exists(mask_path):
+        problems.append(('error', f'region mask {mask_path} not found'))
+
+    # Simulated data
+    simulated = []
+    if task['stitched']:
+        # STITCHED data is created by stitch.job, so may not exist yet
+        stitched_file = os.path.join(task['ESM_Input_Location'], f'stitched_{task["ESM"]}_{variable}_{task["Scenario"]}.nc')
+        if os.path.exists(stitched_file):
+            simulated.append(check_data(problems, 'STITCHED', task['ESM_Input_Location'],
+                                        f'stitched_{task["ESM"]}_{{variable}}_{task["Scenario"]}.nc', variable,
+                                        min(target_period[0], application_period[0]),
+                                        max(target_period[1], application_period[1])))
+    elif pd.isna(task['ESM_Input_Location']):
+        # tasrange/tasskew from Pangeo data are created by create_tasrange_tasskew.py, in intermediate
+        if variable not in utils.DERIVED_VARIABLES:
+            problems.extend(check_pangeo_catalog(task))
+    else:
+        simulated.append(check_data(problems, 'historical', task['ESM_Input_Location'],
+                                    f'{{variable}}_day_{task["ESM"]}_historical_{task["Ensemble"]}_*.nc',
+                                    variable, *target_period))
+        simulated.append(check_data(problems, task['Scenario'], task['ESM_Input_Location'],
+                                    f'{{variable}}_day_{task["ESM"]}_{task["Scenario"]}_{task["Ensemble"]}_*.nc',
+                                    variable, *application_period))
+    simulated = [x for x in simulated if x is not None]
+
+    # Grids and calendars
+    if len(simulated) == 2:
+        if simulated[0]['shape'] != simulated[1]['shape']:
+            problems.append(('error', f'historical grid {format_shape(simulated[0]["shape"])} and {task["Scenario"]} '
+                                      f'grid {format_shape(simulated[1]["shape"])} are different'))
+        if simulated[0]['calendar'] != simulated[1]['calendar']:
+            problems.append(('error', f'historical calendar ({simulated[0]["calendar"]}) and {task["Scenario"]} '
+                                      f'calendar ({simulated[1]["calendar"]}) are different'))
+    if reference is not None and simulated:
+        if not is_refinement(reference['shape'], simulated[0]['shape']):
+            problems.append(('error', f'reference grid {format_shape(reference["shape"])} is not a whole multiple of '
+                                      f'the ESM grid {format_shape(simulated[0]["shape"])}'))
+        if reference['calendar'] != simulated[0]['calendar']:
+            problems.append(('warning', f'reference calendar ({reference["calendar"]}) and ESM calendar '
+                                        f'({simulated[0]["calendar"]}) are different'))
+
+    return problems
+
+
+# Check the files of one dataset
+def check_data(problems, name, input_dir, file_pattern, variable, start_year, end_year):
+    """
+    Function for checking that files exist for a dataset, cover the years needed, and contain the variable.
+    file_pattern has {variable} in place of the variable name, so that tasrange and tasskew can be checked through
+    the variables they will be created from. Problems are added to problems, and a summary of the data (grid shape
+    and calendar) is returned, or None if there is no data.
+    """
+    files = find_files(input_dir, file_pattern.format(variable=variable), start_year, end_year)
+    file_variable = variable
+
+    # tasrange and tasskew are computed from other variables as they are read, if there are no files of them
+    if not files and variable in utils.DERIVED_VARIABLES:
+        source_variables = utils.DERIVED_VARIABLES[variable]['inputs']
+        file_variable = source_variables[0]
+        # Observational data of the source variable is in its own directory
+        input_dir = os.path.dirname(utils.swap_file_variable(os.path.join(input_dir, ''), variable, file_variable))
+        files = find_files(input_dir, file_pattern.format(variable=file_variable), start_year, end_year)
+        if not files:
+            problems.append(('error', f'no {name} files for {variable}, or {", ".join(source_variables)} to create it '
+                                      f'from, in {input_dir}'))
+            return None
+        problems.append(('warning', f'{name} {variable} will be computed from {", ".join(source_variables)}'))
+    elif not files:
+        problems.append(('error', f'no {name} files matching {file_pattern.format(variable=variable)} for '
+                                  f'{start_year}-{end_year} in {input_dir}'))
+        return None
+
+    # Years covered by the files
+    covered_years = set()
+    for file in files:
+        file_years = utils.get_file_years(os.path.basename(file))
+        if file_years is None:
+            file_years = read_metadata(file)['years']
+        covered_years.update(range(file_years[0], file_years[1] + 1))
+    missing_years = [x for x in range(start_year, end_year + 1) if x not in covered_years]
+    if missing_years:
+        problems.append(('error', f'{name} data for {file_variable} is missing years {format_years(missing_years)}'))
+
+    # Grid, calendar and variables from the first file
+    metadata = read_metadata(files[0])
+    if file_variable not in metadata['variables']:
+        problems.append(('error', f'{os.path.basename(files[0])} does not contain {file_variable}'))
+
+    return metadata
+
+
+# Files of a dataset
+def find_files(input_dir, file_pattern, start_year, end_year):
+    """
+    Function for finding the files matching a pattern that overlap the given years, empty if there are none
+    """
+    try:
+        return utils.get_input_files(input_dir, file_pattern, start_year, end_year)
+    except FileNotFoundError:
+        return []
+
+
+# Metadata of a file
+@functools.lru_cache(maxsize=None)
+def read_metadata(file_path):
+    """
+    Function for reading the years, grid shape, calendar and variables of a file, without reading its data.
+    Tasks share files (ex. reference data), so each file is only read once.
+    """
+    with xr.open_dataset(file_path, decode_times=False) as ds:
+        # Only the first and last times are decoded
+        time = ds['time']
+        calendar = time.attrs.get('calendar', 'standard')
+        first_time, last_time = cftime.num2date([time.values[0], time.values[-1]], time.attrs['units'], calendar)
+        years = (first_time.year, last_time.year)
+        shape = (ds.sizes.get('lat'), ds.sizes.get('lon'))
+        variables = list(ds.data_vars)
+
+    return {'years': years, 'calendar': CALENDAR_NAMES.get(calendar, calendar), 'shape': shape, 'variables': variables}
+
+
+# Check Pangeo has the data
+def check_pangeo_catalog(task):
+    """
+    Function for checking that the Pangeo catalog has daily historical and scenario data for a task
+    """
+    try:
+        pangeo_table = fetch_pangeo_table()
+    except Exception as e:
+        return [('warning', f'could not read the Pangeo catalog to check for data ({type(e).__name__})')]
+
+    problems = []
+    for experiment in ['historical', task['Scenario']]:
+        entries = pangeo_table[(pangeo_table['model'] == task['ESM']) &
+                               (pangeo_table['variable'] == task['Variable']) &
+                               (pangeo_table['domain'] == 'day') &
+                               (pangeo_table['experiment'] == experiment) &
+                               (pangeo_table['ensemble'] == task['Ensemble'])]
+        if entries.shape[0] == 0:
+            problems.append(('error', f'no daily {experiment} data on Pangeo for {task["ESM"]} {task["Variable"]} '
+                                      f'{task["Ensemble"]}'))
+
+    return problems
+
+
+# Pangeo catalog, only read once
+@functools.lru_cache(maxsize=None)
+def fetch_pangeo_table():
+    """
+    Function for reading the Pangeo catalog once for all tasks
+    """
+    import pangeo
+    return pangeo.fetch_pangeo_table()
+
+
+# Whether a fine grid is made of whole cells of a coarse grid
+def is_refinement(fine_shape, coarse_shape):
+    """
+    Function for checking that each dimension of the fine grid is a whole multiple of the coarse grid
+    """
+    if None in fine_shape or None in coarse_shape:
+        return True
+
+    return all([fine % coarse == 0 and fine >= coarse for fine, coarse in zip(fine_shape, coarse_shape)])
+
+
+# Grid shape as text
+def format_shape(shape):
+    """
+    Function for writing a grid shape like (lat)x(lon)
+    """
+    return f'{shape[0]}x{shape[1]}'
+
+
+# Years as text, with consecutive years shortened to ranges
+def format_years(years):
+    """
+    Function for writing a list of years, with runs of consecutive years written as a range (ex. 1980-1985, 1990)
+    """
+    ranges = []
+    for year in years:
+        if ranges and year == ranges[-1][1] + 1:
+            ranges[-1][1] = year
+        else:
+            ranges.append([year, year])
+
+    return ', '.join([f'{x[0]}' if x[0] == x[1] else f'{x[0]}-{x[1]}' for x in ranges])
@@ -0,0 +1,170 @@
+"""
+Quality statistics of the output files, saved next to each file as <file name>.qa.json so that the output can be
+checked without reading it again: the number of values and missing values, the minimum, maximum and mean, the number
+of values outside the lower_bound and upper_bound of variable_parameters.csv, the spatial mean of each month, and for
+tasmin and tasmax, the number of values where tasmin is above tasmax. The statistics are reduced chunk by chunk in the
+same Dask computation that writes the file in create_tasmin_tasmax.py, mosaic.py, and utils.expand_output (which
+puts output processed on the compact grid back on the whole grid), so cost no extra read. basd writes its files itself,
+so those it wrote that nothing rewrites have no statistics unless the qa_stats setting of dask_parameters.csv is on.
+They are then read back once from node-local scratch, together in one computation, just after being written and before
+being moved to the output directory, which is a whole extra read of the output (about as long as writing it). Means are
+accumulated in float64.
+Run with:
+    python code/python/qa.py <run_name>
+to collect the statistics of every output file of a run into intermediate/<run_name>/qa_summary.csv, and list the
+files with values out of bounds, tasmin above tasmax, or no data.
+"""
+
+# Import Libraries
+import argparse
+import glob
+import json
+import os
+
+import dask
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Paths
+INTERMEDIATE_PATH = 'intermediate'
+
+# End of the name of the statistics file of an output file
+STATS_SUFFIX = '.qa.json'
+# Precision sums are accumulated in for means
+ACCUMULATION_DTYPE = 'float64'
+
+# Variables whose bounds in variable_parameters.csv apply to scaled data, not the output. rsds is bias adjusted
+# scaled to 0-1 and saved in W m-2.
+UNBOUNDED_OUTPUT = {'rsds': ['upper_bound']}
+
+
+# Statistics file of an output file
+def get_stats_file(file_path):
+    """
+    Function for getting the path of the statistics file of an output file
+    """
+    return f'{file_path}{STATS_SUFFIX}'
+
+
+# Bounds of a variable
+def get_bounds(variable, params):
+    """
+    Function for getting the lower and upper bounds the output of a variable should be within, from its
+    basd.Parameters (variable_parameters.csv), None where it has none
+    """
+    bounds = []
+    for bound in ['lower_bound', 'upper_bound']:
+        value = getattr(params, bound, None) if params is not None else None
+        if (value is None) or pd.isna(value) or (bound in UNBOUNDED_OUTPUT.get(variable, [])):
+            bounds.append(None)
+        else:
+            bounds.append(float(value))
+
+    return bounds
+
+
+# Statistics of the data of an output file
+def get_stats(data, lower_bound=None, upper_bound=None):
+    """
+    Function for getting the statistics of a variable (DataArray with time, lat and lon) lazily, as a dictionary of
+    Dask backed values to compute along with writing the data
+    """
+    count = data.count()
+    spatial_means = data.mean(['lat', 'lon'], dtype=ACCUMULATION_DTYPE)
+
+    stats = {
+        'count': count,
+        'nan_count': data.isnull().sum(),
+        'min': data.min(),
+        'max': data.max(),
+        'mean': data.sum(dtype=ACCUMULATION_DTYPE) / count,
+        'monthly_means': spatial_means.resample(time='MS').mean()
+    }
+    if lower_bound is not None:
+        stats['below_lower_bound'] = (data < lower_bound).sum()
+    if upper_bound is not None:
+        stats['above_upper_bound'] = (data > upper_bound).sum()
+
+    return stats
+
+
+# Save the statistics of an output file
+def save_stats(stats, file_path, variable, lower_bound=None, upper_bound=None):
+    """
+    Function for saving computed statistics (see get_stats) to the statistics file of an output file
+    """
+    record = {'file': os.path.basename(file_path), 'variable': variable,
+              'lower_bound': lower_bound, 'upper_bound': upper_bound}
+    for stat, value in stats.items():
+        if stat == 'monthly_means':
+            record[stat] = {f'{x.year:04d}-{x.month:02d}': (None if np.isnan(y) else float(y))
+                            for x, y in zip(value.indexes['time'], value.values)}
+        elif np.issubdtype(value.dtype, np.integer):
+            record[stat] = int(value)
+        else:
+            value = float(value)
+            record[stat] = None if np.isnan(value) else value
+
+    with open(get_stats_file(file_path), 'w') as stats_file:
+        json.dump(record, stats_file, indent=1)
+
+
+# Statistics of output files already written
+def save_file_stats(file_paths, variable, bounds=(None, None), time_chunk_size=None):
+    """
+    Function for computing and saving the statistics of output files written by basd, which can't be computed as
+    basd writes them. The files are read back one time chunk at a time, all in one Dask computation.
+    """
+    datasets = [xr.open_dataset(x, chunks={'time': time_chunk_size or -1}) for x in file_paths]
+    try:
+        stats, = dask.compute([get_stats(x[variable], *bounds) for x in datasets])
+    finally:
+        for data in datasets:
+            data.close()
+    for file_path, file_stats in zip(file_paths, stats):
+        save_stats(file_stats, file_path, variable, *bounds)
+
+
+# Statistics of the output files of a run
+def read_stats(run_name):
+    """
+    Function for collecting the statistics files of every output location of a run, one row per output file
+    """
+    run_details = pd.read_csv(os.path.join(INTERMEDIATE_PATH, run_name, 'run_manager_explicit_list.csv'))
+
+    records = []
+    for output_location in run_details['Output_Location'].unique():
+        for stats_file in sorted(glob.glob(os.path.join(output_location, '**', f'*{STATS_SUFFIX}'), recursive=True)):
+            with open(stats_file) as f:
+                record = json.load(f)
+            record.pop('monthly_means', None)
+            record['path'] = os.path.dirname(stats_file)
+            records.append(record)
+
+    return pd.DataFrame(records)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Collect the quality statistics of the output files of a run')
+    parser.add_argument('run_name', type=str, help='name of your experiment directory')
+    args = parser.parse_args()
+
+    stats = read_stats(args.run_name)
+    if stats.empty:
+        print('No quality statistics found')
+    else:
+        summary_file = os.path.join(INTERMEDIATE_PATH, args.run_name, 'qa_summary.csv')
+        stats.to_csv(summary_file, index=False)
+        print(f'Quality statistics of {len(stats)} files saved in {summary_file}')
+
+        # Files with problems
+        for column, problem in [('below_lower_bound', 'values below lower_bound'),
+                                ('above_upper_bound', 'values above upper_bound'),
+                                ('tasmin_above_tasmax', 'values with tasmin above tasmax')]:
+            if column in stats:
+                for row in stats[stats[column] > 0].itertuples():
+                    print(f'{row.file}: {getattr(row, column)} {problem}')
+        for row in stats[stats['count'] == 0].itertuples():
+            print(f'{row.file}: no data')
@@ -0,0 +1,270 @@
+"""
+Memory guarded execution of the steps of a BASD task. When a Dask worker runs out of memory (is killed by the
+nanny or the OS) during a step, the step is retried with smaller lat/lon chunks, or fewer workers that each get
+more memory, instead of the whole task failing. The settings of the last successful attempt are saved per grid and
+step in intermediate/<run_name>/chunk_settings/<ESM>_<Reference_Dataset>/<step>.csv, so later tasks on the same grid
+start from them rather than failing the same way, and go back up toward the configured settings after steps that
+finish without coming close to running out of memory.
+"""
+
+# Importing Needed Libraries
+import contextlib  # Closing replacement clusters
+import datetime  # Time stamps
+import os  # For navigating os
+import re  # Matching worker error messages
+import shutil  # Clearing temp directories between attempts
+import time  # Waiting for workers
+
+import metrics  # Timing and memory metrics
+import pandas as pd  # Reading and writing settings
+from distributed import KilledWorker  # Raised when workers keep dying running a Dask task
+
+# CONSTANTS
+INTERMEDIATE_PATH = 'intermediate'
+# Number of times a step is retried before giving up
+MAX_RETRIES = 3
+# Fraction of a worker's memory limit which, when reached during a successful step, makes later tasks start smaller
+MEMORY_PRESSURE = 0.9
+# Seconds to wait for replacement workers to start
+WORKER_TIMEOUT = 120
+# Message of the nanny when it restarts a worker that used too much memory, ex. "Worker tcp://127.0.0.1:40000
+# (pid=1234) exceeded 95% memory budget. Restarting..."
+MEMORY_BUDGET_MESSAGE = re.compile(r'exceeded \d+(\.\d+)?% memory budget')
+
+# Cluster and task being supervised (set in start). The cluster is replaced by one with fewer workers if they run out
+# of memory (see set_n_workers), the task's own cluster is kept in task_client and task_cluster.
+client = None
+cluster = None
+task_client = None
+task_cluster = None
+# Closes the replacement cluster and its client, which is the current client while it's open
+replacement_stack = None
+settings_dir = None
+max_retries = MAX_RETRIES
+# Number of workers the task's own cluster was started with, which saved settings grow back toward
+configured_n_workers = None
+
+
+# Start supervising a task
+def start(dask_client, dask_cluster, run_name, run_object, retries=None):
+    """
+    Function for starting supervision of a task. Without it, steps are run once with the chunk sizes given.
+    """
+    global client, cluster, task_client, task_cluster, settings_dir, max_retries, configured_n_workers
+
+    client = task_client = dask_client
+    cluster = task_cluster = dask_cluster
+    settings_dir = os.path.join(INTERMEDIATE_PATH, run_name, 'chunk_settings',
+                                f'{run_object.ESM}_{run_object.Reference_Dataset}')
+    os.makedirs(settings_dir, exist_ok=True)
+    max_retries = MAX_RETRIES if pd.isna(retries) else int(retries)
+    configured_n_workers = get_n_workers()
+
+
+# Run one step, retrying with less memory use if workers run out of memory
+def run_step(name, step_function, lat_chunk, lon_chunk, chunked=True, temp_dir=None):
+    """
+    Function for running one step of a task (ex. bias adjustment). step_function is called with the lat and lon
+    chunk sizes to use. When workers run out of memory the step is retried, first with half the lat/lon chunk size
+    (when chunked is True), then with half the workers. temp_dir is cleared between attempts.
+    """
+    # Not supervised, just run the step
+    if client is None:
+        return step_function(lat_chunk, lon_chunk)
+
+    # Start from settings that worked for earlier tasks on this grid
+    configured_lat_chunk, configured_lon_chunk = lat_chunk, lon_chunk
+    lat_chunk, lon_chunk, n_workers = get_start_settings(name, lat_chunk, lon_chunk)
+    if n_workers < get_n_workers():
+        set_n_workers(n_workers)
+
+    attempt = 0
+    while True:
+        first_stage = len(metrics.get_stages())
+        try:
+            result = step_function(lat_chunk, lon_chunk)
+            break
+        except Exception as e:
+            if not is_memory_error(e) or attempt >= max_retries:
+                raise
+            attempt += 1
+
+            # Reduce memory use for the next attempt
+            if chunked and (lat_chunk > 1 or lon_chunk > 1):
+                lat_chunk, lon_chunk = max(lat_chunk // 2, 1), max(lon_chunk // 2, 1)
+            elif get_n_workers() > 1:
+                set_n_workers(max(get_n_workers() // 2, 1))
+            else:
+                raise
+            print(f'Workers ran out of memory during {name} ({type(e).__name__}), retry {attempt} of {max_retries} '
+                  f'with lat/lon chunks {lat_chunk}/{lon_chunk} and {get_n_workers()} workers', flush=True)
+            metrics.record(**{f'{name}_retries': attempt})
+
+            # Clear anything the failed attempt left behind
+            if temp_dir is not None:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                os.makedirs(temp_dir, exist_ok=True)
+
+    # Close to running out of memory, start later tasks on this grid a step smaller. Far from it on the first attempt,
+    # a step larger, up to the configured settings. Otherwise with the settings of this (successful) attempt.
+    pressure = under_pressure(metrics.get_stages()[first_stage:])
+    next_lat_chunk, next_lon_chunk, next_n_workers = lat_chunk, lon_chunk, get_n_workers()
+    if pressure and chunked:
+        next_lat_chunk, next_lon_chunk = max(lat_chunk // 2, 1), max(lon_chunk // 2, 1)
+    elif not pressure and attempt == 0:
+        if next_n_workers < configured_n_workers:
+            next_n_workers = min(next_n_workers * 2, configured_n_workers)
+        elif chunked:
+            next_lat_chunk = min(lat_chunk * 2, configured_lat_chunk)
+            next_lon_chunk = min(lon_chunk * 2, configured_lon_chunk)
+    save_settings(name, next_lat_chunk, next_lon_chunk, next_n_workers, attempt, pressure)
+
+    return result
+
+
+# Whether an error was caused by running out of memory
+def is_memory_error(error):
+    """
+    Function for checking whether an error was caused by a worker running out of memory
+    """
+    if isinstance(error, (MemoryError, KilledWorker)):
+        return True
+
+    # Workers restarted by the nanny for going over their memory limit
+    return MEMORY_BUDGET_MESSAGE.search(str(error)) is not None
+
+
+# Whether a step came close to running out of memory
+def under_pressure(stages):
+    """
+    Function for checking if the workers came close to their memory limit, or spilled to disk, during the given stages
+    """
+    if not stages:
+        return False
+
+    memory_limit = min(get_memory_limits(), default=0)
+    worker_peak_mb = max([x['worker_peak_rss_mb'] or 0 for x in stages])
+    spilled = sum([x['spilled_bytes'] for x in stages]) > 0
+
+    return spilled or (memory_limit > 0 and worker_peak_mb * 1024 ** 2 >= MEMORY_PRESSURE * memory_limit)
+
+
+# Settings to start a step with
+def get_start_settings(name, lat_chunk, lon_chunk):
+    """
+    Function for getting the chunk sizes and number of workers to start a step with. Uses the settings saved by the
+    last task on the same grid to run the step, if any, no larger than the configured settings.
+    """
+    n_workers = get_n_workers()
+    settings_file = os.path.join(settings_dir, f'{name}.csv')
+    if os.path.exists(settings_file):
+        settings = pd.read_csv(settings_file).iloc[0]
+        lat_chunk = min(lat_chunk, int(settings['lat_chunk']))
+        lon_chunk = min(lon_chunk, int(settings['lon_chunk']))
+        n_workers = min(n_workers, int(settings['n_workers']))
+
+    return lat_chunk, lon_chunk, n_workers
+
+
+# Save the settings for the next task to start a step with
+def save_settings(name, lat_chunk, lon_chunk, n_workers, retries, pressure):
+    """
+    Function for saving the settings the next task on the grid starts a step with. Each step has its own file, so
+    tasks finishing different steps at the same time don't overwrite each other's settings, and the file is written
+    under a temporary name and moved into place in one go.
+    """
+    settings = pd.DataFrame([{'step': name, 'lat_chunk': lat_chunk, 'lon_chunk': lon_chunk, 'n_workers': n_workers,
+                              'retries': retries, 'pressure': pressure,
+                              'updated': datetime.datetime.now().isoformat(timespec='seconds')}])
+
+    settings_file = os.path.join(settings_dir, f'{name}.csv')
+    temp_file = f'{settings_file}.{os.getpid()}.tmp'
+    settings.to_csv(temp_file, index=False)
+    os.replace(temp_file, settings_file)
+
+
+# Number of Dask workers
+def get_n_workers():
+    """
+    Function for getting the current number of Dask workers
+    """
+    return len(client.scheduler_info()['workers'])
+
+
+# Memory limits of the Dask workers
+def get_memory_limits():
+    """
+    Function for getting the memory limit (bytes) of each Dask worker
+    """
+    return [x.get('memory_limit') or 0 for x in client.scheduler_info()['workers'].values()]
+
+
+# Change the number of workers, giving each the memory of the workers removed
+def set_n_workers(n_workers):
+    """
+    Function for replacing the Dask cluster with one of n_workers workers, sharing the same total memory. Workers have
+    their memory limit set when they start, so a new cluster is started with the new memory limit, after the workers
+    of the current one are stopped. The new client is the current client, used by the task's computations, until the
+    cluster is replaced again or supervision stops.
+    """
+    global client, cluster, replacement_stack
+    from dask.distributed import (Client, LocalCluster)
+
+    total_memory = sum(get_memory_limits())
+    try:
+        release_cluster()
+        replacement_stack = contextlib.ExitStack()
+        cluster = replacement_stack.enter_context(LocalCluster(
+            n_workers=n_workers, processes=True, threads_per_worker=1,
+            memory_limit=(total_memory // n_workers) if total_memory > 0 else 'auto'
+        ))
+        client = replacement_stack.enter_context(Client(cluster))
+    except Exception as e:
+        print(f'Warning: could not replace Dask workers, scaling down instead: {e}', flush=True)
+        client, cluster = task_client, task_cluster
+        cluster.scale(n_workers)
+        wait_for_n_workers(n_workers)
+    metrics.client = client
+
+
+# Stop the workers of the current cluster
+def release_cluster():
+    """
+    Function for freeing the memory of the current Dask workers: a replacement cluster is closed, and the task's own
+    cluster (which its caller closes) is scaled to no workers
+    """
+    global replacement_stack
+
+    if cluster is task_cluster:
+        cluster.scale(0)
+        wait_for_n_workers(0)
+    elif replacement_stack is not None:
+        replacement_stack.close()
+        replacement_stack = None
+
+
+# Stop supervising a task
+def stop():
+    """
+    Function for closing the cluster started by set_n_workers, if any, and going back to the task's own cluster. Its
+    workers aren't started again, a caller running more tasks on it (see daemon.py) scales it back up.
+    """
+    global client, cluster, task_client, task_cluster, replacement_stack
+
+    if replacement_stack is not None:
+        replacement_stack.close()
+        replacement_stack = None
+        metrics.client = task_client
+    client = cluster = task_client = task_cluster = None
+
+
+# Wait for workers to start or close
+def wait_for_n_workers(n_workers):
+    """
+    Function for waiting until there are n_workers Dask workers
+    """
+    start_time = time.time()
+    while get_n_workers() != n_workers:
+        if time.time() - start_time > WORKER_TIMEOUT:
+            raise TimeoutError(f'Dask workers did not reach {n_workers} within {WORKER_TIMEOUT} seconds')
+        time.sleep(1)
@@ -0,0 +1,306 @@
+"""
+Description: This script collects the metrics recorded by every BASD task of a run, joins them with the run's
+             explicit list of tasks, and reports where time and memory went. Used to size the settings in
+             slurm_parameters.csv and dask_parameters.csv.
+Input:
+    - intermediate/<run_name>/run_manager_explicit_list.csv - details of each task in the run
+    - intermediate/<run_name>/metrics/task_<task_id>.jsonl - metrics recorded by each task (see metrics.py)
+    - .out/<run_name>_BASD_<job id>_<task id>.out - slurm logs, used for tasks with no metrics file
+Output:
+    - intermediate/<run_name>/telemetry/tasks.csv - one row per task with its metrics and details
+    - intermediate/<run_name>/telemetry/stages.csv - one row per step of each task
+    - intermediate/<run_name>/telemetry/summary.csv - totals grouped by ESM, variable and scenario
+    - Report printed to the terminal
+Usage:
+    python code/python/telemetry_report.py <run_name> [--top 10]
+"""
+
+# Import Libraries
+import argparse
+import glob
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+# Paths
+INTERMEDIATE_PATH = 'intermediate'
+LOG_PATH = '.out'
+
+# Columns used to group tasks in the report
+GROUP_COLUMNS = ['ESM', 'Variable', 'Scenario']
+
+# Messages in slurm logs that tell us why a task without metrics stopped
+LOG_FAILURES = {
+    'timeout': ['DUE TO TIME LIMIT'],
+    'out_of_memory': ['oom-kill', 'Out Of Memory', 'MemoryError', 'KilledWorker'],
+    'failed': ['Traceback', 'CANCELLED']
+}
+
+
+# Read the metrics of every task in the run
+def read_metrics(run_name):
+    """
+    Function for reading the metrics files of every task, and the METRICS lines of slurm logs for tasks that
+    don't have a metrics file. Returns lists of task records and stage records.
+    """
+    task_records, stage_records = [], []
+
+    # Metrics files written by each task
+    metrics_files = glob.glob(os.path.join(INTERMEDIATE_PATH, run_name, 'metrics', 'task_*.jsonl'))
+    for metrics_file in metrics_files:
+        with open(metrics_file) as file:
+            add_records([json.loads(line) for line in file if line.strip()], task_records, stage_records)
+
+    # Slurm logs of tasks without a metrics file
+    found_tasks = {x['task_id'] for x in task_records + stage_records}
+    for task_id, log_files in get_log_files(run_name).items():
+        if task_id in found_tasks:
+            continue
+        for log_file in log_files:
+            records = read_log_metrics(log_file)
+            if records:
+                add_records(records, task_records, stage_records)
+            else:
+                # No metrics at all, record what we can find from the log
+                task_records.append({'task_id': task_id, 'status': get_log_status(log_file), 'log_file': log_file})
+
+    return task_records, stage_records
+
+
+# Sort records into task summaries and stages
+def add_records(records, task_records, stage_records):
+    """
+    Function for sorting metrics records into task summaries and stages. Attempts that stopped before writing
+    a summary (ex. killed by slurm) are summarised from their stages.
+    """
+    attempt_stages = []
+    for metrics_record in records:
+        if metrics_record.get('type') == 'task':
+            task_records.append(metrics_record)
+            stage_records.extend(attempt_stages)
+            attempt_stages = []
+        else:
+            # A new attempt of the task started without the previous one finishing
+            if attempt_stages and metrics_record.get('start') != attempt_stages[0].get('start'):
+                task_records.append(summarise_unfinished(attempt_stages))
+                stage_records.extend(attempt_stages)
+                attempt_stages = []
+            attempt_stages.append(metrics_record)
+
+    if attempt_stages:
+        task_records.append(summarise_unfinished(attempt_stages))
+        stage_records.extend(attempt_stages)
+
+
+# Summary of an attempt that never finished
+def summarise_unfinished(stages):
+    """
+    Function for creating a task summary from the stages of an attempt that stopped before finishing
+    """
+    summary = {key: value for key, value in stages[0].items()
+               if key not in ['type', 'stage', 'status', 'wall_seconds', 'peak_rss_mb', 'worker_peak_rss_mb',
+                              'n_workers', 'dask_tasks', 'spilled_bytes', 'read_bytes', 'written_bytes']}
+    summary.update({
+        'type': 'task',
+        'status': 'unfinished',
+        'last_stage': stages[-1]['stage'],
+        'wall_seconds': sum([x['wall_seconds'] for x in stages]),
+        'peak_rss_mb': max([x['peak_rss_mb'] or 0 for x in stages]),
+        'worker_peak_rss_mb': max([x['worker_peak_rss_mb'] or 0 for x in stages]),
+        'spilled_bytes': sum([x['spilled_bytes'] for x in stages]),
+    })
+
+    return summary
+
+
+# Find slurm logs of the BASD tasks
+def get_log_files(run_name):
+    """
+    Function for finding the slurm logs of each BASD task. Returns a dictionary of task id to list of log files,
+    in the order they were run. More than one log means the task was resubmitted.
+    """
+    log_pattern = re.compile(rf'{re.escape(run_name)}_BASD_(\d+)_(\d+)\.out$')
+    log_files = {}
+    for log_file in sorted(glob.glob(os.path.join(LOG_PATH, f'{run_name}_BASD_*.out')), key=os.path.getmtime):
+        match = log_pattern.search(log_file)
+        if match:
+            log_files.setdefault(int(match.group(2)), []).append(log_file)
+
+    return log_files
+
+
+# METRICS lines printed to a slurm log
+def read_log_metrics(log_file):
+    """
+    Function for reading the metrics records printed to a slurm log
+    """
+    records = []
+    with open(log_file, errors='replace') as file:
+        for line in file:
+            if line.startswith('METRICS '):
+                try:
+                    records.append(json.loads(line[len('METRICS '):]))
+                except json.JSONDecodeError:
+                    pass
+
+    return records
+
+
+# Why a task without metrics stopped
+def get_log_status(log_file):
+    """
+    Function for guessing the status of a task from its slurm log
+    """
+    with open(log_file, errors='replace') as file:
+        log = file.read()
+
+    for status, messages in LOG_FAILURES.items():
+        if any([message in log for message in messages]):
+            return status
+    if 'Run completed in' in log:
+        return 'completed'
+
+    return 'unknown'
+
+
+# Join the metrics with the details of each task
+def get_task_table(run_name, task_records):
+    """
+    Function for joining task metrics with the run's explicit list of tasks. Every task in the list gets a row,
+    tasks with no metrics are marked as not run. Throughput is given in cell-years (downscaled grid cells times
+    years of output) per second.
+    """
+    explicit_list = pd.read_csv(os.path.join(INTERMEDIATE_PATH, run_name, 'run_manager_explicit_list.csv'))
+    # Without stacked ensemble members, each row is its own task
+    if 'task_id' not in explicit_list:
+        explicit_list['task_id'] = np.arange(explicit_list.shape[0])
+    # Stacked ensemble members share one task, list them together
+    else:
+        explicit_list['Ensemble'] = explicit_list['Ensemble'].astype(str)
+        explicit_list = explicit_list.groupby('task_id', as_index=False, sort=True).agg(
+            {x: (';'.join if x == 'Ensemble' else 'first') for x in explicit_list.columns if x != 'task_id'}
+        )
+
+    # Every attempt of each task, the last attempt is the one that counts
+    attempts = pd.DataFrame(task_records, columns=['task_id', 'status', 'error', 'last_stage', 'wall_seconds',
+                                                   'peak_rss_mb', 'worker_peak_rss_mb', 'spilled_bytes',
+                                                   'n_lat', 'n_lon', 'n_days', 'n_cell_days', 'ensemble_members', 'start',
+                                                   'host'])
+    attempts['task_id'] = attempts['task_id'].astype(int)
+    attempts = attempts.sort_values(['task_id', 'start'], na_position='first')
+    attempts['attempts'] = attempts.groupby('task_id')['task_id'].transform('size')
+    attempts['failed_attempts'] = attempts.groupby('task_id')['status'].transform(lambda x: (x != 'completed').sum())
+    last_attempts = attempts.groupby('task_id').tail(1)
+
+    # Join with task details, the metrics records also have ESM, Variable etc. so only keep those from the list
+    tasks = explicit_list.merge(last_attempts, on='task_id', how='left')
+    tasks['status'] = tasks['status'].fillna('not_run')
+    tasks['attempts'] = tasks['attempts'].fillna(0).astype(int)
+    tasks['failed_attempts'] = tasks['failed_attempts'].fillna(0).astype(int)
+
+    # Throughput in cell-years per second, over every ensemble member and configuration of a task. Metrics recorded
+    # without n_cell_days only have the size of one of them.
+    cell_days = tasks['n_lat'] * tasks['n_lon'] * tasks['n_days'] * tasks['ensemble_members'].fillna(1)
+    tasks['cell_years'] = tasks['n_cell_days'].fillna(cell_days) / 365.25
+    tasks['cell_years_per_second'] = tasks['cell_years'] / tasks['wall_seconds']
+
+    return tasks
+
+
+# Print the report
+def print_report(tasks, stages, top):
+    """
+    Function for printing the bottleneck report to the terminal
+    """
+    completed = tasks[tasks['status'] == 'completed']
+
+    print(f'======================================================')
+    print(f'Tasks: {tasks.shape[0]}')
+    for status, count in tasks['status'].value_counts().items():
+        print(f'    {status}: {count}')
+    print(f'Tasks retried: {(tasks["attempts"] > 1).sum()}')
+
+    if completed.shape[0] > 0:
+        print(f'Wall time (minutes): median {completed["wall_seconds"].median() / 60:.1f}, '
+              f'max {completed["wall_seconds"].max() / 60:.1f}')
+        print(f'Throughput (cell-years/s): median {completed["cell_years_per_second"].median():.1f}')
+        print(f'Peak memory, main process (MB): max {completed["peak_rss_mb"].max():.0f}')
+        print(f'Peak memory, single Dask worker (MB): max {completed["worker_peak_rss_mb"].max():.0f}')
+        print(f'Spilled to disk by Dask (GB): total {completed["spilled_bytes"].sum() / 1e9:.2f}')
+
+    # Slowest tasks
+    print(f'======================================================')
+    print(f'Slowest {top} tasks:')
+    columns = ['task_id'] + GROUP_COLUMNS + ['wall_seconds', 'cell_years_per_second', 'worker_peak_rss_mb', 'status']
+    print(tasks.sort_values('wall_seconds', ascending=False)[columns].head(top).to_string(index=False))
+
+    # Slowest groups
+    print(f'======================================================')
+    print('Time by ESM / Variable / Scenario:')
+    print(get_summary(tasks).head(top).to_string())
+
+    # Slowest stages
+    if stages.shape[0] > 0:
+        print(f'======================================================')
+        print('Time by step:')
+        stage_summary = stages.groupby('stage').agg(
+            total_minutes=('wall_seconds', lambda x: x.sum() / 60),
+            median_seconds=('wall_seconds', 'median'),
+            max_seconds=('wall_seconds', 'max'),
+            max_worker_peak_rss_mb=('worker_peak_rss_mb', 'max')
+        ).sort_values('total_minutes', ascending=False)
+        print(stage_summary.to_string())
+
+    # Tasks that need attention
+    problems = tasks[(tasks['status'] != 'completed') | (tasks['failed_attempts'] > 0)]
+    if problems.shape[0] > 0:
+        print(f'======================================================')
+        print('Failed, unfinished or retried tasks:')
+        columns = ['task_id'] + GROUP_COLUMNS + ['status', 'attempts', 'failed_attempts', 'last_stage', 'error']
+        print(problems[columns].to_string(index=False))
+    print(f'======================================================')
+
+
+# Totals by ESM, variable and scenario
+def get_summary(tasks):
+    """
+    Function for summarising the tasks by ESM, variable and scenario, slowest first
+    """
+    return tasks.groupby(GROUP_COLUMNS).agg(
+        tasks=('task_id', 'size'),
+        completed=('status', lambda x: (x == 'completed').sum()),
+        total_minutes=('wall_seconds', lambda x: x.sum() / 60),
+        max_minutes=('wall_seconds', lambda x: x.max() / 60),
+        cell_years_per_second=('cell_years_per_second', 'median'),
+        max_peak_rss_mb=('peak_rss_mb', 'max'),
+        max_worker_peak_rss_mb=('worker_peak_rss_mb', 'max'),
+        retries=('failed_attempts', 'sum')
+    ).sort_values('total_minutes', ascending=False)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Report on the time and memory used by the BASD tasks of a run')
+    parser.add_argument('run_name', type=str, help='name of your experiment directory')
+    parser.add_argument('--top', type=int, default=10, help='number of slowest tasks / groups to show')
+    args = parser.parse_args()
+
+    # Collect metrics and join with task details
+    task_records, stage_records = read_metrics(args.run_name)
+    tasks = get_task_table(args.run_name, task_records)
+    stages = pd.DataFrame(stage_records, columns=['task_id', 'stage', 'status', 'wall_seconds', 'peak_rss_mb',
+                                                  'worker_peak_rss_mb', 'dask_tasks', 'spilled_bytes',
+                                                  'read_bytes', 'written_bytes'])
+
+    # Save tables
+    output_dir = os.path.join(INTERMEDIATE_PATH, args.run_name, 'telemetry')
+    os.makedirs(output_dir, exist_ok=True)
+    tasks.to_csv(os.path.join(output_dir, 'tasks.csv'), index=False)
+    stages.to_csv(os.path.join(output_dir, 'stages.csv'), index=False)
+    get_summary(tasks).to_csv(os.path.join(output_dir, 'summary.csv'))
+
+    print_report(tasks, stages, args.top)
+    print(f'Tables saved in {output_dir}')
@@ -1,35 +1,235 @@
+import glob
+import hashlib
+import json
+import math
 import os
+import re
+import shutil
+import socket
+import tempfile
 
-import basd
 import numpy as np
 import pandas as pd
 import xarray as xr
 
 
+# Output chunk layouts (see get_chunk_layout), and the default size of their chunks
+CHUNK_LAYOUTS = ['map', 'timeseries', 'balanced']
+TARGET_CHUNK_MB = 4
+# Settings of encoding.csv used to choose chunk sizes, not passed on to xarray.to_netcdf()
+LAYOUT_SETTINGS = ['layout', 'target_chunk_mb', 'timeseries_copy']
+
+# Settings of attributes.csv giving the precision a variable is saved with, used in the encoding instead of being
+# saved as attributes
+PRECISION_SETTINGS = ['keepbits', 'least_significant_digit']
+
+# Coarse grid cells added on each side of the latitude band of a tiled task, so that the cells at the edge of the
+# band are downscaled with their neighbours (see get_tile_rows)
+TILE_HALO = 1
+
+# Days of reference data used to find the grid cells that have data (see get_valid_cells)
+VALID_CELL_DAYS = 31
+
+# Variables computed from other variables as they are read, when there are no files of their own (see
+# open_derived_data), with the variables they are computed from (inputs) and how (function of the inputs). Both
+# registries can give a compute_dtype, ex. 'float64', for a function that loses too much precision in float32 (see
+# compute_variable).
+DERIVED_VARIABLES = {
+    'tasrange': {'inputs': ['tasmin', 'tasmax'],
+                 'function': lambda tasmin, tasmax: tasmax - tasmin},
+    'tasskew': {'inputs': ['tas', 'tasmin', 'tasmax'],
+                'function': lambda tas, tasmin, tasmax: (tas - tasmin) / (tasmax - tasmin)}
+}
+
+# Variables created from the BASD output of other variables by create_tasmin_tasmax.py, with the variables they are
+# created from (inputs), how (function of the inputs), and their attributes if attributes.csv has none. Asking for
+# one in the run manager runs BASD for its inputs instead.
+DERIVED_OUTPUTS = {
+    'tasmin': {'inputs': ['tas', 'tasrange', 'tasskew'],
+               'function': lambda tas, tasrange, tasskew: tas - tasskew * tasrange,
+               'attributes': {'long_name': 'Daily Minimum Near-Surface Air Temperature', 'units': 'K',
+                              'standard_name': 'air_temperature'}},
+    'tasmax': {'inputs': ['tas', 'tasrange', 'tasskew'],
+               'function': lambda tas, tasrange, tasskew: tas - tasskew * tasrange + tasrange,
+               'attributes': {'long_name': 'Daily Maximum Near-Surface Air Temperature', 'units': 'K',
+                              'standard_name': 'air_temperature'}},
+    'prsn': {'inputs': ['pr', 'prsnratio'],
+             'function': lambda pr, prsnratio: pr * prsnratio,
+             'attributes': {'long_name': 'Snowfall Flux', 'units': 'kg m-2 s-1', 'standard_name': 'snowfall_flux'}}
+}
+
+# Directory of reference period data rechunked once and shared by the tasks and ensemble members using it (see
+# open_reference_data)
+reference_cache_dir = None
+
+# Directory on node-local scratch for the temporary and unfinished output files of the current task (see
+# start_staging)
+staging_dir = None
+
+# Local copies of input files and Pangeo stores made ahead of the task that reads them, {source: (copy, stamp)} (see
+# prefetch.py)
+prefetched_files = {}
+
+# Settings of the current task from the run plan (see plan.py), used instead of reading the input files
+task_plan = None
+
+# Precision data is read and computed in, the precision of the output (see use_compute_dtype)
+compute_dtype = np.dtype('float32')
+# Variables already warned about being in more precision than compute_dtype in the current task, {(variable, source)}
+promotion_warnings = set()
+
+
+# Compute in the precision of the output
+def use_compute_dtype(encoding):
+    """
+    Function for reading and computing data in the precision the output is saved with (dtype of encoding.csv),
+    float32 unless float64 is asked for. Data read or computed in more precision is cast to it (see
+    to_compute_dtype), rather than carried through the task at twice the memory and cast when it's saved.
+    """
+    global compute_dtype
+    dtype = np.dtype(encoding.get('dtype', 'float32'))
+    compute_dtype = dtype if np.issubdtype(dtype, np.floating) else np.dtype('float32')
+
+
+# Cast data to the precision it's computed in
+def to_compute_dtype(data, variable, source):
+    """
+    Function for lazily casting data (DataArray) of a variable to compute_dtype, chunk by chunk. If the data was in
+    more precision, ex. float64 from scale_factor/add_offset decoding, float64 files or float64 scalars, a warning
+    is printed once for the variable and source (where it was read or computed).
+    """
+    if data.dtype == compute_dtype:
+        return data
+
+    promoted = np.issubdtype(data.dtype, np.floating) and (data.dtype.itemsize > compute_dtype.itemsize)
+    if promoted and ((variable, source) not in promotion_warnings):
+        print(f'Warning: {variable} {source} as {data.dtype}, casting to {compute_dtype}', flush=True)
+        promotion_warnings.add((variable, source))
+
+    return data.astype(compute_dtype)
+
+
+# Compute a derived variable
+def compute_variable(definition, inputs, variable):
+    """
+    Function for computing a derived variable from its inputs (DataArrays), with its definition from
+    DERIVED_VARIABLES or DERIVED_OUTPUTS, in compute_dtype. A definition giving its own compute_dtype is computed in
+    that, and the result cast back without a warning.
+    """
+    dtype = definition.get('compute_dtype')
+    if dtype is not None:
+        return definition['function'](*[x.astype(dtype) for x in inputs]).astype(compute_dtype)
+
+    return to_compute_dtype(definition['function'](*inputs), variable, 'computed')
+
+
+# Use the settings of a task from the run plan
+def use_task_plan(plan_settings):
+    """
+    Function for setting the settings from the run plan that the functions below return, instead of reading them
+    from the input files
+    """
+    global task_plan
+    task_plan = plan_settings
+
+
 # Get relevant parameters object
 def get_parameters(run_object, input_path):
     """
-    Function for reading parameters for the relevant variable and returning a basd.Parameters object
+    Function for reading parameters for the relevant variable, and configuration of a parameter sweep if the task
+    has one (run_object.config_id), and returning a basd.Parameters object
+    """
+    config_id = getattr(run_object, 'config_id', None)
+
+    # Types were checked and set when the run plan was compiled
+    if task_plan is not None:
+        param_dict = dict(task_plan['parameters'] if config_id is None else task_plan['configs'][config_id])
+    else:
+        param_dict = read_parameters(run_object.Variable, input_path, config_id)
+
+        # Make n_iterations an integer
+        if 'n_iterations' in param_dict:
+            param_dict['n_iterations'] = int(param_dict['n_iterations'])
+        # Make halfwin_ubc an integer
+        if 'halfwin_ubc' in param_dict:
+            param_dict['halfwin_ubc'] = int(param_dict['halfwin_ubc'])
+
+    # Create basd.Parameters object, basd is only imported here so that the job scripts can be generated without it
+    import basd
+    param_obj = basd.Parameters(**param_dict)
+    
+    return param_obj
+
+
+# Read parameters of a variable
+def read_parameters(variable, input_path, config_id=None):
+    """
+    Function for reading the parameters of the given variable from the input file, as a dictionary. For a parameter
+    sweep, the parameters of the configuration with the given config_id.
     """
     # Read in input parameter data
     param_data = pd.read_csv(os.path.join(input_path, 'variable_parameters.csv'))
+    param_data = param_data[param_data.variable == variable]
+    if config_id is not None:
+        param_data = param_data[[format_config_id(x) == config_id for x in param_data['config_id']]]
 
     # Get parameter data for relevant variable as dictionary
-    param_dict = param_data[param_data.variable == run_object.Variable].dropna(axis=1).to_dict(orient='records')[0]
+    param_dict = param_data.dropna(axis=1).to_dict(orient='records')[0]
     del param_dict['variable'] # Parameters object doesn't take 'variable', was only needed to filter data
+    param_dict.pop('config_id', None)
 
-    # Make n_iterations an integer
-    # TODO: Fix inherent type troubles from csv input
-    if 'n_iterations' in param_dict:
-        param_dict['n_iterations'] = int(param_dict['n_iterations'])
-    # Make halfwin_ubc an integer
-    if 'halfwin_ubc' in param_dict:
-        param_dict['halfwin_ubc'] = int(param_dict['halfwin_ubc'])
+    return param_dict
 
-    # Create basd.Parameters object
-    param_obj = basd.Parameters(**param_dict)
-    
-    return param_obj
+
+# Read the configurations of a parameter sweep
+def read_config_ids(variable, input_path):
+    """
+    Function for reading the config_id of each row of the given variable in the parameters input file, in order. A
+    variable with no config_id has one configuration, [None].
+    """
+    param_data = pd.read_csv(os.path.join(input_path, 'variable_parameters.csv'))
+    if 'config_id' not in param_data:
+        return [None]
+    config_ids = [format_config_id(x) for x in param_data[param_data.variable == variable]['config_id']]
+
+    return [None] if all(x is None for x in config_ids) else config_ids
+
+
+# Configurations of a parameter sweep
+def get_config_ids(run_object, input_path):
+    """
+    Function for getting the config_ids of the parameter configurations a task runs, or [None] if the variable has
+    only one configuration
+    """
+    if task_plan is not None:
+        return list(task_plan.get('configs', {})) or [None]
+
+    return read_config_ids(run_object.Variable, input_path)
+
+
+# Name of a configuration
+def format_config_id(config_id):
+    """
+    Function for formatting a config_id as read from the parameters input file, ex. 1.0 as 1, or None if missing
+    """
+    if pd.isna(config_id):
+        return None
+    if isinstance(config_id, float) and config_id.is_integer():
+        return str(int(config_id))
+
+    return str(config_id).strip()
+
+
+# Output file name of one configuration
+def get_config_file_name(file_name, run_object):
+    """
+    Function for getting the name of the file a configuration of a parameter sweep writes in place of file_name
+    """
+    config_id = getattr(run_object, 'config_id', None)
+    if (file_name is None) or (config_id is None):
+        return file_name
+
+    return f'{os.path.splitext(file_name)[0]}_{config_id}.nc'
 
 
 # Function for getting the sizes of chunks to be using while performing dask operations on data
@@ -37,10 +237,23 @@ def get_chunk_sizes(input_path):
     """
     Function for getting the sizes of chunks to be using while performing dask operations on data
     """
+    if task_plan is not None:
+        dask_params = task_plan['dask']
+    else:
+        dask_params = read_dask_settings(input_path)
+    
+    return dask_params['time_chunk_size'], dask_params['lat_chunk_size'], dask_params['lon_chunk_size'], dask_params['dask_temp_directory']
+
+
+# Read Dask settings
+def read_dask_settings(input_path):
+    """
+    Function for reading the Dask settings from the input file, as a dictionary
+    """
     # Read in input parameter data
     dask_params = pd.read_csv(os.path.join(input_path, 'dask_parameters.csv'))
-    
-    return dask_params['time_chunk_size'][0], dask_params['lat_chunk_size'][0], dask_params['lon_chunk_size'][0], dask_params['dask_temp_directory'][0]
+
+    return dask_params.iloc[0].to_dict()
 
 
 # Get attributes for given variable, and global
@@ -48,6 +261,10 @@ def get_attributes(variable, input_path):
     """
     Function for reading in variable and global attributes from input file
     """
+    if task_plan is not None:
+        variable_attribute_dict, global_monthly_attribute_dict, global_daily_attribute_dict = task_plan['attributes']
+        return dict(variable_attribute_dict), dict(global_monthly_attribute_dict), dict(global_daily_attribute_dict)
+
     # Read in input parameter data
     attribute_data = pd.read_csv(os.path.join(input_path, 'attributes.csv'))
 
@@ -85,35 +302,828 @@ def reset_chunk_sizes(chunk_size_tuple, dims_dict):
     return (time_chunk, lat_chunk, lon_chunk)
 
 
-# Function for loading in data for statistical downscaling routine, including trimming to respective periods
-def load_sd_data(run_object, input_ref_dir, time_chunk_size, output_ba_path, output_day_ba_file_name):
+# Encoding for data on a given grid
+def get_output_encoding(encoding, reset_chunksizes, sizes):
     """
-    Function for loading in data for statistical downscaling routine, including trimming to respective periods
+    Function for getting a copy of the encoding settings with chunk sizes for data of the given sizes (dictionary of
+    time, lat and lon sizes, ex. Dataset.sizes). Chunk sizes come from the layout if one is given, or else from
+    encoding.csv with "max" replaced by the size of the dimension. Without either, chunking is left to the default.
+    encoding itself isn't changed, so it can be used again for data on a different grid (ex. bias adjusted then
+    downscaled).
     """
-    # Load in data for downscaling
-    obs_reference_data = xr.open_mfdataset(os.path.join(input_ref_dir, f'{run_object.Variable}_*.nc'), chunks={'time': time_chunk_size})
-    sim_application_data = xr.open_mfdataset(os.path.join(output_ba_path, output_day_ba_file_name), chunks={'time': time_chunk_size})
+    output_encoding = {key: value for key, value in encoding.items() if key not in LAYOUT_SETTINGS}
+    if encoding.get('layout') is not None:
+        item_size = np.dtype(encoding.get('dtype', 'float32')).itemsize
+        target_chunk_mb = encoding.get('target_chunk_mb', TARGET_CHUNK_MB)
+        output_encoding['chunksizes'] = get_chunk_layout(encoding['layout'], sizes, item_size, target_chunk_mb)
+    elif reset_chunksizes and 'chunksizes' in encoding:
+        output_encoding['chunksizes'] = reset_chunk_sizes(encoding['chunksizes'], sizes)
 
+    # Chunks can't be larger than the data
+    if 'chunksizes' in output_encoding:
+        output_encoding['chunksizes'] = tuple(min(int(x), sizes[dim]) for x, dim in
+                                              zip(output_encoding['chunksizes'], ['time', 'lat', 'lon']))
+
+    return output_encoding
+
+
+# Encoding and attributes with the precision of a variable
+def set_precision(encoding, variable_attributes):
+    """
+    Function for moving the precision settings of a variable from its attributes into a copy of the encoding
+    settings. keepbits rounds values to that many mantissa bits (netCDF4 BitRound quantization, at most 23 for
+    float32), least_significant_digit to that many decimal places. Bits beyond the precision are set to zero, so
+    the data compresses much better. Returns the encoding and the attributes without the precision settings.
+    """
+    encoding = dict(encoding)
+    attributes = {key: value for key, value in variable_attributes.items() if key not in PRECISION_SETTINGS}
+    keepbits = variable_attributes.get('keepbits')
+    least_significant_digit = variable_attributes.get('least_significant_digit')
+
+    if (keepbits is not None) and pd.notna(keepbits):
+        import netCDF4
+        if getattr(netCDF4, '__has_quantization_support__', False):
+            encoding['quantize_mode'] = 'BitRound'
+            encoding['significant_digits'] = int(keepbits)
+        else:
+            print('Warning: netCDF4 was built without quantization support, saving without keepbits', flush=True)
+    elif (least_significant_digit is not None) and pd.notna(least_significant_digit):
+        encoding['least_significant_digit'] = int(least_significant_digit)
+
+    return encoding, attributes
+
+
+# Chunk sizes for a layout
+def get_chunk_layout(layout, sizes, item_size, target_chunk_mb):
+    """
+    Function for getting (time, lat, lon) chunk sizes of about target_chunk_mb for a layout:
+        - map: whole maps (or bands of latitude for large grids), several days per chunk if a map is small
+        - timeseries: the whole time series of small lat/lon tiles, so reading one point reads one chunk
+        - balanced: about the same number of chunks along each dimension, between the two
+    """
+    n_time, n_lat, n_lon = sizes['time'], sizes['lat'], sizes['lon']
+    target_values = max(int(target_chunk_mb * 1024 ** 2 / item_size), 1)
+
+    if layout == 'map':
+        if n_lat * n_lon <= target_values:
+            return (min(n_time, target_values // (n_lat * n_lon)), n_lat, n_lon)
+        return (1, min(n_lat, max(target_values // n_lon, 1)), n_lon)
+
+    if layout == 'timeseries':
+        if n_time > target_values:
+            return (target_values, 1, 1)
+        lat_chunk = min(n_lat, max(math.isqrt(target_values // n_time), 1))
+        lon_chunk = min(n_lon, max(target_values // (n_time * lat_chunk), 1))
+        return (n_time, lat_chunk, lon_chunk)
+
+    if layout == 'balanced':
+        fraction = min((target_values / (n_time * n_lat * n_lon)) ** (1 / 3), 1)
+        return tuple(min(x, max(round(x * fraction), 1)) for x in [n_time, n_lat, n_lon])
+
+    raise ValueError(f'Unknown chunk layout {layout}, must be one of {", ".join(CHUNK_LAYOUTS)}')
+
+
+# Node-local scratch directory
+def get_scratch_root(dask_settings):
+    """
+    Function for getting the directory for files only needed while a task runs: the scratch_directory setting of
+    dask_parameters.csv, else $TMPDIR (node-local on most clusters), else dask_temp_directory, else the system
+    temporary directory
+    """
+    for directory in [dask_settings.get('scratch_directory'), os.environ.get('TMPDIR'),
+                      dask_settings.get('dask_temp_directory')]:
+        if (directory is not None) and pd.notna(directory) and str(directory).strip():
+            return str(directory)
+
+    return tempfile.gettempdir()
+
+
+# Stage the files of a task on node-local scratch
+def start_staging(scratch_root, name):
+    """
+    Function for making a new directory in scratch_root for the temporary and unfinished output files of a task (see
+    get_staging_dir). Finished outputs are moved from there to their output directory with publish_output.
+    """
+    global staging_dir
+    os.makedirs(scratch_root, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(prefix=f'{name}_', dir=scratch_root)
+
+
+# Stop staging files
+def stop_staging():
+    """
+    Function for removing the staging directory of a task, with anything left in it, ex. after a failure
+    """
+    global staging_dir
+    if staging_dir is not None:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    staging_dir = None
+
+
+# Staging directory standing in for a directory
+def get_staging_dir(path):
+    """
+    Function for getting the directory in the staging directory used in place of path (the same path below the
+    staging directory), or path itself if files aren't being staged
+    """
+    if staging_dir is None:
+        return path
+
+    return os.path.join(staging_dir, os.path.relpath(os.path.abspath(path), os.path.abspath(os.sep)))
+
+
+# Move a finished output file into place
+def publish_output(staged_file, output_file):
+    """
+    Function for moving a finished output file from the staging directory to its output location. It's moved next to
+    the output file first and then renamed, so the output file is never seen half written, even when moved from
+    another file system.
+    """
+    if os.path.abspath(staged_file) == os.path.abspath(output_file):
+        return
+
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    temp_file = f'{output_file}.{socket.gethostname()}.{os.getpid()}.tmp'
+    try:
+        shutil.move(staged_file, temp_file)
+        os.replace(temp_file, output_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+
+# Stamp of an input file, to tell if it changed since it was copied
+def get_file_stamp(source):
+    """
+    Function for getting the size and modification time of a local input file, or None for a URL or missing file
+    """
+    if not os.path.exists(source):
+        return None
+
+    return os.path.getsize(source), os.path.getmtime(source)
+
+
+# Local copy of an input file, if one was prefetched
+def get_prefetched_file(source):
+    """
+    Function for getting the local copy of an input file made by prefetch.py, or source itself if there is none, or
+    the file changed after it was copied
+    """
+    local_file, stamp = prefetched_files.get(source, (None, None))
+    if (local_file is None) or (get_file_stamp(source) != stamp):
+        return source
+
+    return local_file
+
+
+# Write a copy of an output file for reading time series
+def write_timeseries_copy(file_path, copy_path, variable, encoding):
+    """
+    Function for writing a copy of an output file with the timeseries chunk layout, for programs that read the whole
+    time series of a few points. The data is rechunked by Dask to the same chunks as the file, so each chunk is
+    written once. Like the other output, it's written in the staging directory under a temporary name, and moved
+    into place when finished.
+    """
+    stage_dir = get_staging_dir(os.path.dirname(copy_path))
+    os.makedirs(stage_dir, exist_ok=True)
+    temp_file = os.path.join(stage_dir, f'{os.path.basename(copy_path)}.{socket.gethostname()}.{os.getpid()}.tmp')
+    try:
+        with xr.open_dataset(file_path, chunks={}) as data:
+            copy_encoding = get_output_encoding(dict(encoding, layout='timeseries'), False, data.sizes)
+            data = data.transpose('time', 'lat', 'lon', ...)
+            data = data.chunk(dict(zip(['time', 'lat', 'lon'], copy_encoding['chunksizes'])))
+            data.to_netcdf(temp_file, encoding={variable: copy_encoding})
+        publish_output(temp_file, copy_path)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+
+# Whether a task is one latitude band of a tiled task
+def is_tiled(run_object):
+    """
+    Function for checking if a task was split into latitude bands (tiles) by job-script-generation.py --tiles
+    """
+    return (getattr(run_object, 'n_tiles', None) or 1) > 1
+
+
+# Output file name of one tile
+def get_tile_file_name(file_name, run_object):
+    """
+    Function for getting the name of the file a tile writes in place of file_name, put together by mosaic.py
+    """
+    if file_name is None:
+        return None
+
+    return f'{os.path.splitext(file_name)[0]}_tile{run_object.tile}of{run_object.n_tiles}.nc'
+
+
+# Latitude rows of one tile
+def get_tile_rows(run_object, n_lat_coarse, n_lat_fine):
+    """
+    Function for getting the latitude rows (slices) of the coarse (ESM) and fine (reference) grids in a tile. The
+    coarse grid is split into n_tiles bands of about the same size, each with TILE_HALO extra cells on either side,
+    and the fine grid is split at the same places.
+    """
+    if run_object.n_tiles > n_lat_coarse // TILE_HALO:
+        raise ValueError(f'Can\'t split {n_lat_coarse} latitudes into {run_object.n_tiles} tiles')
+
+    edges = np.linspace(0, n_lat_coarse, run_object.n_tiles + 1).round().astype(int)
+    start = max(edges[run_object.tile] - TILE_HALO, 0)
+    end = min(edges[run_object.tile + 1] + TILE_HALO, n_lat_coarse)
+    ratio = n_lat_fine // n_lat_coarse
+
+    return slice(start, end), slice(start * ratio, end * ratio)
+
+
+# Halo rows of one tile
+def get_tile_halo(tile, n_tiles, ratio=1):
+    """
+    Function for getting the number of halo rows at the start and end of a tile's output, ratio being the number of
+    rows of its grid in each coarse cell. The first and last tiles have no halo at the edges of the grid.
+    """
+    return (0 if tile == 0 else TILE_HALO * ratio), (0 if tile == n_tiles - 1 else TILE_HALO * ratio)
+
+
+# Whether to process only the grid cells with reference data
+def use_compact_cells(input_path):
+    """
+    Function for reading the compact_cells setting of dask_parameters.csv, off if not given
+    """
+    if task_plan is not None:
+        dask_params = task_plan['dask']
+    else:
+        dask_params = read_dask_settings(input_path)
+    compact_cells = dask_params.get('compact_cells')
+
+    return (compact_cells is not None) and pd.notna(compact_cells) and bool(compact_cells)
+
+
+# Whether to read back the output files basd wrote for their quality statistics
+def use_qa_stats(input_path):
+    """
+    Function for reading the qa_stats setting of dask_parameters.csv, off if not given
+    """
+    if task_plan is not None:
+        dask_params = task_plan['dask']
+    else:
+        dask_params = read_dask_settings(input_path)
+    qa_stats = dask_params.get('qa_stats')
+
+    return (qa_stats is not None) and pd.notna(qa_stats) and bool(qa_stats)
+
+
+# Grid cells of the reference data that have data
+def get_valid_cells(obs_reference_data, run_object, run_name):
+    """
+    Function for getting a mask (DataArray of lat and lon) of the reference grid cells that have data, ex. the land
+    cells of a land-only dataset. The mask is found from the first VALID_CELL_DAYS days once per reference dataset and
+    variable (and region and ESM, for regional tasks), and saved in intermediate/<run_name>/valid_cells for later
+    tasks.
+    """
+    mask_name = f'{run_object.Reference_Dataset}_{run_object.Variable}'
+    if get_region_name(run_object) != 'global':
+        mask_name = f'{mask_name}_{get_region_name(run_object)}_{run_object.ESM}'
+    mask_file = os.path.join('intermediate', run_name, 'valid_cells', f'{mask_name}.nc')
+    if not os.path.exists(mask_file):
+        os.makedirs(os.path.dirname(mask_file), exist_ok=True)
+        data = obs_reference_data[run_object.Variable].isel(time=slice(0, VALID_CELL_DAYS))
+        valid_cells = data.notnull().any('time').compute().rename('valid_cells')
+        temp_file = f'{mask_file}.{socket.gethostname()}.{os.getpid()}.tmp'
+        valid_cells.to_netcdf(temp_file)
+        os.replace(temp_file, mask_file)
+
+    with xr.open_dataset(mask_file) as mask:
+        return mask['valid_cells'].load()
+
+
+# Rows and columns of the grids that contain cells with data
+def get_compact_cells(valid_cells, coarse_sizes, fine_sizes):
+    """
+    Function for getting the rows and columns (dictionaries of lat and lon indices, for Dataset.isel) of the coarse
+    (ESM) and fine (reference) grids to process, leaving out rows and columns of coarse cells with no valid fine
+    cells. TILE_HALO coarse cells around the cells with data are kept, so they are downscaled with their real
+    neighbours.
+    """
+    coarse_cells, fine_cells = {}, {}
+    for dim, other_dim in [('lat', 'lon'), ('lon', 'lat')]:
+        ratio = fine_sizes[dim] // coarse_sizes[dim]
+        has_data = valid_cells.any(other_dim).values[:coarse_sizes[dim] * ratio]
+        has_data = has_data.reshape(coarse_sizes[dim], ratio).any(axis=1)
+        # Keep the neighbours of cells with data, wrapping around in longitude as the grid is global
+        keep = has_data.copy()
+        for shift in range(1, TILE_HALO + 1):
+            if dim == 'lon':
+                keep |= np.roll(has_data, shift) | np.roll(has_data, -shift)
+            else:
+                keep[shift:] |= has_data[:-shift]
+                keep[:-shift] |= has_data[shift:]
+        coarse_cells[dim] = np.flatnonzero(keep)
+        fine_cells[dim] = (coarse_cells[dim][:, None] * ratio + np.arange(ratio)).ravel()
+
+    return coarse_cells, fine_cells
+
+
+# Put an output file written on the compact grid back on the whole grid
+def expand_output(file_path, grid, variable, encoding, time_chunk_size, bounds=None):
+    """
+    Function for rewriting an output file processed on the compact grid (see get_compact_cells) on the whole grid
+    (dictionary of lat and lon coordinates), with missing values in the cells left out. With bounds given, (lower
+    bound, upper bound), the quality statistics of the file (see qa.py) are computed as it's rewritten.
+    """
+    import dask
+    import qa
+
+    temp_file = f'{file_path}.{os.getpid()}.tmp'
+    with xr.open_dataset(file_path, chunks={'time': time_chunk_size}) as data:
+        data = data.reindex(lat=grid['lat'], lon=grid['lon']).transpose('time', 'lat', 'lon', ...)
+        write = data.to_netcdf(temp_file, encoding={variable: encoding}, compute=False)
+        _, stats = dask.compute(write, qa.get_stats(data[variable], *bounds) if bounds is not None else None)
+    os.replace(temp_file, file_path)
+    if bounds is not None:
+        qa.save_stats(stats, file_path, variable, *bounds)
+
+
+# Name of the region of a task
+def get_region_name(run_object):
+    """
+    Function for getting the name of the region of a task, used in output file names, or global if it has none
+    """
+    region = getattr(run_object, 'Region', None)
+
+    return 'global' if (region is None) or pd.isna(region) else str(region)
+
+
+# Whether a region mask file is a set of shapes
+def is_shapefile(mask_path):
+    """
+    Function for checking if a Region_Mask file holds shapes (ex. a shapefile) to be rasterized, instead of a NetCDF
+    mask on a lat/lon grid
+    """
+    return os.path.splitext(mask_path)[1].lower() in ['.shp', '.geojson', '.gpkg']
+
+
+# Read the shapes of a region
+def read_region_shapes(mask_path):
+    """
+    Function for reading the shapes of a region with geopandas, which is only needed for regions given as shapes
+    """
+    try:
+        import geopandas
+    except ImportError:
+        raise ImportError(f'geopandas is needed to read {mask_path}, or give the region as a NetCDF mask or '
+                          f'Region_Bounds instead') from None
+
+    return geopandas.read_file(mask_path).to_crs('EPSG:4326')
+
+
+# Read a NetCDF region mask
+def read_region_mask(mask_path):
+    """
+    Function for reading a NetCDF region mask, its first variable on a lat/lon grid, as a boolean DataArray that is
+    true in the region
+    """
+    with xr.open_dataset(mask_path) as mask_data:
+        mask = mask_data[list(mask_data.data_vars)[0]].load()
+
+    return mask.fillna(0) > 0
+
+
+# Bounding box of the region of a task
+def get_region_bounds(run_object):
+    """
+    Function for getting the bounding box (west, south, east, north) of the region of a task, from Region_Bounds,
+    else the extent of Region_Mask, or None for a global task
+    """
+    bounds = getattr(run_object, 'Region_Bounds', None)
+    mask_path = getattr(run_object, 'Region_Mask', None)
+    if (bounds is not None) and pd.notna(bounds):
+        return tuple(float(x) for x in str(bounds).split())
+    if (mask_path is None) or pd.isna(mask_path):
+        return None
+
+    if is_shapefile(mask_path):
+        return tuple(float(x) for x in read_region_shapes(mask_path).total_bounds)
+    mask = read_region_mask(mask_path)
+    lat = mask['lat'].values[mask.any('lon').values]
+    lon = mask['lon'].values[mask.any('lat').values]
+    lat_step = np.abs(np.diff(mask['lat'].values)).max() / 2
+    lon_step = np.abs(np.diff(mask['lon'].values)).max() / 2
+
+    return lon.min() - lon_step, lat.min() - lat_step, lon.max() + lon_step, lat.max() + lat_step
+
+
+# Grid cells of a region
+def get_region_cells(data, region_bounds, overlapping=False):
+    """
+    Function for getting the rows and columns (dictionary of lat and lon indices, for Dataset.isel) of a grid in a
+    region's bounding box, the cells with centres inside it or, if overlapping, every cell overlapping it. Longitude
+    is measured eastwards from the west edge, so regions can cross the date line, and the columns are put in order
+    from west to east.
+    """
+    west, south, east, north = region_bounds
+    lat = data['lat'].values
+    lon = data['lon'].values
+    # Longitude relative to the middle of the region, between -180 and 180
+    width = 360 if east - west >= 360 else (east - west) % 360
+    relative_lon = (lon - (west + width / 2) + 180) % 360 - 180
+
+    if overlapping:
+        # Cells overlapping the region, not only touching its edges
+        lat_half = np.abs(np.gradient(lat)) / 2
+        lon_half = np.abs(np.gradient(lon)) / 2
+        lat_cells = np.flatnonzero((lat - lat_half < north) & (lat + lat_half > south))
+        lon_cells = np.flatnonzero(np.abs(relative_lon) - lon_half < width / 2)
+    else:
+        lat_cells = np.flatnonzero((lat <= north) & (lat >= south))
+        lon_cells = np.flatnonzero(np.abs(relative_lon) <= width / 2)
+    lon_cells = lon_cells[np.argsort(relative_lon[lon_cells], kind='stable')]
+    if (lat_cells.size == 0) or (lon_cells.size == 0):
+        raise ValueError(f'No grid cells in the region {region_bounds}')
+
+    return {'lat': lat_cells, 'lon': lon_cells}
+
+
+# Snap the bounding box of a region to the edges of the cells of a grid
+def snap_region_bounds(data, region_bounds):
+    """
+    Function for widening the bounding box of a region to the edges of the grid cells of data (the ESM grid) that
+    overlap it, so that the reference grid is cut at the edges of the same ESM grid cells
+    """
+    cells = get_region_cells(data, region_bounds, overlapping=True)
+    lat = data['lat'].values
+    lon = data['lon'].values
+    lat_half = np.abs(np.gradient(lat))[cells['lat']] / 2
+    lon_half = np.abs(np.gradient(lon))[cells['lon']] / 2
+    lat = lat[cells['lat']]
+    # Longitude of the columns continuing eastwards from the first one, across the date line
+    lon = lon[cells['lon']]
+    lon = lon[0] + (lon - lon[0]) % 360
+
+    return ((lon - lon_half).min(), (lat - lat_half).min(), (lon + lon_half).max(), (lat + lat_half).max())
+
+
+# Cut the region out of data
+def select_region(data, region_bounds):
+    """
+    Function for cutting the grid cells of a region's bounding box out of data, or returning it as is if there is no
+    region
+    """
+    if region_bounds is None:
+        return data
+
+    return data.isel(get_region_cells(data, region_bounds))
+
+
+# Mask of a region on the grid of some data
+def get_region_mask(run_object, run_name, data):
+    """
+    Function for getting the mask (boolean DataArray of lat and lon) of a region given by Region_Mask on the grid of
+    data, or None if the region is only a bounding box. Shapes are rasterized, and NetCDF masks put on the grid by
+    nearest neighbour, once per grid and saved in intermediate/<run_name>/region_masks for later tasks.
+    """
+    mask_path = getattr(run_object, 'Region_Mask', None)
+    if (mask_path is None) or pd.isna(mask_path):
+        return None
+
+    # Grids cut from the same reference data for different ESMs differ, so the grid is part of the file name
+    grid_hash = hashlib.sha1(data['lat'].values.tobytes() + data['lon'].values.tobytes()).hexdigest()[:16]
+    mask_file = os.path.join('intermediate', run_name, 'region_masks', f'{get_region_name(run_object)}_{grid_hash}.nc')
+    if not os.path.exists(mask_file):
+        os.makedirs(os.path.dirname(mask_file), exist_ok=True)
+        if is_shapefile(mask_path):
+            try:
+                import regionmask
+            except ImportError:
+                raise ImportError(f'regionmask is needed to rasterize {mask_path}, or give the region as a '
+                                  f'NetCDF mask or Region_Bounds instead') from None
+            shapes = read_region_shapes(mask_path)
+            mask = regionmask.mask_geopandas(shapes, data['lon'], data['lat']).notnull()
+        else:
+            mask = read_region_mask(mask_path)
+            # Longitude of the grid in the convention of the mask, 0 to 360 or -180 to 180
+            if mask['lon'].max() > 180:
+                lon = data['lon'].values % 360
+            else:
+                lon = (data['lon'].values + 180) % 360 - 180
+            mask = mask.sel(lat=data['lat'].values, lon=lon, method='nearest')
+            mask = mask.assign_coords(lat=data['lat'].values, lon=data['lon'].values)
+        mask = mask.transpose('lat', 'lon').rename('region_mask')
+        temp_file = f'{mask_file}.{socket.gethostname()}.{os.getpid()}.tmp'
+        mask.to_netcdf(temp_file)
+        os.replace(temp_file, mask_file)
+
+    with xr.open_dataset(mask_file) as mask:
+        return mask['region_mask'].load()
+
+
+# Mask out the grid cells outside of a region
+def mask_region(data, region_mask, variable):
+    """
+    Function for setting the grid cells of data outside of the region mask to missing values, so they are treated
+    like cells without reference data
+    """
+    if region_mask is None:
+        return data
+
+    data[variable] = data[variable].where(region_mask)
+
+    return data
+
+
+# Function for loading in data for statistical downscaling routine, including trimming to respective periods
+def load_sd_data(run_object, input_ref_dir, time_chunk_size, output_ba_path, output_day_ba_file_name,
+                 region_bounds=None, region_mask=None):
+    """
+    Function for loading in data for statistical downscaling routine, including trimming to respective periods, and
+    to the region of the task if it has one (the bias adjusted data already covers only the region)
+    """
     # Get application and target periods
     application_start_year, application_end_year = str.split(run_object.application_period, '-')
     target_start_year, target_end_year = str.split(run_object.target_period, '-')
 
-    # Subsetting desired time
-    obs_reference_data = obs_reference_data.sel(time = slice(f'{target_start_year}', f'{target_end_year}'))
-    sim_application_data = sim_application_data.sel(time = slice(f'{application_start_year}', f'{application_end_year}'))
-    
-    # Drop unwanted vars
-    obs_reference_data = obs_reference_data.drop([x for x in list(obs_reference_data.coords) if x not in ['time', 'lat', 'lon']])
-    sim_application_data = sim_application_data.drop([x for x in list(sim_application_data.coords) if x not in ['time', 'lat', 'lon']])
+    # Only open reference files that overlap the target period
+    obs_reference_files = get_input_files(input_ref_dir, f'{run_object.Variable}_*.nc', target_start_year, target_end_year,
+                                          run_object.Variable)
+
+    # Load in data for downscaling, trimmed to the desired time, region and variable as it is opened
+    obs_reference_data = open_input_data(obs_reference_files, run_object.Variable, time_chunk_size, target_start_year, target_end_year,
+                                         region_bounds)
+    obs_reference_data = mask_region(obs_reference_data, region_mask, run_object.Variable)
+    sim_application_data = open_input_data([os.path.join(output_ba_path, output_day_ba_file_name)], run_object.Variable, time_chunk_size,
+                                           application_start_year, application_end_year)
 
     return obs_reference_data, sim_application_data
 
 
+# Driver script of a task
+def get_driver(task):
+    """
+    Function for getting the driver module that runs a task: pangeo when no ESM input location is given (apart from
+    tasrange/tasskew, made from Pangeo data in intermediate), stitched for STITCHED data, and downloaded otherwise
+    """
+    if (task.ESM_Input_Location is None) and (task.Variable not in ['tasrange', 'tasskew']):
+        import pangeo
+        return pangeo
+    if task.stitched:
+        import stitched
+        return stitched
+    import downloaded
+    return downloaded
+
+
+# Date range at the end of CMIP style file names, ex. tas_day_<ESM>_<scenario>_<ensemble>_20150101-21001231.nc
+FILE_PERIOD_PATTERN = re.compile(r'_(\d{4,8})-(\d{4,8})\.nc$')
+
+
+# Get the year from a date string found in a file name
+def parse_file_date_year(date_str):
+    """
+    Function for getting the year from a file name date string. Accepts YYYY, YYYYMM, YYYYMMDD (CMIP convention),
+    and MMDDYYYY. Returns None if the string can't be read as a date.
+    """
+    # Year, or year and month
+    if len(date_str) in [4, 6]:
+        return int(date_str[:4])
+    
+    if len(date_str) == 8:
+        # YYYYMMDD
+        if (1 <= int(date_str[4:6]) <= 12) and (1 <= int(date_str[6:8]) <= 31):
+            return int(date_str[:4])
+        # MMDDYYYY
+        if (1 <= int(date_str[0:2]) <= 12) and (1 <= int(date_str[2:4]) <= 31):
+            return int(date_str[4:8])
+    
+    return None
+
+
+# Get the years covered by a file from its name
+def get_file_years(file_name):
+    """
+    Function for reading the start and end years of the date range in a CMIP style file name.
+    Returns None if the file name doesn't contain a date range.
+    """
+    match = FILE_PERIOD_PATTERN.search(os.path.basename(file_name))
+    if match is None:
+        return None
+    
+    start_year = parse_file_date_year(match.group(1))
+    end_year = parse_file_date_year(match.group(2))
+    if (start_year is None) or (end_year is None):
+        return None
+
+    return start_year, end_year
+
+
+# Input inventory, only listing files which overlap the requested period
+def get_input_files(input_dir, file_pattern, start_year=None, end_year=None, variable=None):
+    """
+    Function for listing the files matching a pattern whose file name date range overlaps the given years.
+    Files without a date range in their name are always kept, since we can't tell what they cover. With variable
+    given, and a derived variable (see DERIVED_VARIABLES) with no files of its own, the names its files would have
+    are listed, from the files of its first source variable. open_input_data computes the data for these names.
+    """
+    all_files = sorted(glob.glob(os.path.join(input_dir, file_pattern)))
+    if (len(all_files) == 0) and (variable in DERIVED_VARIABLES):
+        source_variable = DERIVED_VARIABLES[variable]['inputs'][0]
+        source_files = sorted(glob.glob(swap_file_variable(os.path.join(input_dir, file_pattern), variable, source_variable)))
+        all_files = [swap_file_variable(x, source_variable, variable) for x in source_files]
+    if len(all_files) == 0:
+        raise FileNotFoundError(f'No files matching {os.path.join(input_dir, file_pattern)}')
+    
+    # No period given, keep everything
+    if (start_year is None) or (end_year is None):
+        return all_files
+
+    # Keep files that overlap the period
+    overlapping_files = []
+    for file_path in all_files:
+        file_years = get_file_years(file_path)
+        if (file_years is None) or ((file_years[0] <= int(end_year)) and (file_years[1] >= int(start_year))):
+            overlapping_files.append(file_path)
+
+    if len(overlapping_files) == 0:
+        raise FileNotFoundError(f'No files matching {os.path.join(input_dir, file_pattern)} cover {start_year}-{end_year}')
+
+    return overlapping_files
+
+
+# Name of the file of another variable
+def swap_file_variable(file_path, variable, new_variable):
+    """
+    Function for replacing the variable name in a file name (or pattern), ex. tasmin_day_<ESM>_... to
+    tasrange_day_<ESM>_.... The directory is replaced too if it's named after the variable, as the observational
+    data is kept in <Reference_Input_Location>/<variable>/.
+    """
+    input_dir, file_name = os.path.split(file_path)
+    file_name = re.sub(rf'(?<![A-Za-z0-9]){variable}(?![A-Za-z0-9])', new_variable, file_name, count=1)
+    if os.path.basename(input_dir) == variable:
+        input_dir = os.path.join(os.path.dirname(input_dir), new_variable)
+
+    return os.path.join(input_dir, file_name)
+
+
+# Files read for an input file
+def get_source_files(file_path, variable):
+    """
+    Function for getting the files read for an input file of variable: the file itself, or if it's a derived variable
+    without a file of its own, the files of its source variables (see DERIVED_VARIABLES)
+    """
+    if os.path.exists(file_path) or (variable not in DERIVED_VARIABLES):
+        return [file_path]
+
+    return [swap_file_variable(file_path, variable, x) for x in DERIVED_VARIABLES[variable]['inputs']]
+
+
+# Open a derived variable, computing it from its source variables
+def open_derived_data(file_paths, variable, time_chunk_size, start_year=None, end_year=None, region_bounds=None):
+    """
+    Function for lazily computing a derived variable (see DERIVED_VARIABLES) from the files of its source variables,
+    file_paths being the names its own files would have. The data is computed chunk by chunk as it's used, so it's
+    never written out or read back. Closing the returned data closes the source files.
+    """
+    source_variables = DERIVED_VARIABLES[variable]['inputs']
+    sources = [open_input_data([swap_file_variable(x, variable, source_variable) for x in file_paths], source_variable,
+                               time_chunk_size, start_year, end_year, region_bounds)
+               for source_variable in source_variables]
+
+    data = compute_variable(DERIVED_VARIABLES[variable], [x[y] for x, y in zip(sources, source_variables)], variable)
+    data = data.to_dataset(name=variable)
+    data.set_close(lambda: [x.close() for x in sources])
+
+    return data
+
+
+# Open input files, pushing the variable, coordinate and time selection into the open step
+def open_input_data(file_paths, variable, time_chunk_size, start_year=None, end_year=None, region_bounds=None):
+    """
+    Function for lazily opening a list of files, keeping only the given variable and the time, lat and lon
+    coordinates, trimmed to the given years and region (bounding box, see get_region_cells). The selection is done
+    per file as it's opened, so extra variables, coordinates (ex. time_bnds, height) and grid cells outside the region
+    are never combined, decoded or rechunked. The variable is cast to compute_dtype as it's read (see
+    to_compute_dtype). Derived variables without files of their own are computed from the files of their source
+    variables (see open_derived_data).
+    """
+    if (variable in DERIVED_VARIABLES) and not all(os.path.exists(x) for x in file_paths):
+        return open_derived_data(file_paths, variable, time_chunk_size, start_year, end_year, region_bounds)
+
+    def preprocess(ds):
+        # Keep only the requested variable and the time/lat/lon coordinates
+        ds = ds[[variable]]
+        ds = ds.drop_vars([x for x in list(ds.coords) if x not in ['time', 'lat', 'lon']])
+
+        # Decoded in the precision it's computed in
+        ds[variable] = to_compute_dtype(ds[variable], variable, 'read')
+
+        # Subsetting desired time
+        if (start_year is not None) and (end_year is not None):
+            ds = ds.sel(time = slice(f'{start_year}', f'{end_year}'))
+
+        # Cutting out the region
+        ds = select_region(ds, region_bounds)
+        
+        return ds
+
+    # Read local copies of the files, if they were prefetched
+    file_paths = [get_prefetched_file(x) for x in file_paths]
+
+    return xr.open_mfdataset(file_paths, chunks={'time': time_chunk_size}, preprocess=preprocess, 
+                             data_vars='minimal', coords='minimal', compat='override')
+
+
+# Cache reference period data shared with other tasks
+def start_reference_cache(cache_dir):
+    """
+    Function for starting to cache reference period data (observational and historical simulated data) in cache_dir.
+    Data opened with open_reference_data is trimmed, rechunked and saved there by the first task that needs it, and
+    read from there by later tasks and ensemble members using the same data.
+    """
+    global reference_cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+    reference_cache_dir = cache_dir
+
+
+# Stop caching reference period data
+def stop_reference_cache():
+    """
+    Function for no longer using the reference cache in this process. The cached data is kept for other tasks.
+    """
+    global reference_cache_dir
+    reference_cache_dir = None
+
+
+# File of a set of reference data in the reference cache
+def get_reference_cache_file(file_paths, variable, start_year, end_year, lat_chunk_size, lon_chunk_size, source=None,
+                             region_bounds=None):
+    """
+    Function for getting the path of the cache file of a set of reference data, or None if the cache isn't in use.
+    The data is identified by its files, with their sizes and modification times so that changed files are read
+    again, or by source (ex. a Pangeo URL) for data that is downloaded by each task.
+    """
+    if reference_cache_dir is None:
+        return None
+
+    if source is None:
+        source = [[os.path.abspath(y), os.path.getsize(y), os.path.getmtime(y)] for x in sorted(file_paths)
+                  for y in get_source_files(x, variable)]
+    key = [source, variable, int(start_year), int(end_year), int(lat_chunk_size), int(lon_chunk_size),
+           str(compute_dtype)]
+    if region_bounds is not None:
+        key.append([float(x) for x in region_bounds])
+    key = json.dumps(key)
+
+    return os.path.join(reference_cache_dir,
+                        f'{variable}_{start_year}_{end_year}_{hashlib.sha1(key.encode()).hexdigest()[:16]}.nc')
+
+
+# Open reference period data, from the reference cache if in use
+def open_reference_data(file_paths, variable, time_chunk_size, start_year, end_year, lat_chunk_size, lon_chunk_size,
+                        source=None, region_bounds=None):
+    """
+    Function for opening reference period data. When the reference cache is in use (see start_reference_cache), the
+    first task rechunks it to the whole time series of lat/lon chunks, as used by bias adjustment, and saves it.
+    Later tasks read those chunks directly, instead of reading and rechunking the original files again.
+    """
+    cache_file = get_reference_cache_file(file_paths, variable, start_year, end_year, lat_chunk_size, lon_chunk_size,
+                                          source, region_bounds)
+    if cache_file is None:
+        return open_input_data(file_paths, variable, time_chunk_size, start_year, end_year, region_bounds)
+
+    if os.path.exists(cache_file):
+        print(f'Using cached reference data {cache_file}', flush=True)
+    else:
+        # Tasks using the same data can run at the same time, so each writes its own file and moves it into place
+        temp_file = f'{cache_file}.{socket.gethostname()}.{os.getpid()}.tmp'
+        with open_input_data(file_paths, variable, time_chunk_size, start_year, end_year, region_bounds) as data:
+            chunks = {'time': data.sizes['time'], 'lat': min(lat_chunk_size, data.sizes['lat']),
+                      'lon': min(lon_chunk_size, data.sizes['lon'])}
+            data.chunk(chunks).to_netcdf(temp_file, encoding={
+                variable: {'chunksizes': tuple(chunks[x] for x in data[variable].dims)}
+            })
+        os.replace(temp_file, cache_file)
+
+    return xr.open_dataset(cache_file, chunks={'time': -1, 'lat': lat_chunk_size, 'lon': lon_chunk_size})
+
+
 # Function for reading in encoding parameters to be passed to xarray.to_netcdf()
 def get_encoding(input_path):
     """
     Function for reading in encoding parameters to be passed to xarray.to_netcdf()
     """
+    if task_plan is not None:
+        encoding_data_dict = dict(task_plan['encoding'])
+        if 'chunksizes' in encoding_data_dict:
+            encoding_data_dict['chunksizes'] = tuple(encoding_data_dict['chunksizes'])
+        return encoding_data_dict, task_plan['reset_chunksizes']
+
+    return read_encoding(input_path)
+
+
+# Read encoding parameters
+def read_encoding(input_path):
+    """
+    Function for reading the encoding parameters from the input file
+    """
     # Read in encoding input file
     encoding_data = pd.read_csv(os.path.join(input_path, 'encoding.csv'))
 
@@ -125,12 +1135,19 @@ def get_encoding(input_path):
     # If one or more set to "max", set reset_encoding_chunks = True, meaning
     # that the chunksizes will later be set to whatever the data dimensions are
     reset_encoding_chunks = False
-    if np.any( [pd.isna(encoding_data['time_chunk']), pd.isna(encoding_data['lat_chunk']), pd.isna(encoding_data['lon_chunk'])] ):
-        del encoding_data_dict['time_chunk'], encoding_data_dict['lat_chunk'], encoding_data_dict['lon_chunk']
+    # Columns can be left out when a layout is given
+    if np.any( [(x not in encoding_data) or encoding_data[x].isna().all() for x in ['time_chunk', 'lat_chunk', 'lon_chunk']] ):
+        for x in ['time_chunk', 'lat_chunk', 'lon_chunk']:
+            encoding_data_dict.pop(x, None)
     else:
         if 'max' in [encoding_data_dict['time_chunk'], encoding_data_dict['lat_chunk'], encoding_data_dict['lon_chunk']]:
             reset_encoding_chunks = True
-            encoding_data_dict['chunksizes'] = (encoding_data_dict['time_chunk'], encoding_data_dict['lat_chunk'], encoding_data_dict['lon_chunk'])
+        encoding_data_dict['chunksizes'] = (encoding_data_dict['time_chunk'], encoding_data_dict['lat_chunk'], encoding_data_dict['lon_chunk'])
         del encoding_data_dict['time_chunk'], encoding_data_dict['lat_chunk'], encoding_data_dict['lon_chunk']
+
+    # Codec given in the compression column, auto is chosen by each task (see compression.py)
+    if encoding_data_dict.get('compression', 'auto') != 'auto':
+        import compression
+        encoding_data_dict = compression.set_codec(encoding_data_dict, encoding_data_dict['compression'])
     
     return encoding_data_dict, reset_encoding_chunks
\ No newline at end of file